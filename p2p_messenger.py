@@ -1,17 +1,53 @@
 import socket
+import asyncio
 import threading
+import queue
 import base64
 import json
 import os
-import pyaudio
+import zlib
 import wave
+import numpy as np
 import time
+import uuid
+import hmac
+import struct
+import functools
+import hashlib
+import bisect
+import errno
+import random
+import selectors
+import io
+import sqlite3
+import shutil
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future
 from getpass import getpass
 from playsound import playsound
-from PIL import Image, ImageGrab
+from PIL import Image, ImageGrab, features
 from cryptography.fernet import Fernet
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+
+try:
+    import pyaudio
+except ImportError: # Headless boxes can still use SyntheticAudioBackend
+    pyaudio = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import opuslib
+except Exception: # Not installed, or libopus itself is missing
+    opuslib = None
 
 def derive_key(password: str, salt: bytes) -> bytes:
     """Derives a key from a password and salt."""
@@ -23,39 +59,1570 @@ def derive_key(password: str, salt: bytes) -> bytes:
     )
     return base64.urlsafe_b64encode(kdf.derive(password.encode()))
 
+class KeyDerivationService:
+    """Runs derive_key on a worker pool and caches the results for the process lifetime.
+
+    derive() returns a concurrent.futures.Future, so a UI thread never waits on
+    PBKDF2. Repeated requests for the same secret and salt (e.g. reconnects)
+    resolve immediately from the cache. Concurrent requests for the same pair
+    share one derivation. Cache entries are keyed by an HMAC under a random
+    per-process key, so the secret itself is never stored. Keys live in
+    bytearrays that are overwritten on eviction and on clear().
+    """
+    def __init__(self, max_workers=2, max_entries=8):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="kdf")
+        self.max_entries = max_entries
+        self.cache = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self._cache_secret = os.urandom(32)
+
+    def _cache_key(self, password, salt):
+        return hmac.new(self._cache_secret, salt + b'\x00' + password.encode(), hashlib.sha256).digest()
+
+    def derive(self, password: str, salt: bytes) -> Future:
+        cache_key = self._cache_key(password, salt)
+        with self.lock:
+            if cache_key in self.cache:
+                self.cache.move_to_end(cache_key)
+                future = Future()
+                future.set_result(bytes(self.cache[cache_key]))
+                return future
+            if cache_key in self.pending:
+                return self.pending[cache_key]
+            future = self.executor.submit(derive_key, password, salt)
+            self.pending[cache_key] = future
+        future.add_done_callback(lambda f: self._store(cache_key, f))
+        return future
+
+    def _store(self, cache_key, future):
+        with self.lock:
+            self.pending.pop(cache_key, None)
+            if future.cancelled() or future.exception():
+                return
+            self.cache[cache_key] = bytearray(future.result())
+            while len(self.cache) > self.max_entries:
+                _, key = self.cache.popitem(last=False)
+                self._zeroize(key)
+
+    @staticmethod
+    def _zeroize(key):
+        for i in range(len(key)):
+            key[i] = 0
+
+    def clear(self):
+        """Overwrites and forgets every cached key."""
+        with self.lock:
+            for key in self.cache.values():
+                self._zeroize(key)
+            self.cache.clear()
+
+FILE_CHUNK_SIZE = 64 * 1024   # Plaintext bytes per streamed file chunk
+FILE_OFFER_TIMEOUT = 30       # Seconds to wait for the peer to accept a file offer
+TRANSFER_JOURNAL_DIR = ".transfers"   # Partial files and resume journals, inside downloads_dir
+CONTENT_STORE_DIR = ".store"          # Received files by sha256, inside downloads_dir
+TRANSFER_JOURNAL_TTL = 7 * 24 * 3600  # Seconds before an interrupted transfer is given up
+CHUNK_RECORD = struct.Struct('>QI32s') # Manifest entry: offset, length, sha256 of the chunk
+# Flow control: a sender may have FLOW_WINDOW bytes of a transfer in flight
+# that the receiver has not yet written out. The receiver hands the credit
+# back with a 'window_update' whenever a quarter of it has drained.
+FLOW_WINDOW = 4 * 1024 * 1024
+MAX_STREAMED_SIZE = 64 * 1024 * 1024 # Cap on a transfer whose size is only known at its end
+
+# --- Wire Format ---
+# Version 1 frames are Fernet tokens carrying JSON. Version 2 frames are
+# binary: a type byte and a 64-bit sequence number (also the AEAD nonce and
+# associated data) followed by the raw AEAD ciphertext. Fernet tokens always
+# start with b'g', so both kinds can be told apart by their first byte.
+PROTOCOL_VERSIONS = (1, 2)
+FRAME_JSON = 0x01   # UTF-8 JSON message
+FRAME_CHUNK = 0x02  # Raw file chunk: transfer id, offset, data
+AEAD_HEADER = struct.Struct('>BQ')
+CHUNK_HEADER = struct.Struct('>16sQ')
+AEAD_CIPHERS = {
+    'aesgcm': AESGCM,
+    'chacha20': ChaCha20Poly1305,
+}
+
+# --- Compression ---
+# The low nibble of a version 2 type byte is the frame type, the high nibble
+# says how the payload was compressed before encryption.
+FRAME_TYPE_MASK = 0x0F
+COMPRESSION_FLAGS = {'zstd': 0x20, 'zlib': 0x10}
+MIN_COMPRESS_SIZE = 256                  # Smaller payloads are not worth it
+MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024 # Guard against decompression bombs
+ZLIB_LEVEL = 3
+ZSTD_LEVEL = 3
+INCOMPRESSIBLE_EXTENSIONS = (
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.ogg', '.opus', '.m4a', '.aac',
+    '.mp4', '.mkv', '.mov', '.avi', '.webm', '.zip', '.gz', '.tgz', '.bz2', '.xz',
+    '.7z', '.rar', '.zst', '.docx', '.xlsx', '.pptx', '.apk', '.jar'
+)
+
+def supported_compression():
+    """Compression algorithms we can use, most preferred first."""
+    return [name for name in COMPRESSION_FLAGS if name != 'zstd' or zstandard]
+
+def decompress_payload(data, flag) -> bytes:
+    if flag == COMPRESSION_FLAGS['zlib']:
+        decompressor = zlib.decompressobj()
+        out = decompressor.decompress(data, MAX_DECOMPRESSED_SIZE)
+        if decompressor.unconsumed_tail:
+            raise ValueError("Compressed frame is too large")
+        return out
+    if flag == COMPRESSION_FLAGS['zstd'] and zstandard:
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=MAX_DECOMPRESSED_SIZE)
+    raise ValueError(f"Unsupported compression flag {flag:#x}")
+
+class FrameCompressor:
+    """Compresses outgoing frame payloads for one connection when it pays off.
+
+    Each stream (JSON messages, or one file transfer) is tracked on its own.
+    When a payload shrinks by less than 10%, the stream sends the next
+    frames uncompressed, doubling the gap up to 64 frames before sampling
+    again. Already-compressed data like JPEGs or Opus voice notes therefore
+    costs almost nothing. Safe to call from several CryptoPipeline workers.
+    """
+    def __init__(self, algorithm):
+        self.algorithm = algorithm
+        self.flag = COMPRESSION_FLAGS[algorithm]
+        self.lock = threading.Lock()
+        self.local = threading.local() # zstd compressor objects are not thread-safe
+        self.streams = {} # stream -> [frames left to skip, current gap]
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _compress(self, data) -> bytes:
+        if self.algorithm == 'zlib':
+            return zlib.compress(data, ZLIB_LEVEL)
+        if not hasattr(self.local, 'zstd'):
+            self.local.zstd = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        return self.local.zstd.compress(data)
+
+    def compress(self, data, stream) -> (bytes, int):
+        """Returns (payload, compression flag); the flag is 0 if data was left as is."""
+        with self.lock:
+            self.bytes_in += len(data)
+            state = self.streams.setdefault(stream, [0, 1]) if len(data) >= MIN_COMPRESS_SIZE else None
+            if state is None or state[0] > 0:
+                if state:
+                    state[0] -= 1
+                self.bytes_out += len(data)
+                return data, 0
+
+        packed = self._compress(data)
+        with self.lock:
+            if len(packed) > len(data) * 0.9:
+                state[1] = min(state[1] * 2, 64)
+                state[0] = state[1]
+                self.bytes_out += len(data)
+                return data, 0
+            state[1] = 1
+            self.bytes_out += len(packed)
+        return packed, self.flag
+
+    def forget(self, stream):
+        with self.lock:
+            self.streams.pop(stream, None)
+
+def derive_frame_key(master_key: bytes, sender_nonce: bytes, receiver_nonce: bytes, cipher_name: str) -> bytes:
+    """Derives the AEAD key for frames travelling from one peer to the other."""
+    hkdf = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=sender_nonce + receiver_nonce,
+        info=b"p2p-messenger frames " + cipher_name.encode(),
+    )
+    return hkdf.derive(master_key)
+
+class FrameCipher:
+    """Seals or opens the binary frames of one direction of a session."""
+    def __init__(self, cipher_name, key):
+        self.aead = AEAD_CIPHERS[cipher_name](key)
+        self.seq = 0
+
+    def _nonce(self, header):
+        # 4 zero bytes followed by the sequence number; keys are unique per direction
+        return b'\x00\x00\x00\x00' + header[1:]
+
+    def reserve(self) -> int:
+        """Hands out the next sequence number, for sealing or opening it on another thread."""
+        seq = self.seq
+        self.seq += 1
+        return seq
+
+    def seal(self, frame_type, data, seq=None) -> bytes:
+        if seq is None:
+            seq = self.reserve()
+        header = AEAD_HEADER.pack(frame_type, seq)
+        return header + self.aead.encrypt(self._nonce(header), data, header)
+
+    def open(self, frame, seq=None) -> (int, bytes):
+        """Opens the frame expected at seq (by default the next one in order)."""
+        frame_type, frame_seq = AEAD_HEADER.unpack_from(frame)
+        if frame_seq != (self.seq if seq is None else seq):
+            raise InvalidTag()
+        header = bytes(frame[:AEAD_HEADER.size])
+        data = self.aead.decrypt(self._nonce(header), frame[AEAD_HEADER.size:], header)
+        if seq is None:
+            self.seq += 1
+        return frame_type, data
+
+# --- Crypto Pipeline ---
+# The AEAD ciphers and zlib/zstd release the GIL, so on multi-core machines
+# frames can be sealed and opened in parallel. Sequence numbers are handed
+# out in wire order before a frame goes to the pool, and the results are
+# written or dispatched in that same order.
+CRYPTO_WORKERS = min(8, os.cpu_count() or 1)
+# Jobs queued per worker. Frames already handed to the send pipeline are past
+# the SendScheduler, so anything deeper only delays the next chat message.
+CRYPTO_QUEUE_PER_WORKER = 1
+
+class CryptoPipeline:
+    """Runs frame crypto jobs on a thread pool and delivers results in submission order.
+
+    One producer submits jobs in wire order; they may finish in any order, and
+    a single consumer thread passes each result to deliver(), which returns
+    False to stop. Exceptions from a job or from deliver go to on_error(e),
+    which returns True to carry on. At most CRYPTO_QUEUE_PER_WORKER jobs per
+    worker are queued, which blocks the producer and bounds memory use.
+    """
+    def __init__(self, workers, deliver, on_error, name='crypto'):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.jobs = queue.Queue(maxsize=CRYPTO_QUEUE_PER_WORKER * workers)
+        self.deliver = deliver
+        self.on_error = on_error
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, func, *args):
+        future = self.pool.submit(func, *args)
+        while self.running:
+            try:
+                self.jobs.put(future, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+        future.cancel()
+        raise BrokenPipeError("Crypto pipeline is closed")
+
+    def _run(self):
+        while self.running:
+            future = self.jobs.get()
+            if future is None:
+                break
+            try:
+                keep_going = self.deliver(future.result()) is not False
+            except Exception as e:
+                keep_going = self.on_error(e)
+            if not keep_going:
+                break
+        self.running = False
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def close(self, timeout=0):
+        """Stops the pipeline, first waiting up to timeout seconds (None for no limit)
+        for the jobs already submitted to be delivered."""
+        if timeout != 0 and self.running and threading.current_thread() is not self.thread:
+            try:
+                self.jobs.put(None, timeout=timeout)
+                self.thread.join(timeout)
+            except queue.Full:
+                pass
+        self.running = False
+        try:
+            self.jobs.put_nowait(None)
+        except queue.Full:
+            pass
+
+# --- Send Scheduling ---
+# Outgoing frames are queued by class so a bulk transfer never holds up chat
+# messages or call signalling for more than one chunk.
+PRIORITY_CONTROL = 0   # Handshake, call signalling and transfer control
+PRIORITY_TEXT = 1      # Chat messages
+PRIORITY_VOICE = 2     # Voice note transfers
+PRIORITY_BULK = 3      # Every other file transfer
+PRIORITY_WEIGHTS = {PRIORITY_VOICE: 4, PRIORITY_BULK: 1} # Chunks per round between transfer classes
+STREAM_QUEUE_DEPTH = 8 # Chunks a transfer may queue before its sender blocks
+SEND_LOWAT = 128 * 1024 # Unsent bytes the kernel may hold, see configure_socket
+KEEPALIVE_IDLE = 10     # Seconds of silence before the first keepalive probe
+KEEPALIVE_INTERVAL = 5  # Seconds between unanswered probes
+KEEPALIVE_COUNT = 3     # Unanswered probes before the connection is dropped
+UNACKED_TIMEOUT_MS = 30000 # Sent data unacknowledged this long drops the connection (Linux)
+
+def transfer_priority(kind):
+    return PRIORITY_VOICE if kind == 'audio' else PRIORITY_BULK
+
+def configure_socket(sock):
+    """Tunes a connected TCP socket for interactive frames sharing the link with bulk data.
+
+    Frames are written whole, so Nagle's algorithm only adds delay, and
+    keeping little unsent data in the kernel lets a new chat message
+    overtake a transfer instead of queueing behind megabytes of it.
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if hasattr(socket, 'TCP_NOTSENT_LOWAT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, SEND_LOWAT)
+    # Notice a peer that vanished with the network in seconds rather than the OS default of hours
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (('TCP_KEEPIDLE', KEEPALIVE_IDLE), ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL),
+                          ('TCP_KEEPCNT', KEEPALIVE_COUNT), ('TCP_USER_TIMEOUT', UNACKED_TIMEOUT_MS)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+class SendScheduler:
+    """Orders the outgoing frames of one connection by priority class.
+
+    Control and text frames always go first, in the order they were queued.
+    Transfers queue their frames per stream: the voice and bulk classes share
+    the link by PRIORITY_WEIGHTS and streams within a class take turns, while
+    each stream stays in order. A stream with STREAM_QUEUE_DEPTH frames
+    waiting blocks its producer. One thread passes frames to write(*item);
+    if that raises before close(), on_error(e) is called and the scheduler stops.
+    """
+    def __init__(self, write, on_error):
+        self.write = write
+        self.on_error = on_error
+        self.cond = threading.Condition()
+        self.classes = {priority: OrderedDict() for priority in
+                        (PRIORITY_CONTROL, PRIORITY_TEXT, PRIORITY_VOICE, PRIORITY_BULK)}
+        self.credits = dict(PRIORITY_WEIGHTS)
+        self.busy = False
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='send', daemon=True)
+        self.thread.start()
+
+    def put(self, item, priority, stream):
+        with self.cond:
+            streams = self.classes[priority]
+            while True:
+                if not self.running:
+                    raise BrokenPipeError("Connection is closed")
+                frames = streams.setdefault(stream, deque())
+                if priority < PRIORITY_VOICE or len(frames) < STREAM_QUEUE_DEPTH:
+                    break
+                self.cond.wait()
+            frames.append(item)
+            self.cond.notify_all()
+
+    def _pop(self, priority):
+        """Takes the next frame of a class, rotating between its streams."""
+        streams = self.classes[priority]
+        while streams:
+            stream, frames = next(iter(streams.items()))
+            if not frames:
+                del streams[stream]
+                continue
+            item = frames.popleft()
+            streams.move_to_end(stream)
+            return item
+        return None
+
+    def _next(self):
+        for priority in (PRIORITY_CONTROL, PRIORITY_TEXT):
+            item = self._pop(priority)
+            if item:
+                return item
+        # Weighted round robin between the transfer classes
+        for _ in range(2):
+            for priority, credit in self.credits.items():
+                if credit > 0:
+                    item = self._pop(priority)
+                    if item:
+                        self.credits[priority] -= 1
+                        return item
+            self.credits = dict(PRIORITY_WEIGHTS)
+        return None
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+                item = self._next()
+                while item is None and self.running:
+                    self.cond.wait()
+                    item = self._next()
+                if item is None:
+                    break
+                self.busy = True
+            try:
+                self.write(*item)
+            except Exception as e:
+                if self.running: # After close the error belongs to a connection already torn down
+                    self.on_error(e)
+                break
+        with self.cond:
+            self.running = False
+            self.busy = False
+            self.cond.notify_all()
+
+    def pending(self) -> int:
+        """Number of frames waiting to be sent."""
+        with self.cond:
+            return sum(len(frames) for streams in self.classes.values() for frames in streams.values())
+
+    def close(self, timeout=0):
+        """Stops sending, first waiting up to timeout seconds (None for no limit)
+        for the frames already queued to be written."""
+        with self.cond:
+            if timeout != 0 and threading.current_thread() is not self.thread:
+                self.cond.wait_for(lambda: not self.running or (not self.busy and not any(
+                    frames for streams in self.classes.values() for frames in streams.values())), timeout)
+            self.running = False
+            self.cond.notify_all()
+
+# --- Voice Codecs ---
+class VoiceCodec:
+    """Converts between 16-bit mono PCM frames and voice packet payloads.
+
+    The base class sends raw PCM. Each codec fixes the sample rate and the
+    number of samples per packet it wants the audio stream opened with.
+    """
+    name = 'pcm'
+    rate = 22050
+    frame_size = 1024
+
+    def encode(self, pcm: bytes) -> bytes:
+        return pcm
+
+    def decode(self, data: bytes) -> bytes:
+        return data
+
+class MuLawCodec(VoiceCodec):
+    """G.711 mu-law: one byte per sample, done with NumPy lookup tables."""
+    name = 'ulaw'
+    BIAS = 0x84
+    CLIP = 32635
+    _encode_table = None
+    _decode_table = None
+
+    def __init__(self):
+        if MuLawCodec._encode_table is None:
+            MuLawCodec._build_tables()
+
+    @classmethod
+    def _build_tables(cls):
+        # Encode every possible int16 sample once, indexed by its uint16 bit pattern
+        samples = np.arange(65536, dtype=np.uint16).view(np.int16).astype(np.int32)
+        sign = np.where(samples < 0, 0x80, 0)
+        magnitude = np.minimum(np.abs(samples), cls.CLIP) + cls.BIAS
+        exponent = np.floor(np.log2(magnitude >> 7)).astype(np.int32)
+        mantissa = (magnitude >> (exponent + 3)) & 0x0F
+        cls._encode_table = (~(sign | (exponent << 4) | mantissa) & 0xFF).astype(np.uint8)
+
+        codes = ~np.arange(256, dtype=np.int32) & 0xFF
+        exponent = (codes >> 4) & 0x07
+        magnitude = (((codes & 0x0F) << 3) + cls.BIAS << exponent) - cls.BIAS
+        cls._decode_table = np.where(codes & 0x80, -magnitude, magnitude).astype('<i2')
+
+    def encode(self, pcm: bytes) -> bytes:
+        return self._encode_table[np.frombuffer(pcm, dtype='<u2')].tobytes()
+
+    def decode(self, data: bytes) -> bytes:
+        return self._decode_table[np.frombuffer(data, dtype=np.uint8)].tobytes()
+
+def clamped_cumsum(start, deltas, lo, hi):
+    """Running sum of deltas from start, clamped to [lo, hi] after every step, as an int64 array.
+
+    The lower bound is applied in one pass with Lindley's recursion; each
+    time the upper bound is hit the sum restarts from hi, which is rare for
+    the ADPCM state this is used on.
+    """
+    deltas = np.asarray(deltas, dtype=np.int64)
+    out = np.empty(len(deltas), dtype=np.int64)
+    pos, value = 0, start
+    while pos < len(deltas):
+        total = np.cumsum(deltas[pos:])
+        run = lo + total - np.minimum(np.minimum.accumulate(total), lo - value)
+        over = np.flatnonzero(run > hi)
+        if not len(over):
+            out[pos:] = run
+            break
+        end = pos + over[0]
+        out[pos:end] = run[:over[0]]
+        out[end] = value = hi
+        pos = end + 1
+    return out
+
+class ImaAdpcmCodec(VoiceCodec):
+    """IMA ADPCM: four bits per sample, using the mono WAV block layout.
+
+    Each block starts with the first sample and the step index, so every
+    packet decodes on its own and a lost packet does not corrupt the next.
+    Decoding is vectorized with NumPy. Encoding stays a loop over samples:
+    each nibble is chosen against the predictor left by the previous ones.
+    """
+    name = 'adpcm'
+    INDEX_TABLE = [-1, -1, -1, -1, 2, 4, 6, 8] * 2
+    INDEX_ARRAY = np.array(INDEX_TABLE, dtype=np.int64)
+    STEP_TABLE = [
+        7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+        50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230,
+        253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963,
+        1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327,
+        3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487,
+        12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794, 32767
+    ]
+    HEADER = struct.Struct('<hBx')
+    STEP_ARRAY = np.array(STEP_TABLE, dtype=np.int64)
+
+    def __init__(self):
+        self.index = 0 # Step index carried from block to block
+
+    @staticmethod
+    def block_samples(block_bytes):
+        """Number of samples held by an encoded block of the given size."""
+        return 2 * (block_bytes - ImaAdpcmCodec.HEADER.size) + 1
+
+    def encode(self, pcm: bytes) -> bytes:
+        samples = np.frombuffer(pcm, dtype='<i2').tolist()
+        if not samples:
+            return b''
+        steps, indexes = self.STEP_TABLE, self.INDEX_TABLE
+        predictor, index = samples[0], self.index
+        nibbles = []
+        for sample in samples[1:]:
+            step = steps[index]
+            diff = sample - predictor
+            nibble = 0
+            if diff < 0:
+                nibble = 8
+                diff = -diff
+            delta = step >> 3
+            if diff >= step:
+                nibble |= 4
+                diff -= step
+                delta += step
+            step >>= 1
+            if diff >= step:
+                nibble |= 2
+                diff -= step
+                delta += step
+            step >>= 1
+            if diff >= step:
+                nibble |= 1
+                delta += step
+            predictor = max(-32768, min(32767, predictor - delta if nibble & 8 else predictor + delta))
+            index = max(0, min(88, index + indexes[nibble]))
+            nibbles.append(nibble)
+
+        header = self.HEADER.pack(samples[0], self.index)
+        self.index = index
+        if len(nibbles) % 2:
+            nibbles.append(0)
+        packed = np.array(nibbles, dtype=np.uint8)
+        return header + (packed[0::2] | (packed[1::2] << 4)).tobytes()
+
+    def decode(self, data: bytes, count=None) -> bytes:
+        """Decodes one block; count trims the padding nibble of odd-sized blocks."""
+        predictor, index = self.HEADER.unpack_from(data)
+        packed = np.frombuffer(data, dtype=np.uint8, offset=self.HEADER.size)
+        nibbles = np.empty(2 * len(packed), dtype=np.uint8)
+        nibbles[0::2] = packed & 0x0F
+        nibbles[1::2] = packed >> 4
+        if count is None:
+            count = self.frame_size
+        nibbles = nibbles[:count - 1].astype(np.int64)
+        # The step index only depends on the nibbles before it
+        indexes = np.empty(len(nibbles), dtype=np.int64)
+        if len(nibbles):
+            indexes[0] = index
+            indexes[1:] = clamped_cumsum(index, self.INDEX_ARRAY[nibbles[:-1]], 0, 88)
+        step = self.STEP_ARRAY[indexes]
+        delta = (step >> 3) + (nibbles >> 2 & 1) * step + (nibbles >> 1 & 1) * (step >> 1) + (nibbles & 1) * (step >> 2)
+        delta[nibbles >= 8] *= -1
+        out = np.empty(len(nibbles) + 1, dtype='<i2')
+        out[0] = predictor
+        out[1:] = clamped_cumsum(predictor, delta, -32768, 32767)
+        return out.tobytes()
+
+class OpusCodec(VoiceCodec):
+    """Opus via opuslib, 20 ms frames at 24 kHz. Only offered when libopus is available."""
+    name = 'opus'
+    rate = 24000
+    frame_size = 480
+
+    def __init__(self):
+        self.encoder = opuslib.Encoder(self.rate, 1, opuslib.APPLICATION_VOIP)
+        self.decoder = opuslib.Decoder(self.rate, 1)
+
+    def encode(self, pcm: bytes) -> bytes:
+        return self.encoder.encode(pcm, self.frame_size)
+
+    def decode(self, data: bytes) -> bytes:
+        return self.decoder.decode(data, self.frame_size)
+
+VOICE_CODECS = {
+    'pcm': VoiceCodec,
+    'ulaw': MuLawCodec,
+    'adpcm': ImaAdpcmCodec,
+}
+if opuslib:
+    VOICE_CODECS['opus'] = OpusCodec
+
+# Most preferred first; the callee picks the first one it also supports
+VOICE_CODEC_PREFERENCE = ['opus', 'adpcm', 'ulaw', 'pcm']
+
+def supported_voice_codecs():
+    return [name for name in VOICE_CODEC_PREFERENCE if name in VOICE_CODECS]
+
+def negotiate_voice_codec(offered) -> str:
+    """Picks the first codec from the caller's list that we support; 'pcm' for old peers."""
+    for name in offered or []:
+        if name in VOICE_CODECS:
+            return name
+    return 'pcm'
+
+# --- Transfer Ranges ---
+def chunk_ranges(chunks) -> list:
+    """Merges {offset: length} chunks into sorted [start, end) byte ranges."""
+    ranges = []
+    for offset, length in sorted(chunks.items()):
+        if ranges and offset <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], offset + length)
+        else:
+            ranges.append([offset, offset + length])
+    return ranges
+
+def ranges_cover(ranges, offset, length) -> bool:
+    """Checks if [offset, offset + length) lies inside one of the sorted ranges."""
+    i = bisect.bisect_right(ranges, [offset, float('inf')]) - 1
+    return i >= 0 and ranges[i][0] <= offset and offset + length <= ranges[i][1]
+
+def file_sha256(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# --- Content Store ---
+class ContentStore:
+    """Keeps received files by content so a file the peer re-sends needn't travel again.
+
+    Each file is stored once as root/.store/<sha256>; the names shown in
+    root are hard links to it (copies where links are not supported). The
+    index in .store/index.json maps names to hashes and records the size
+    and mtime of each blob, so a blob changed through one of its names is
+    no longer offered as a match. Like any hard link, editing one name in
+    place changes the other names of the same content too.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.blob_dir = os.path.join(root, CONTENT_STORE_DIR)
+        self.index_path = os.path.join(self.blob_dir, "index.json")
+        self.lock = threading.Lock()
+        self.reserved = set() # Destinations handed out to transfers still in progress
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+            self.names, self.blobs = index['names'], index['blobs']
+        except (OSError, ValueError, KeyError):
+            self.names, self.blobs = {}, {}
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest)
+
+    def has(self, digest, size=None) -> bool:
+        """Checks if an intact blob with this hash (and size, if given) is stored."""
+        if not isinstance(digest, str) or len(digest) != 64 or not all(c in '0123456789abcdef' for c in digest):
+            return False
+        with self.lock:
+            meta = self.blobs.get(digest)
+        try:
+            stat = os.stat(self.blob_path(digest))
+        except OSError:
+            return False
+        return meta == [stat.st_size, stat.st_mtime_ns] and (size is None or stat.st_size == size)
+
+    def destination(self, name, digest=None) -> str:
+        """Picks the path a received file will be saved under.
+
+        A name already holding the same content is reused; otherwise a free
+        name is chosen so an existing file is never overwritten.
+        """
+        with self.lock:
+            if digest and self._intact_blob(digest) and self._intact_name(name, digest):
+                return os.path.join(self.root, name)
+            return self._reserve_free_name(name)
+
+    def _reserve_free_name(self, name):
+        stem, ext = os.path.splitext(name)
+        candidate, n = name, 1
+        while os.path.exists(os.path.join(self.root, candidate)) or candidate in self.reserved:
+            candidate = f"{stem} ({n}){ext}"
+            n += 1
+        self.reserved.add(candidate)
+        return os.path.join(self.root, candidate)
+
+    def release(self, path):
+        with self.lock:
+            self.reserved.discard(os.path.basename(path))
+
+    def add(self, part_path, digest, path) -> str:
+        """Moves a verified file into the store and makes it visible at path."""
+        with self.lock:
+            os.makedirs(self.blob_dir, exist_ok=True)
+            if self._intact_blob(digest):
+                os.remove(part_path) # Same content arrived before
+            else:
+                os.replace(part_path, self.blob_path(digest))
+                stat = os.stat(self.blob_path(digest))
+                self.blobs[digest] = [stat.st_size, stat.st_mtime_ns]
+        return self.link(digest, path)
+
+    def link(self, digest, path) -> str:
+        """Makes the stored blob visible at path."""
+        name = os.path.basename(path)
+        with self.lock:
+            self.reserved.discard(name)
+            if not self._intact_name(name, digest):
+                if os.path.exists(path):
+                    # Something else took the name meanwhile; never overwrite it
+                    path = self._reserve_free_name(name)
+                    name = os.path.basename(path)
+                    self.reserved.discard(name)
+                try:
+                    os.link(self.blob_path(digest), path)
+                except OSError:
+                    shutil.copyfile(self.blob_path(digest), path)
+                self.names[name] = digest
+                self._save_index()
+        return path
+
+    def _intact_blob(self, digest):
+        try:
+            stat = os.stat(self.blob_path(digest))
+        except OSError:
+            return False
+        return self.blobs.get(digest) == [stat.st_size, stat.st_mtime_ns]
+
+    def _intact_name(self, name, digest):
+        try:
+            return self.names.get(name) == digest and os.path.samefile(os.path.join(self.root, name), self.blob_path(digest))
+        except OSError:
+            return False
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'names': self.names, 'blobs': self.blobs}, f)
+        os.replace(tmp_path, self.index_path)
+
+_content_stores = {}
+_content_stores_lock = threading.Lock()
+
+def content_store(root) -> ContentStore:
+    """Returns the one ContentStore for a downloads directory, shared by every client using it."""
+    key = os.path.abspath(root)
+    with _content_stores_lock:
+        if key not in _content_stores:
+            _content_stores[key] = ContentStore(root)
+        return _content_stores[key]
+
+# --- Outbox ---
+OUTBOX_DIR = ".outbox"  # Unacknowledged messages per peer, inside downloads_dir
+OUTBOX_LIMIT = 1000     # Messages kept for a peer that stays away; the oldest are dropped beyond it
+ACK_DELAY = 0.2         # Seconds an ack waits so that one covers a burst of messages
+HELLO_TIMEOUT = 3       # Seconds without a hello after which the peer is taken to be one that never sends it
+
+class Outbox:
+    """Sequenced messages to one peer that it has not acknowledged yet, kept on disk.
+
+    Every message gets the next sequence number of this outbox's epoch (a
+    random id, so a peer that remembers an older outbox of ours is not
+    confused by numbers starting over). The peer acknowledges the highest
+    number it has processed and those messages are dropped; whatever is
+    left is replayed on the next session. The outbox also remembers the
+    peer's epoch and the highest number received from it, which tells the
+    peer where to resume and filters out replayed duplicates.
+
+    Changes are appended to a log of one JSON record per line, so sending,
+    acknowledging or receiving a message writes a line rather than the
+    whole outbox. The log is rewritten as a snapshot once it holds
+    OUTBOX_LIMIT records.
+    """
+    def __init__(self, path, limit=OUTBOX_LIMIT):
+        self.path = path
+        self.limit = limit
+        self.lock = threading.RLock()
+        self.log = None
+        self.records = 0 # Lines in the log after its snapshot
+        self.epoch, self.next_seq, self.pending = uuid.uuid4().hex, 1, []
+        self.peer_epoch, self.peer_seen = None, 0
+        try:
+            with open(path) as f:
+                for line in f:
+                    self._apply(json.loads(line))
+                    self.records += 1
+        except (OSError, ValueError, KeyError, TypeError):
+            pass # A missing log, or a line cut short by a crash; keep what was read
+
+    def _apply(self, record):
+        if 'snapshot' in record:
+            state = record['snapshot']
+            self.epoch, self.next_seq = state['epoch'], state['next_seq']
+            self.pending = [tuple(entry) for entry in state['pending']]
+            self.peer_epoch, self.peer_seen = state['peer_epoch'], state['peer_seen']
+            self.records = -1
+        elif 'add' in record:
+            self.pending.append(tuple(record['add']))
+            self.next_seq = record['add'][0] + 1
+            del self.pending[:-self.limit]
+        elif 'ack' in record:
+            self.pending = [entry for entry in self.pending if entry[0] > record['ack']]
+        elif 'seen' in record:
+            self.peer_epoch, self.peer_seen = record['seen']
+
+    def _write(self, record):
+        """Applies a change and appends it to the log."""
+        self._apply(record)
+        try:
+            if self.records >= self.limit or self.log is None:
+                self._compact()
+            else:
+                self.log.write(json.dumps(record) + "\n")
+                self.log.flush()
+                self.records += 1
+        except OSError as e:
+            print(f"Cannot save outbox, queued messages will not survive a restart: {e}")
+
+    def _compact(self):
+        if self.log:
+            self.log.close()
+            self.log = None
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'snapshot': {'epoch': self.epoch, 'next_seq': self.next_seq, 'pending': self.pending,
+                                    'peer_epoch': self.peer_epoch, 'peer_seen': self.peer_seen}}, f)
+            f.write("\n")
+        os.replace(tmp_path, self.path)
+        self.log = open(self.path, 'a')
+        self.records = 0
+
+    def add(self, msg_type, payload) -> int:
+        """Queues a message and returns its sequence number."""
+        with self.lock:
+            seq = self.next_seq
+            if len(self.pending) >= self.limit:
+                print("Outbox full, dropped the oldest undelivered message.")
+            self._write({'add': [seq, msg_type, payload]})
+            return seq
+
+    def ack(self, seq):
+        """Drops every message the peer has processed, up to and including seq."""
+        with self.lock:
+            if self.pending and self.pending[0][0] <= seq:
+                self._write({'ack': seq})
+
+    def take(self) -> list:
+        """Removes and returns every pending message, for a peer that cannot acknowledge them."""
+        with self.lock:
+            pending = self.pending
+            if pending:
+                self._write({'ack': pending[-1][0]})
+            return pending
+
+    def cursor(self) -> dict:
+        """Where the peer's messages should resume from, as sent in our hello."""
+        with self.lock:
+            return {'epoch': self.peer_epoch, 'seq': self.peer_seen}
+
+    def greet(self, peer_epoch):
+        """Starts counting afresh when the peer's outbox is not the one we know."""
+        with self.lock:
+            if peer_epoch != self.peer_epoch:
+                self._write({'seen': [peer_epoch, 0]})
+
+    def receive(self, seq) -> bool:
+        """Records a sequenced message from the peer; returns False for one already processed.
+
+        The number is on disk before the caller shows the message, so a
+        crash may lose it but a replay never shows it twice.
+        """
+        with self.lock:
+            if seq <= self.peer_seen:
+                return False
+            self._write({'seen': [self.peer_epoch, seq]})
+            return True
+
+    def close(self):
+        with self.lock:
+            if self.log:
+                self.log.close()
+                self.log = None
+
+# --- Dialing ---
+CONNECT_TIMEOUT = 10         # Seconds to give all addresses of a peer together
+CONNECT_ATTEMPT_DELAY = 0.25 # Head start of one address before the next is tried too (RFC 8305)
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+
+def interleave_addresses(infos) -> list:
+    """Orders getaddrinfo results so address families alternate, keeping the resolver's preference first."""
+    families = OrderedDict()
+    for info in infos:
+        families.setdefault(info[0], []).append(info)
+    ordered = []
+    queues = list(families.values())
+    while any(queues):
+        for family_infos in queues:
+            if family_infos:
+                ordered.append(family_infos.pop(0))
+    return ordered
+
+def dial(host, port, timeout=CONNECT_TIMEOUT, attempt_delay=CONNECT_ATTEMPT_DELAY) -> socket.socket:
+    """Connects to host over IPv6 or IPv4, whichever answers first (Happy Eyeballs, RFC 8305).
+
+    Every address getaddrinfo returns gets its own non-blocking attempt,
+    started attempt_delay after the previous one or as soon as it fails,
+    and the first to connect wins. Raises TimeoutError once timeout seconds
+    have passed, or the last error if every address failed.
+    """
+    deadline = time.monotonic() + timeout
+    infos = interleave_addresses(socket.getaddrinfo(host, port, type=socket.SOCK_STREAM))
+    selector = selectors.DefaultSelector()
+    attempts = {} # Socket -> address
+    error = None
+    next_start = time.monotonic()
+    try:
+        while infos or attempts:
+            now = time.monotonic()
+            if now >= deadline:
+                raise TimeoutError(f"Timed out connecting to {host}:{port}")
+            if infos and (now >= next_start or not attempts):
+                family, type_, proto, _, address = infos.pop(0)
+                sock = socket.socket(family, type_, proto)
+                sock.setblocking(False)
+                result = sock.connect_ex(address)
+                if result in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, 'WSAEWOULDBLOCK', -1)):
+                    selector.register(sock, selectors.EVENT_WRITE)
+                    attempts[sock] = address
+                else:
+                    error = OSError(result, os.strerror(result))
+                    sock.close()
+                next_start = now + attempt_delay
+                continue
+
+            wake = min(deadline, next_start) if infos else deadline
+            for key, _ in selector.select(max(wake - now, 0)):
+                sock = key.fileobj
+                selector.unregister(sock)
+                attempts.pop(sock)
+                result = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if result == 0:
+                    sock.setblocking(True)
+                    return sock
+                error = OSError(result, os.strerror(result))
+                sock.close()
+                next_start = time.monotonic() # A failure lets the next address start right away
+        raise error or OSError(f"No addresses found for {host}")
+    finally:
+        for sock in attempts:
+            sock.close()
+        selector.close()
+
+def backoff_delays(base=RECONNECT_BASE_DELAY, cap=RECONNECT_MAX_DELAY):
+    """Yields exponentially growing delays with full jitter, so peers that lost a link together do not retry in lockstep."""
+    attempt = 0
+    while True:
+        yield random.uniform(0, min(cap, base * 2 ** attempt))
+        attempt += 1
+
+class ReconnectSupervisor:
+    """Keeps a ChatClient connected, re-establishing the session whenever it drops.
+
+    In 'connect' mode the peer is redialed with backoff_delays between failed
+    attempts; in 'listen' mode the client listens again. The supervisor
+    gives up only when stop() is called or the peer said goodbye.
+    on_retry(attempt, delay) is called before each wait.
+    """
+    def __init__(self, client, mode, host, port, on_retry=None,
+                 base_delay=RECONNECT_BASE_DELAY, max_delay=RECONNECT_MAX_DELAY):
+        self.client = client
+        self.mode = mode
+        self.host = host
+        self.port = port
+        self.on_retry = on_retry
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stopped = threading.Event()
+        self.wake = threading.Event()
+
+    def start(self):
+        self.client.listen_stopped.clear()
+        threading.Thread(target=self._run, name='reconnect', daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+        self.client.stop_listening()
+
+    def retry_now(self):
+        """Cuts the current backoff wait short."""
+        self.wake.set()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            if self.mode == 'listen':
+                result = self.client.listen(self.host, self.port)
+                if isinstance(result, Future):
+                    result.result() # The asyncio client only starts its server here
+            else:
+                self._dial()
+            # Sync listen() returns connected; the others may still be waiting for a peer
+            while not self.client.connection_up.wait(0.5):
+                if self.stopped.is_set():
+                    return
+            self.client.disconnected.wait()
+            if self.client.session_ended:
+                return
+
+    def _dial(self):
+        delays = backoff_delays(self.base_delay, self.max_delay)
+        attempt = 0
+        while not self.stopped.is_set():
+            result = self.client.connect(self.host, self.port)
+            if isinstance(result, Future):
+                result.result() # The asyncio client connects on its loop
+            if self.client.is_connected:
+                return
+            attempt += 1
+            delay = next(delays)
+            if self.on_retry:
+                self.on_retry(attempt, delay)
+            self.wake.clear()
+            self.wake.wait(delay)
+
 # --- Networking and Logic ---
+class FrameReader:
+    """Reads length-prefixed frames from a socket into one reusable buffer.
+
+    Frames are received with recv_into straight into a preallocated bytearray
+    that only grows when a larger frame arrives, so no per-packet copies are
+    made before decryption.
+    """
+    def __init__(self, sock, initial_size=FILE_CHUNK_SIZE + 1024):
+        self.sock = sock
+        self.header = bytearray(4)
+        self.buffer = bytearray(initial_size)
+        self.view = memoryview(self.buffer)
+
+    def _recv_exactly(self, view) -> bool:
+        """Fills the whole view, returning False if the peer closed the connection."""
+        received = 0
+        while received < len(view):
+            n = self.sock.recv_into(view[received:])
+            if n == 0:
+                return False
+            received += n
+        return True
+
+    def read_frame(self):
+        """Returns the next frame as a memoryview, or None on EOF.
+
+        The view points into the shared buffer and is only valid until the
+        next call.
+        """
+        if not self._recv_exactly(memoryview(self.header)):
+            return None
+        size = int.from_bytes(self.header, 'big')
+        if size > len(self.buffer):
+            self.view.release()
+            self.buffer = bytearray(max(size, 2 * len(self.buffer)))
+            self.view = memoryview(self.buffer)
+        frame = self.view[:size]
+        if not self._recv_exactly(frame):
+            return None
+        return frame
+
+# --- Voice Jitter Buffer ---
+# Voice protocol 1 sends bare codec payloads. Version 2 prefixes every packet
+# with a sequence number and the capture timestamp in samples (as RTP does).
+# Version 3 replaces the Fernet token around each packet with MediaCipher.
+VOICE_PROTOCOL_VERSION = 3
+VOICE_HEADER = struct.Struct('>II')
+
+def seq_diff(a, b):
+    """Signed distance between two 32-bit sequence numbers, allowing for wrap-around."""
+    return ((a - b + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+
+def derive_media_key(master_key: bytes, sender_nonce: bytes, receiver_nonce: bytes) -> bytes:
+    """Derives the key for one direction of a call from the session key and both call nonces."""
+    hkdf = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=sender_nonce + receiver_nonce,
+        info=b"p2p-messenger voice",
+    )
+    return hkdf.derive(master_key)
+
+class MediaCipher:
+    """SRTP-style protection for voice packets.
+
+    A packet is a 9-byte header (type, sequence number, timestamp) followed
+    by the AES-GCM ciphertext of the codec payload, with the header as
+    associated data and the sequence number as the nonce. Keys are fresh for
+    every call and direction. Received sequence numbers go through a 64-packet
+    sliding window, so replays are rejected before any decryption work.
+    """
+    HEADER = struct.Struct('>BII')
+    PACKET_TYPE = 0x03
+    WINDOW = 64
+
+    def __init__(self, send_key, recv_key):
+        self.send_aead = AESGCM(send_key)
+        self.recv_aead = AESGCM(recv_key)
+        self.highest = None
+        self.window = 0 # Bit n set: highest - n already received
+        self.replayed = 0
+
+    @staticmethod
+    def _nonce(seq):
+        return bytes(8) + seq.to_bytes(4, 'big')
+
+    def protect(self, seq, timestamp, payload) -> bytes:
+        header = self.HEADER.pack(self.PACKET_TYPE, seq, timestamp)
+        return header + self.send_aead.encrypt(self._nonce(seq), payload, header)
+
+    def unprotect(self, packet) -> (int, int, bytes):
+        """Authenticates and decrypts a packet; raises InvalidTag for forged or replayed ones."""
+        packet_type, seq, timestamp = self.HEADER.unpack_from(packet)
+        if packet_type != self.PACKET_TYPE:
+            raise InvalidTag()
+        offset = 0 if self.highest is None else seq_diff(self.highest, seq)
+        if offset >= self.WINDOW or (offset >= 0 and self.highest is not None and self.window >> offset & 1):
+            self.replayed += 1
+            raise InvalidTag()
+
+        header = bytes(packet[:self.HEADER.size])
+        payload = self.recv_aead.decrypt(self._nonce(seq), packet[self.HEADER.size:], header)
+
+        # Only authenticated packets move the window
+        if self.highest is None:
+            self.highest, self.window = seq, 1
+        elif offset < 0:
+            self.window = (self.window << -offset | 1) & ((1 << self.WINDOW) - 1)
+            self.highest = seq
+        else:
+            self.window |= 1 << offset
+        return seq, timestamp, payload
+
+class JitterBuffer:
+    """Reorders voice packets and hands them to playback at a steady pace.
+
+    Packets are held until the buffer reaches a target depth that follows the
+    measured interarrival jitter (the RFC 3550 estimator), so a calm link
+    gets minimal latency and a jittery one gets just enough headroom. Late
+    and duplicate packets are dropped. A missing packet is reported as None so
+    the caller can conceal it.
+    """
+    def __init__(self, rate, frame_size, max_delay=0.4):
+        self.rate = rate
+        self.frame_duration = frame_size / rate
+        self.max_depth = max(2, int(max_delay / self.frame_duration))
+        self.lock = threading.Lock()
+        self.packets = {}
+        self.next_seq = None
+        self.buffering = True
+        self.jitter = 0.0
+        self.last_transit = None
+        self.stats = {'received': 0, 'late': 0, 'duplicate': 0, 'lost': 0, 'dropped': 0, 'underruns': 0}
+
+    def target_depth(self):
+        """Frames to hold before playing: one frame plus four times the jitter."""
+        depth = 1 + int(4 * self.jitter / self.frame_duration + 0.5)
+        return min(depth, self.max_depth)
+
+    def put(self, seq, timestamp, payload, arrival=None):
+        arrival = time.monotonic() if arrival is None else arrival
+        with self.lock:
+            self.stats['received'] += 1
+            if timestamp is not None:
+                transit = arrival - timestamp / self.rate
+                if self.last_transit is not None:
+                    self.jitter += (abs(transit - self.last_transit) - self.jitter) / 16
+                self.last_transit = transit
+
+            if self.next_seq is not None and seq_diff(seq, self.next_seq) < 0:
+                self.stats['late'] += 1
+                return
+            if seq in self.packets:
+                self.stats['duplicate'] += 1
+                return
+            self.packets[seq] = payload
+
+            if len(self.packets) > self.max_depth:
+                # Far behind the sender; skip ahead rather than grow the delay
+                oldest = min(self.packets, key=lambda k: seq_diff(k, seq))
+                del self.packets[oldest]
+                self.stats['dropped'] += 1
+                self.next_seq = None
+
+    def get(self):
+        """Returns (payload, playing) for the next playout slot.
+
+        payload is None when there is nothing to play: either the buffer is
+        still filling (playing is False, play silence) or the expected packet
+        was lost (playing is True, conceal it).
+        """
+        with self.lock:
+            if self.buffering:
+                if len(self.packets) < self.target_depth():
+                    return None, False
+                self.buffering = False
+            if not self.packets:
+                # Ran dry: refill to the target depth before playing again
+                self.stats['underruns'] += 1
+                self.buffering = True
+                return None, False
+
+            if self.next_seq is None:
+                self.next_seq = min(self.packets, key=lambda k: seq_diff(k, next(iter(self.packets))))
+            elif len(self.packets) > self.target_depth() + 2 and self.next_seq not in self.packets:
+                # Latency has crept up; skip the gap instead of concealing it
+                self.next_seq = min(self.packets, key=lambda k: seq_diff(k, self.next_seq))
+
+            payload = self.packets.pop(self.next_seq, None)
+            if payload is None:
+                self.stats['lost'] += 1
+            self.next_seq = (self.next_seq + 1) & 0xFFFFFFFF
+            return payload, True
+
+# --- Audio Backends ---
+# All audio in the app is 16-bit mono PCM. Stream callbacks get PortAudio's
+# status flags and return PortAudio's continue code, whatever the backend.
+SAMPLE_WIDTH = 2
+PA_CONTINUE = 0
+PA_INPUT_OVERFLOW = 0x2
+PA_OUTPUT_UNDERFLOW = 0x4
+
+class AudioBackend(ABC):
+    """Opens 16-bit audio streams for calls and recordings.
+
+    Streams follow PyAudio's interface: blocking read/write, or a
+    stream_callback(in_data, frame_count, time_info, status) returning
+    (out_data, flag), plus stop_stream, close and is_active.
+    """
+    @abstractmethod
+    def open(self, rate, channels=1, input=False, output=False, frames_per_buffer=1024, stream_callback=None):
+        pass
+
+    def terminate(self):
+        pass
+
+class PyAudioBackend(AudioBackend):
+    """Real sound hardware through PyAudio/PortAudio."""
+    def __init__(self):
+        if pyaudio is None:
+            raise RuntimeError("PyAudio is not installed; use SyntheticAudioBackend on machines without sound hardware.")
+        self.p = pyaudio.PyAudio()
+
+    def open(self, rate, channels=1, input=False, output=False, frames_per_buffer=1024, stream_callback=None):
+        return self.p.open(format=pyaudio.paInt16,
+                           channels=channels,
+                           rate=rate,
+                           input=input,
+                           output=output,
+                           frames_per_buffer=frames_per_buffer,
+                           stream_callback=stream_callback)
+
+    def terminate(self):
+        self.p.terminate()
+
+class ToneSource:
+    """Sine tone generator for SyntheticAudioBackend."""
+    def __init__(self, frequency=440.0, amplitude=0.3):
+        self.frequency = frequency
+        self.amplitude = amplitude
+        self.position = 0
+
+    def read(self, n, rate):
+        t = (self.position + np.arange(n)) / rate
+        self.position += n
+        return (np.sin(2 * np.pi * self.frequency * t) * self.amplitude * 32767).astype('<i2')
+
+class NoiseSource:
+    """White noise generator for SyntheticAudioBackend."""
+    def __init__(self, amplitude=0.1, seed=None):
+        self.amplitude = amplitude
+        self.rng = np.random.default_rng(seed)
+
+    def read(self, n, rate):
+        return (self.rng.uniform(-1, 1, n) * self.amplitude * 32767).astype('<i2')
+
+class WavFileSource:
+    """Plays a WAV file (mixed down to mono, resampled to the stream rate), looping by default."""
+    def __init__(self, path, loop=True):
+        with wave.open(path, 'rb') as wf:
+            self.file_rate = wf.getframerate()
+            channels = wf.getnchannels()
+            samples = np.frombuffer(wf.readframes(wf.getnframes()), dtype='<i2')
+        self.samples = samples.reshape(-1, channels).mean(axis=1).astype('<i2')
+        self.loop = loop
+        self.resampled = {}
+        self.position = 0
+
+    def _at_rate(self, rate):
+        if rate not in self.resampled:
+            if rate == self.file_rate:
+                self.resampled[rate] = self.samples
+            else:
+                count = int(len(self.samples) * rate / self.file_rate)
+                x = np.linspace(0, len(self.samples) - 1, count)
+                self.resampled[rate] = np.interp(x, np.arange(len(self.samples)), self.samples).astype('<i2')
+        return self.resampled[rate]
+
+    def read(self, n, rate):
+        samples = self._at_rate(rate)
+        out = np.zeros(n, dtype='<i2')
+        filled = 0
+        while filled < n and len(samples):
+            if self.position >= len(samples):
+                if not self.loop:
+                    break
+                self.position = 0
+            take = min(n - filled, len(samples) - self.position)
+            out[filled:filled + take] = samples[self.position:self.position + take]
+            filled += take
+            self.position += take
+        return out
+
+class CaptureSink:
+    """Collects everything a synthetic stream plays, optionally saving it as a WAV."""
+    def __init__(self, keep=True):
+        self.keep = keep
+        self.chunks = []
+        self.total_samples = 0
+        self.rate = None
+
+    def write(self, samples, rate):
+        self.rate = rate
+        self.total_samples += len(samples)
+        if self.keep:
+            self.chunks.append(np.array(samples, dtype='<i2'))
+
+    def samples(self):
+        return np.concatenate(self.chunks) if self.chunks else np.zeros(0, dtype='<i2')
+
+    def save(self, path):
+        with wave.open(path, 'wb') as wf:
+            wf.setnchannels(1)
+            wf.setsampwidth(SAMPLE_WIDTH)
+            wf.setframerate(self.rate or 22050)
+            wf.writeframes(self.samples().tobytes())
+
+class SyntheticStream:
+    """A stream with PyAudio's interface that runs against a generator and a sink instead of a device."""
+    def __init__(self, backend, rate, channels, input, output, frames_per_buffer, stream_callback):
+        self.backend = backend
+        self.rate = rate
+        self.input = input
+        self.output = output
+        self.frames_per_buffer = frames_per_buffer
+        self.stream_callback = stream_callback
+        self.source = backend.source_factory()
+        self.sink = backend.sink_factory()
+        backend.sinks.append(self.sink)
+        self.active = True
+        self.next_time = time.monotonic()
+        if stream_callback:
+            threading.Thread(target=self._callback_loop, daemon=True).start()
+
+    def _pace(self, frames):
+        """Sleeps until the next buffer is due on the synthetic clock."""
+        if not self.backend.realtime:
+            return
+        self.next_time += frames / (self.rate * self.backend.speed)
+        delay = self.next_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            self.next_time = time.monotonic() # Fell behind; don't try to catch up
+
+    def _callback_loop(self):
+        while self.active:
+            self._pace(self.frames_per_buffer)
+            in_data = self.source.read(self.frames_per_buffer, self.rate).tobytes() if self.input else None
+            out_data, flag = self.stream_callback(in_data, self.frames_per_buffer, {}, 0)
+            if self.output and out_data:
+                self.sink.write(np.frombuffer(out_data, dtype='<i2'), self.rate)
+            if flag != PA_CONTINUE:
+                self.active = False
+
+    def read(self, frames, exception_on_overflow=True):
+        if not self.active:
+            raise IOError("Stream closed")
+        self._pace(frames)
+        return self.source.read(frames, self.rate).tobytes()
+
+    def write(self, data):
+        samples = np.frombuffer(data, dtype='<i2')
+        self._pace(len(samples))
+        self.sink.write(samples, self.rate)
+
+    def is_active(self):
+        return self.active
+
+    def start_stream(self):
+        if not self.active:
+            self.active = True
+            self.next_time = time.monotonic()
+            if self.stream_callback:
+                threading.Thread(target=self._callback_loop, daemon=True).start()
+
+    def stop_stream(self):
+        self.active = False
+
+    def close(self):
+        self.active = False
+
+class SyntheticAudioBackend(AudioBackend):
+    """Audio without sound hardware, for headless servers, CI and load tests.
+
+    Input comes from source_factory() (a tone by default) and output is
+    collected by sink_factory() (a CaptureSink); every opened stream gets its
+    own. With realtime=False streams run as fast as the CPU allows, otherwise
+    at speed times real time.
+    """
+    def __init__(self, source_factory=ToneSource, sink_factory=CaptureSink, realtime=True, speed=1.0):
+        self.source_factory = source_factory
+        self.sink_factory = sink_factory
+        self.realtime = realtime
+        self.speed = speed
+        self.sinks = []
+
+    def open(self, rate, channels=1, input=False, output=False, frames_per_buffer=1024, stream_callback=None):
+        return SyntheticStream(self, rate, channels, input, output, frames_per_buffer, stream_callback)
+
+def default_audio_backend():
+    return PyAudioBackend()
+
+# --- Audio Ring Buffers ---
+class AudioRingBuffer:
+    """Single-producer, single-consumer ring of 16-bit samples.
+
+    The producer only advances write_pos and the consumer only advances
+    read_pos, so the audio callback can use it without taking a lock.
+    Each side also counts its own failures: overflows for writes that did
+    not fit, underruns for reads that came up short.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = np.zeros(capacity, dtype='<i2')
+        self.write_pos = 0 # Total samples ever written
+        self.read_pos = 0  # Total samples ever read
+        self.overflows = 0
+        self.underruns = 0
+
+    def available(self):
+        return self.write_pos - self.read_pos
+
+    def free(self):
+        return self.capacity - self.available()
+
+    def write(self, samples) -> bool:
+        """Appends all samples, or none of them (counting an overflow) if they don't fit."""
+        n = len(samples)
+        if n > self.free():
+            self.overflows += 1
+            return False
+        start = self.write_pos % self.capacity
+        first = min(n, self.capacity - start)
+        self.data[start:start + first] = samples[:first]
+        self.data[:n - first] = samples[first:]
+        self.write_pos += n
+        return True
+
+    def read_into(self, out) -> int:
+        """Fills out with up to len(out) samples and returns how many were read."""
+        n = min(len(out), self.available())
+        if n < len(out):
+            self.underruns += 1
+        start = self.read_pos % self.capacity
+        first = min(n, self.capacity - start)
+        out[:first] = self.data[start:start + first]
+        out[first:n] = self.data[:n - first]
+        self.read_pos += n
+        return n
+
 class VoiceCallManager:
-    def __init__(self, f_obj, peer_ip, peer_port, my_socket):
+    RING_FRAMES = 8     # Capacity of each ring buffer, in codec frames
+    PLAYBACK_FRAMES = 2 # Decoded frames kept queued ahead of the speaker
+
+    def __init__(self, f_obj, peer_ip, peer_port, my_socket, codec_name='pcm', voice_version=1, media_keys=None,
+                 audio_backend=None):
         self.f_obj = f_obj
+        # Version 3 calls protect packets with per-call keys instead of Fernet
+        self.media_cipher = MediaCipher(*media_keys) if voice_version >= 3 else None
         self.peer_ip = peer_ip
         self.peer_port = peer_port
         self.receive_socket = my_socket
         self.my_port = my_socket.getsockname()[1]
         self.is_running = False
-        self.p_audio = pyaudio.PyAudio()
-        self.CHUNK = 1024
-        self.FORMAT = pyaudio.paInt16
+        self.owns_backend = audio_backend is None
+        self.audio_backend = audio_backend or default_audio_backend()
+        self.codec = VOICE_CODECS[codec_name]()
+        self.voice_version = voice_version
+        self.CHUNK = self.codec.frame_size
         self.CHANNELS = 1
-        self.RATE = 22050  # Lower rate for less bandwidth
+        self.RATE = self.codec.rate
         self.send_socket = None
         self.stream = None
+        self.recv_buffer = bytearray(65536) # Largest possible datagram
+        self.jitter_buffer = JitterBuffer(self.RATE, self.CHUNK)
+        self.last_frame = None
+        self.concealed_frames = 0
+
+        # The audio callback moves samples between the device and these rings;
+        # the events wake the encode and decode threads when there is work.
+        self.capture_ring = AudioRingBuffer(self.RING_FRAMES * self.CHUNK)
+        self.playback_ring = AudioRingBuffer(self.RING_FRAMES * self.CHUNK)
+        self.capture_ready = threading.Event()
+        self.playback_wanted = threading.Event()
+        self.device_overflows = 0
+        self.device_underflows = 0
 
     def start(self):
         self.is_running = True
         
-        self.send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.send_socket = socket.socket(self.receive_socket.family, socket.SOCK_DGRAM)
+        if self.send_socket.family == socket.AF_INET6:
+            self.send_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
         # The receive_socket is now passed in, already bound.
+        # A timeout lets the receive thread notice when the call has ended.
+        self.receive_socket.settimeout(0.5)
 
-        self.stream = self.p_audio.open(format=self.FORMAT,
-                                        channels=self.CHANNELS,
-                                        rate=self.RATE,
-                                        input=True,
-                                        output=True,
-                                        frames_per_buffer=self.CHUNK)
+        self.stream = self.audio_backend.open(rate=self.RATE,
+                                              channels=self.CHANNELS,
+                                              input=True,
+                                              output=True,
+                                              frames_per_buffer=self.CHUNK,
+                                              stream_callback=self._audio_callback)
 
         threading.Thread(target=self.receive_thread, daemon=True).start()
+        threading.Thread(target=self.playout_thread, daemon=True).start()
         threading.Thread(target=self.send_thread, daemon=True).start()
 
+    def _audio_callback(self, in_data, frame_count, time_info, status):
+        """Runs on the audio device thread: never blocks, only copies to and from the rings."""
+        if status & PA_INPUT_OVERFLOW:
+            self.device_overflows += 1
+        if status & PA_OUTPUT_UNDERFLOW:
+            self.device_underflows += 1
+
+        if in_data:
+            self.capture_ring.write(np.frombuffer(in_data, dtype='<i2'))
+            self.capture_ready.set()
+
+        out = np.zeros(frame_count, dtype='<i2')
+        self.playback_ring.read_into(out)
+        self.playback_wanted.set()
+        return out.tobytes(), PA_CONTINUE
+
     def stop(self):
         self.is_running = False
         if self.stream:
@@ -63,38 +1630,152 @@ class VoiceCallManager:
             self.stream.close()
         if self.send_socket:
             self.send_socket.close()
+        if self.owns_backend:
+            self.audio_backend.terminate()
+        # Wake the worker threads so they notice the call is over
+        self.capture_ready.set()
+        self.playback_wanted.set()
+
+    def stats(self):
+        """Jitter and audio buffer statistics for the running call.
+
+        Ring fill levels are in samples; divide by RATE for seconds of
+        latency they add.
+        """
+        stats = dict(self.jitter_buffer.stats)
+        stats['jitter'] = self.jitter_buffer.jitter
+        stats['concealed'] = self.concealed_frames
+        stats['capture_fill'] = self.capture_ring.available()
+        stats['playback_fill'] = self.playback_ring.available()
+        stats['capture_overflows'] = self.capture_ring.overflows
+        stats['playback_underruns'] = self.playback_ring.underruns
+        stats['device_overflows'] = self.device_overflows
+        stats['device_underflows'] = self.device_underflows
+        if self.media_cipher:
+            stats['replayed'] = self.media_cipher.replayed
+        return stats
 
     def send_thread(self):
+        seq = 0
+        timestamp = 0
+        frame = np.zeros(self.CHUNK, dtype='<i2')
         while self.is_running:
             try:
-                data = self.stream.read(self.CHUNK, exception_on_overflow=False)
-                encrypted_data = self.f_obj.encrypt(data)
+                if self.capture_ring.available() < self.CHUNK:
+                    self.capture_ready.wait(0.5)
+                    self.capture_ready.clear()
+                    continue
+                self.capture_ring.read_into(frame)
+                packet = self.codec.encode(frame.tobytes())
+                if self.media_cipher:
+                    encrypted_data = self.media_cipher.protect(seq, timestamp, packet)
+                elif self.voice_version >= 2:
+                    encrypted_data = self.f_obj.encrypt(VOICE_HEADER.pack(seq, timestamp) + packet)
+                else:
+                    encrypted_data = self.f_obj.encrypt(packet)
+                seq = (seq + 1) & 0xFFFFFFFF
+                timestamp = (timestamp + self.CHUNK) & 0xFFFFFFFF
                 self.send_socket.sendto(encrypted_data, (self.peer_ip, self.peer_port))
             except Exception:
                 break
 
     def receive_thread(self):
+        arrival_seq = 0
         while self.is_running:
             try:
-                data, addr = self.receive_socket.recvfrom(self.CHUNK + 512)
-                decrypted_data = self.f_obj.decrypt(data)
-                self.stream.write(decrypted_data)
+                size, addr = self.receive_socket.recvfrom_into(self.recv_buffer)
+                if addr[0] != self.peer_ip:
+                    continue
+                data = memoryview(self.recv_buffer)[:size]
+                if self.media_cipher:
+                    seq, timestamp, payload = self.media_cipher.unprotect(data)
+                    self.jitter_buffer.put(seq, timestamp, payload)
+                    continue
+
+                decrypted_data = self.f_obj.decrypt(bytes(data))
+                if self.voice_version >= 2:
+                    seq, timestamp = VOICE_HEADER.unpack_from(decrypted_data)
+                    self.jitter_buffer.put(seq, timestamp, decrypted_data[VOICE_HEADER.size:])
+                else:
+                    # Old peers send no header; play in arrival order
+                    self.jitter_buffer.put(arrival_seq, None, decrypted_data)
+                    arrival_seq += 1
             except Exception:
                 if self.is_running:
                     continue
                 break
 
+    def playout_thread(self):
+        # Keeps PLAYBACK_FRAMES decoded frames queued for the audio callback,
+        # which bounds the playback side's latency to that many frames.
+        silence = bytes(2 * self.CHUNK)
+        target = self.PLAYBACK_FRAMES * self.CHUNK
+        while self.is_running:
+            try:
+                if self.playback_ring.available() >= target:
+                    self.playback_wanted.wait(0.5)
+                    self.playback_wanted.clear()
+                    continue
+                payload, playing = self.jitter_buffer.get()
+                if payload is not None:
+                    frame = self.codec.decode(payload)
+                    self.last_frame = frame
+                    self.concealed_frames = 0
+                elif playing:
+                    frame = self.conceal()
+                else:
+                    frame = silence
+                self.playback_ring.write(np.frombuffer(frame, dtype='<i2'))
+            except Exception:
+                if self.is_running:
+                    continue
+                break
+
+    def conceal(self):
+        """Packet loss concealment: repeat the last frame at fading volume, then go silent."""
+        self.concealed_frames += 1
+        if self.last_frame is None or self.concealed_frames > 3:
+            return bytes(2 * self.CHUNK)
+        faded = np.frombuffer(self.last_frame, dtype='<i2') * (0.5 ** self.concealed_frames)
+        return faded.astype('<i2').tobytes()
+
 class ChatClient:
     def __init__(self, key, **kwargs):
         self.f_obj = Fernet(key)
+        self.master_key = base64.urlsafe_b64decode(key)
         self.sock = None
         self.is_connected = False
         self.pending_conn = None
         self.connection_event = threading.Event()
         self.connection_accepted = False
+        self.listen_socket = None
+        self.listen_stopped = threading.Event() # Set by stop_listening; listen() returns at once until cleared
+        self.connect_timeout = kwargs.get('connect_timeout', CONNECT_TIMEOUT)
+        # Followed by ReconnectSupervisor; session_ended is set when either side leaves on purpose
+        self.connection_up = threading.Event()
+        self.disconnected = threading.Event()
+        self.session_ended = False
         self.voice_call_manager = None
         self.my_pending_udp_socket = None
+        self.incoming_call_offer = None
+        self.call_nonce = None
+        self.audio_backend = kwargs.get('audio_backend')
         self.send_lock = threading.Lock()
+        # Frames are sealed and opened on this many threads once version 2 is up
+        self.crypto_workers = kwargs.get('crypto_workers', CRYPTO_WORKERS)
+        self.send_pipeline = None
+        self.recv_pipeline = None
+        self.scheduler = None
+
+        # Frame format negotiation, see _start_session
+        self.ciphers = kwargs.get('ciphers', ['aesgcm', 'chacha20'])
+        self.compression = kwargs.get('compression', supported_compression())
+        self.wire_version = 1
+        self.session_nonce = None
+        self.send_cipher = None
+        self.recv_cipher = None
+        self.compressor = None
+        self.peer_features = set()
         
         self.on_message_received = kwargs.get('on_message_received')
         self.on_connection_status = kwargs.get('on_connection_status')
@@ -103,16 +1784,176 @@ class ChatClient:
         self.on_connection_request = kwargs.get('on_connection_request')
         self.on_call_request = kwargs.get('on_call_request')
         self.on_call_status = kwargs.get('on_call_status')
+        self.on_transfer_progress = kwargs.get('on_transfer_progress')
+        # on_image_preview(filepath, preview_path, sender) shows an image that is still arriving at filepath
+        self.on_image_preview = kwargs.get('on_image_preview')
+
+        # Streaming file transfers, keyed by transfer id
+        self.outgoing_transfers = {}
+        self.incoming_transfers = {}
+        # Offers of content we already hold, answered without any data
+        self.known_transfers = {}
+        # Re-offer interrupted outgoing transfers once a new session is up
+        self.resume_transfers = kwargs.get('resume_transfers', True)
+        # Text messages wait in an Outbox until the peer acknowledges them, see _open_outbox
+        self.reliable_delivery = kwargs.get('reliable_delivery', True)
+        self._outbox = None
+        self.outbox_mode = None # 'acks' or 'plain' once the peer has sent a hello or HELLO_TIMEOUT passed
+        self.ack_timer = None
+        self.hello_timer = None
+
+        # Sent and received messages are recorded here when a HistoryStore is given
+        self.history = kwargs.get('history')
+        self.history_peer = history_peer_id(self.master_key)
+        # Shared by all clients, hub sessions included, unless one is passed in
+        self.image_transcoder = kwargs.get('image_transcoder') or get_shared_transcoder()
         
         self.downloads_dir = "downloads"
         if not os.path.exists(self.downloads_dir):
             os.makedirs(self.downloads_dir)
 
-    def send_data(self, data: bytes):
-        """Encrypts and sends data with a 4-byte length prefix under a lock."""
+    def send_data(self, data: bytes, frame_type=FRAME_JSON, stream='json', priority=PRIORITY_CONTROL, compress=True):
+        """Queues data to be encrypted and sent with a 4-byte length prefix.
+
+        Frames of one stream (a file transfer, or 'json' for messages) keep
+        their order and are compressed as a group; the send scheduler
+        interleaves streams by priority.
+        """
+        item = (data, frame_type, stream if compress else None)
+        if self.scheduler:
+            self.scheduler.put(item, priority, stream)
+        else:
+            self._send_now(*item)
+
+    def _send_now(self, data, frame_type, stream):
+        """Encrypts and writes one frame under send_lock."""
         with self.send_lock:
+            if self.send_pipeline:
+                # Sealed on a worker; the pipeline writes frames in sequence order
+                seq = self.send_cipher.reserve()
+                self.send_pipeline.submit(self.seal_frame, data, frame_type, stream, seq)
+            else:
+                self.sock.sendall(self.seal_frame(data, frame_type, stream))
+
+    def seal_frame(self, data: bytes, frame_type=FRAME_JSON, stream='json', seq=None) -> bytes:
+        """Compresses and encrypts data into a length-prefixed frame.
+
+        Callers must hold send_lock unless they pass a sequence number
+        reserved under it.
+        """
+        if self.send_cipher:
+            if self.compressor and stream is not None:
+                data, flag = self.compressor.compress(data, stream)
+                frame_type |= flag
+            encrypted_data = self.send_cipher.seal(frame_type, data, seq)
+        elif frame_type == FRAME_JSON:
             encrypted_data = self.f_obj.encrypt(data)
-            self.sock.sendall(len(encrypted_data).to_bytes(4, 'big') + encrypted_data)
+        else:
+            raise ValueError("Binary frames need a negotiated version 2 session")
+        return len(encrypted_data).to_bytes(4, 'big') + encrypted_data
+
+    def open_frame(self, frame, seq=None) -> (int, bytes):
+        """Decrypts a received frame (bytes or memoryview) of either wire version into (type, plaintext).
+
+        seq is the sequence number reserved for a version 2 frame opened out of line.
+        """
+        if frame[:1] == b'g':
+            # Fernet only takes bytes
+            return FRAME_JSON, self.f_obj.decrypt(bytes(frame))
+        if not self.recv_cipher:
+            raise InvalidTag()
+        frame_type, data = self.recv_cipher.open(frame, seq)
+        flag = frame_type & ~FRAME_TYPE_MASK
+        if flag:
+            data = decompress_payload(data, flag)
+        return frame_type & FRAME_TYPE_MASK, data
+
+    def _start_scheduler(self):
+        # Started after the hello went out, which must precede every version 2 frame
+        configure_socket(self.sock)
+        self.scheduler = SendScheduler(self._send_now, self._handle_send_error)
+
+    def _start_session(self):
+        """Announces our supported frame formats right after the TCP connection is up.
+
+        Each side switches its outgoing frames to version 2 as soon as it has
+        seen the peer's hello. Since the hello is the first thing either side
+        sends, the peer always knows the keys before the first binary frame
+        arrives. Peers that never send a hello keep talking Fernet.
+        """
+        self.wire_version = 1
+        self.session_ended = False
+        self.disconnected.clear()
+        self.connection_up.set()
+        if self.send_pipeline:
+            self.send_pipeline.close()
+        self.send_pipeline = None
+        self.send_cipher = None
+        self.recv_cipher = None
+        self.compressor = None
+        self.peer_features = set()
+        self.outbox_mode = None
+        self.session_nonce = os.urandom(16)
+        hello = {
+            'versions': list(PROTOCOL_VERSIONS),
+            'nonce': base64.b64encode(self.session_nonce).decode('ascii'),
+            'ciphers': self.ciphers,
+            'compression': self.compression,
+            'features': ['streaming'] # Accepts transfers whose size is only given by 'file_end'
+        }
+        if self.reliable_delivery:
+            # Acknowledges sequenced messages; 'received' tells the peer what to replay
+            hello['features'].append('acks')
+            hello['outbox'] = {'epoch': self.outbox.epoch, 'received': self.outbox.cursor()}
+        self.send_json('hello', hello)
+        if self.reliable_delivery:
+            self._schedule_hello_timeout()
+
+    def _handle_hello(self, payload):
+        if 2 not in payload.get('versions', []):
+            return
+        peer_nonce = base64.b64decode(payload['nonce'])
+        peer_ciphers = payload.get('ciphers', [])
+        # Each direction uses the receiving side's most preferred cipher
+        send_name = next((c for c in peer_ciphers if c in AEAD_CIPHERS), None)
+        recv_name = next((c for c in self.ciphers if c in peer_ciphers), None)
+        if not send_name or not recv_name:
+            return
+
+        # Compress with the peer's most preferred algorithm that we also have
+        compression = next((c for c in payload.get('compression', []) if c in self.compression), None)
+        self.peer_features = set(payload.get('features', []))
+
+        self.recv_cipher = FrameCipher(recv_name, derive_frame_key(self.master_key, peer_nonce, self.session_nonce, recv_name))
+        with self.send_lock:
+            self.send_cipher = FrameCipher(send_name, derive_frame_key(self.master_key, self.session_nonce, peer_nonce, send_name))
+            self.compressor = FrameCompressor(compression) if compression else None
+            if self.crypto_workers > 1:
+                self.send_pipeline = CryptoPipeline(self.crypto_workers, self._write_sealed,
+                                                    self._handle_send_error, 'send')
+        self.wire_version = 2
+
+        if self.resume_transfers and 'streaming' in self.peer_features:
+            self._resume_outgoing_transfers()
+
+    def _write_sealed(self, frame):
+        self.sock.sendall(frame)
+
+    def _handle_send_error(self, e) -> bool:
+        """Ends the session when the send pipeline fails to write a frame."""
+        if self.is_connected and not isinstance(e, (ConnectionResetError, BrokenPipeError)):
+            print(f"Failed to send frame: {e}")
+        self.handle_disconnect()
+        return False
+
+    def send_json(self, msg_type, payload, stream='json', priority=None, seq=None):
+        """Serializes a typed message to JSON and sends it as one frame, with its outbox sequence number if given."""
+        if priority is None:
+            priority = PRIORITY_TEXT if msg_type == 'text' else PRIORITY_CONTROL
+        message = {'type': msg_type, 'payload': payload}
+        if seq is not None:
+            message['seq'] = seq
+        self.send_data(json.dumps(message).encode('utf-8'), stream=stream, priority=priority)
 
     def encrypt(self, data: bytes) -> bytes:
         return self.f_obj.encrypt(data)
@@ -121,11 +1962,23 @@ class ChatClient:
         return self.f_obj.decrypt(encrypted_data)
 
     def listen(self, host, port):
-        """Listens for an incoming connection."""
-        listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        listen_socket.bind((host, port))
-        listen_socket.listen(1)
+        """Listens for an incoming connection.
+
+        The wildcard addresses '0.0.0.0' and '' listen on IPv6 and IPv4 at
+        once where the system supports dual-stack sockets.
+        """
+        if self.listen_stopped.is_set():
+            return
+        if host in ('0.0.0.0', '') and socket.has_dualstack_ipv6():
+            listen_socket = socket.create_server(('', port), family=socket.AF_INET6, dualstack_ipv6=True)
+        else:
+            listen_socket = socket.create_server((host, port))
+        self.listen_socket = listen_socket
+        if self.listen_stopped.is_set():
+            # stop_listening ran before there was a socket to shut down
+            listen_socket.close()
+            self.listen_socket = None
+            return
         if self.on_connection_status:
             self.on_connection_status(f"Listening on {host}:{port}...", is_connected=False)
         
@@ -134,7 +1987,10 @@ class ChatClient:
             try:
                 conn, addr = listen_socket.accept()
             except OSError:
-                return # Socket has been closed, exit thread
+                break # Shut down by stop_listening
+            if self.listen_stopped.is_set():
+                conn.close()
+                break
 
             self.pending_conn = conn
             self.connection_event.clear()
@@ -144,14 +2000,16 @@ class ChatClient:
                 self.on_connection_request(addr)
             else:
                 # If no UI handler, just accept automatically
-                self.connection_accepted = True
+                self.confirm_connection()
             
             # Wait for the UI to signal accept or reject
             self.connection_event.wait()
 
-            if self.connection_accepted:
+            if self.connection_accepted and not self.listen_stopped.is_set():
                 self.sock = self.pending_conn
                 self.is_connected = True
+                self._start_session()
+                self._start_scheduler()
                 if self.on_connection_status:
                     self.on_connection_status(f"Connected by {addr[0]}:{addr[1]}", is_connected=True)
                 
@@ -162,10 +2020,29 @@ class ChatClient:
                 # Connection was rejected, close the socket and listen for the next one
                 self.pending_conn.close()
                 self.pending_conn = None
-                if self.on_connection_status:
+                if self.on_connection_status and not self.listen_stopped.is_set():
                     self.on_connection_status(f"Connection rejected. Listening again...", is_connected=False)
         
         listen_socket.close()
+        self.listen_socket = None
+
+    def stop_listening(self):
+        """Ends a listen() that is waiting for a peer, without connecting, and keeps later ones from starting.
+
+        Clear listen_stopped to listen with this client again.
+        """
+        self.listen_stopped.set()
+        listen_socket = self.listen_socket
+        if listen_socket:
+            # Closing alone does not wake a thread blocked in accept() on Linux
+            try:
+                listen_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            listen_socket.close()
+        # Turn down a peer still waiting for the user's decision
+        self.connection_accepted = False
+        self.connection_event.set()
 
     def confirm_connection(self):
         """Called by the UI to confirm a pending connection."""
@@ -178,11 +2055,12 @@ class ChatClient:
         self.connection_event.set()
 
     def connect(self, host, port):
-        """Connects to a listening peer."""
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        """Connects to a listening peer, trying all its addresses; see dial()."""
         try:
-            self.sock.connect((host, port))
+            self.sock = dial(host, port, self.connect_timeout)
             self.is_connected = True
+            self._start_session()
+            self._start_scheduler()
             if self.on_connection_status:
                 self.on_connection_status(f"Connected to {host}:{port}", is_connected=True)
             threading.Thread(target=self.receive_loop, daemon=True).start()
@@ -192,152 +2070,922 @@ class ChatClient:
                 self.on_connection_status(f"Connection failed: {e}", is_connected=False)
 
     def receive_loop(self):
-        """Handles receiving messages and files."""
-        while self.is_connected:
-            try:
-                # First, receive the size of the incoming message
-                size_data = self.sock.recv(4)
-                if not size_data:
-                    self.handle_disconnect()
-                    break
-                
-                msg_size = int.from_bytes(size_data, 'big')
-                
-                # Now receive the actual message
-                data = b""
-                while len(data) < msg_size:
-                    packet = self.sock.recv(msg_size - len(data))
-                    if not packet:
+        """Handles receiving messages and files.
+
+        Once version 2 keys are in place and more than one crypto worker is
+        configured, frames are opened on a CryptoPipeline and dispatched in
+        order from its thread while this one keeps reading.
+        """
+        reader = FrameReader(self.sock)
+        pipeline = None
+        try:
+            while self.is_connected:
+                try:
+                    data = reader.read_frame()
+                    if data is None:
+                        if pipeline:
+                            pipeline.close(timeout=None) # Dispatch what already arrived
                         self.handle_disconnect()
+                        break
+                    if pipeline is None and self.recv_cipher and self.crypto_workers > 1:
+                        pipeline = CryptoPipeline(self.crypto_workers, self._dispatch_opened,
+                                                  self._handle_receive_error, 'receive')
+                        self.recv_pipeline = pipeline
+                    if pipeline:
+                        seq = None if data[:1] == b'g' else self.recv_cipher.reserve()
+                        # The reader reuses its buffer, so the worker gets a copy
+                        pipeline.submit(self.open_frame, bytes(data), seq)
+                    elif not self.handle_frame(data):
+                        break
+                except Exception as e:
+                    if not self._handle_receive_error(e):
+                        break
+        finally:
+            if pipeline:
+                pipeline.close()
+                self.recv_pipeline = None
+
+    def handle_frame(self, data) -> bool:
+        """Decrypts and dispatches one received frame.
+
+        Returns False once the session has ended. Shared by every transport.
+        """
+        return self.dispatch_frame(*self.open_frame(data))
+
+    def _dispatch_opened(self, opened) -> bool:
+        return self.dispatch_frame(*opened)
+
+    def dispatch_frame(self, frame_type, decrypted_data) -> bool:
+        """Acts on one decrypted frame; returns False once the session has ended."""
+        if frame_type == FRAME_CHUNK:
+            transfer_id, offset = CHUNK_HEADER.unpack_from(decrypted_data)
+            chunk = memoryview(decrypted_data)[CHUNK_HEADER.size:]
+            self._write_file_chunk(transfer_id.hex(), offset, chunk)
+            return True
+
+        message = json.loads(decrypted_data.decode('utf-8'))
+        msg_type = message['type']
+        payload = message['payload']
+
+        if self.outbox_mode is None and msg_type != 'hello':
+            self._open_outbox({}) # A peer whose first frame is not a hello never sends one
+
+        if msg_type == 'hello':
+            self._handle_hello(payload)
+            self._open_outbox(payload)
+
+        elif msg_type == 'ack':
+            if self.reliable_delivery:
+                self.outbox.ack(payload['seq'])
+
+        elif msg_type == 'text':
+            if not self._first_delivery(message):
+                return True
+            self._record("Peer", 'text', payload)
+            if self.on_message_received:
+                self.on_message_received(payload, "Peer")
+
+        elif msg_type == 'disconnect':
+            self.session_ended = True
+            self.handle_disconnect()
+            return False
+
+        elif msg_type in ['file', 'image', 'audio']:
+            # Legacy single-frame transfer from peers without streaming support
+            filename = payload['name']
+            file_data = base64.b64decode(payload['data'])
+            sha256 = hashlib.sha256(file_data).hexdigest()
+            filepath = self.store.destination(os.path.basename(filename), sha256)
+
+            os.makedirs(self._journal_path(), exist_ok=True)
+            part_path = self._journal_path(uuid.uuid4().hex + '.part')
+            with open(part_path, 'wb') as f:
+                f.write(file_data)
+            self.store.add(part_path, sha256, filepath)
+
+            self._notify_file_received(msg_type, filepath, filename, payload.get('duration', 0))
+
+        # --- Streaming File Transfer ---
+        elif msg_type == 'file_offer':
+            self._accept_file_offer(payload)
+        elif msg_type in ['file_accept', 'file_reject']:
+            pending = self.outgoing_transfers.get(payload['id'])
+            if pending:
+                pending['accepted'] = msg_type == 'file_accept'
+                pending['have'] = payload.get('have', [])
+                # Peers without flow control grant no window and are not throttled
+                pending['credit'] = payload.get('window')
+                pending['event'].set()
+        elif msg_type == 'window_update':
+            pending = self.outgoing_transfers.get(payload['id'])
+            if pending and pending['credit'] is not None:
+                self._grant_credit(pending, payload['credit'])
+        elif msg_type == 'file_chunk':
+            self._write_file_chunk(payload['id'], payload['offset'], base64.b64decode(payload['data']))
+        elif msg_type == 'file_end':
+            self._finish_file_transfer(payload)
+        elif msg_type == 'file_done':
+            self._drop_outgoing_journal(payload['id'])
+
+        # --- Call Signaling ---
+        elif msg_type == 'call_request':
+            self.incoming_call_offer = payload
+            if self.on_call_request:
+                self.on_call_request(payload)
+        elif msg_type == 'call_accepted':
+            if self.on_call_status: self.on_call_status("Call connected. Starting stream...")
+            if self.my_pending_udp_socket:
+                peer_udp_port = payload['udp_port']
+                # Peers without codec support answer without one and send raw PCM
+                voice_version = payload.get('voice_version', 1)
+                media_keys = None
+                if voice_version >= 3:
+                    media_keys = self._media_keys(base64.b64decode(payload['media_nonce']))
+                self.start_voice_call(peer_udp_port, self.my_pending_udp_socket,
+                                      payload.get('codec', 'pcm'), voice_version, media_keys)
+                self.my_pending_udp_socket = None # Clear after use
+            else:
+                print("ERROR: Received 'call_accepted' but no pending call was initiated.")
+        elif msg_type == 'call_rejected':
+            if self.on_call_status: self.on_call_status("Call rejected by peer.")
+            self.stop_voice_call() # Cleans up pending socket
+        elif msg_type == 'call_end':
+            if self.on_call_status: self.on_call_status("Call ended by peer.")
+            self.stop_voice_call()
+
+        return True
+
+    def _handle_receive_error(self, e) -> bool:
+        """Reports an error raised while receiving; returns True if the session survives it."""
+        if not self.is_connected:
+            return False # The socket was closed under us by a disconnect
+        if isinstance(e, (ConnectionResetError, BrokenPipeError)):
+            self.handle_disconnect()
+            return False
+        if isinstance(e, InvalidTag):
+            # A forged, replayed or reordered frame breaks the sequence; drop the session
+            print("Frame authentication failed, closing connection.")
+            self.handle_disconnect()
+            return False
+        if isinstance(e, (json.JSONDecodeError, ValueError)):
+            print(f"Data corruption or format error: {e}")
+            # Don't disconnect for a single bad message, but log it.
+            return True
+        import traceback
+        print(f"UNEXPECTED ERROR in receive_loop:")
+        traceback.print_exception(e)
+        self.handle_disconnect()
+        return False
+    
+    def send_message(self, message):
+        """Sends a text message.
+
+        With reliable delivery the message goes to the outbox first, so one
+        sent while the link is down or dying reaches the peer after the
+        next reconnect.
+        """
+        if not message or not (self.is_connected or self.reliable_delivery):
+            return
+        try:
+            if not self.reliable_delivery:
+                self._record("You", 'text', message)
+                self.send_json('text', message)
+                return
+            outbox = self.outbox
+            with outbox.lock:
+                # Under the lock, so a replay cannot overtake or follow this message
+                seq = None if self.outbox_mode == 'plain' else outbox.add('text', message)
+                self._record("You", 'text', message)
+                if self.outbox_mode and self.is_connected:
+                    self.send_json('text', message, seq=seq)
+        except (ConnectionResetError, BrokenPipeError):
+            self.handle_disconnect()
+
+    # --- Reliable Delivery ---
+    # Text messages carry a sequence number from the Outbox. The receiver
+    # processes each number once and acknowledges the highest it has seen,
+    # ACK_DELAY after a burst. Each hello carries the sender's outbox epoch
+    # and the highest number received from the peer, and after it each side
+    # replays only the messages the other has not acknowledged.
+    @property
+    def outbox(self) -> Outbox:
+        path = os.path.join(self.downloads_dir, OUTBOX_DIR, self.history_peer + '.log')
+        if self._outbox is None or self._outbox.path != path:
+            if self._outbox:
+                self._outbox.close()
+            self._outbox = Outbox(path)
+        return self._outbox
+
+    def _open_outbox(self, hello):
+        """Replays what the peer has missed, once its first frame shows whether it sends acks."""
+        if not self.reliable_delivery:
+            self.outbox_mode = 'plain'
+            return
+        outbox = self.outbox
+        with outbox.lock:
+            if 'acks' in hello.get('features', []):
+                resume = hello.get('outbox', {})
+                outbox.greet(resume.get('epoch'))
+                received = resume.get('received') or {}
+                if received.get('epoch') == outbox.epoch:
+                    outbox.ack(received.get('seq', 0))
+                for seq, msg_type, payload in outbox.pending:
+                    self.send_json(msg_type, payload, seq=seq)
+                self.outbox_mode = 'acks'
+            else:
+                # Older peers cannot acknowledge, so what is queued goes out once, unsequenced
+                for _, msg_type, payload in outbox.take():
+                    self.send_json(msg_type, payload)
+                self.outbox_mode = 'plain'
+
+    def _schedule_hello_timeout(self):
+        self._cancel_hello_timeout()
+        self.hello_timer = threading.Timer(HELLO_TIMEOUT, self._hello_timed_out, args=(self.session_nonce,))
+        self.hello_timer.daemon = True
+        self.hello_timer.start()
+
+    def _hello_timed_out(self, session_nonce):
+        """Sends held messages unsequenced to a peer that has not sent a hello since connecting."""
+        if session_nonce != self.session_nonce or not self.is_connected:
+            return
+        try:
+            with self.outbox.lock:
+                if self.outbox_mode is None:
+                    self._open_outbox({})
+        except (ConnectionResetError, BrokenPipeError):
+            self.handle_disconnect()
+
+    def _cancel_hello_timeout(self):
+        if self.hello_timer:
+            self.hello_timer.cancel()
+            self.hello_timer = None
+
+    def _first_delivery(self, message) -> bool:
+        """Checks a received message against the outbox; False for a replayed duplicate."""
+        seq = message.get('seq')
+        if seq is None or not self.reliable_delivery:
+            return True
+        # Duplicates are acknowledged too; the ack that would have covered them was lost
+        self._schedule_ack()
+        return self.outbox.receive(seq)
+
+    def _schedule_ack(self):
+        if self.ack_timer is None:
+            self.ack_timer = threading.Timer(ACK_DELAY, self._send_ack)
+            self.ack_timer.daemon = True
+            self.ack_timer.start()
+
+    def _send_ack(self):
+        self.ack_timer = None
+        if not self.is_connected:
+            return
+        try:
+            self.send_json('ack', {'seq': self.outbox.peer_seen})
+        except (ConnectionResetError, BrokenPipeError):
+            self.handle_disconnect()
+
+    def _cancel_ack(self):
+        if self.ack_timer:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+    
+    def send_image(self, filepath):
+        """Sends an image, shrunk to the transcoder's size budget, with a preview in its offer.
+
+        Blocks while the image is prepared on the transcoder's workers, so
+        call it off the UI thread like send_file.
+        """
+        try:
+            send_path, preview = self.image_transcoder.submit(filepath, os.path.join(self.downloads_dir, "sent")).result()
+        except Exception as e:
+            print(f"Could not prepare image {filepath}, sending it unchanged: {e}")
+            send_path, preview = filepath, None
+        return self.send_file(send_path, preview=preview)
+
+    def send_voice_note(self, note):
+        """Sends a voice message while it is still being recorded.
+
+        Chunks go out as soon as the recorder has written them, so only the
+        tail is left to send when recording stops. Peers that cannot take a
+        transfer of unknown size get the finished file through send_file.
+        Blocks until the note is sent; call it off the UI thread.
+        """
+        if 'streaming' not in self.peer_features:
+            note.wait()
+            return self.send_file(note.path, True, note.duration)
+        if not self.is_connected:
+            return
+
+        offer = self._make_voice_note_offer(note)
+        transfer_id = offer['id']
+        try:
+            pending = {'event': threading.Event(), 'accepted': False, 'have': [],
+                       'credit': None, 'credit_cond': threading.Condition(), 'blocked': False,
+                       'session': self.session_nonce}
+            self.outgoing_transfers[transfer_id] = pending
+            self.send_json('file_offer', offer)
+
+            if not pending['event'].wait(FILE_OFFER_TIMEOUT) or not pending['accepted']:
+                self._file_not_accepted(offer, pending)
+                return
+
+            for offset, chunk in self._voice_note_chunks(note):
+                if not self.is_connected or not self._wait_for_credit(pending, len(chunk)):
+                    return
+                # ADPCM does not compress
+                self._send_file_chunk(transfer_id, offset, chunk, False, PRIORITY_VOICE)
+            self._finish_voice_note(offer, note)
+
+        except (ConnectionResetError, BrokenPipeError):
+            self.handle_disconnect()
+        except Exception as e:
+            if self.is_connected and self.on_message_received:
+                self.on_message_received(f"System: Failed to send voice message: {e}")
+        finally:
+            self.outgoing_transfers.pop(transfer_id, None)
+
+    def _make_voice_note_offer(self, note):
+        # No size: the receiver learns it, and the duration, from 'file_end'
+        return {'id': uuid.uuid4().hex, 'name': os.path.basename(note.path), 'kind': 'audio',
+                'chunk_size': FILE_CHUNK_SIZE, 'streaming': True}
+
+    def _voice_note_chunks(self, note):
+        """Yields (offset, data) for a note as it is recorded, ending with its final header."""
+        offset = 0
+        with open(note.path, 'rb') as f:
+            while True:
+                available = note.wait(offset + FILE_CHUNK_SIZE)
+                if available <= offset:
+                    break # Finished and everything sent
+                f.seek(offset)
+                chunk = f.read(min(FILE_CHUNK_SIZE, available - offset))
+                yield offset, chunk
+                offset += len(chunk)
+        # The lengths in the header are only known now; this overwrites the start of the file
+        yield 0, note.header()
+
+    def _finish_voice_note(self, offer, note):
+        transfer_id = offer['id']
+        self.send_json('file_end', {'id': transfer_id, 'size': os.path.getsize(note.path),
+                                    'sha256': file_sha256(note.path), 'duration': note.duration},
+                       transfer_id, PRIORITY_VOICE)
+        self._finish_outgoing_transfer(transfer_id)
+        self._notify_file_sent('audio', note.path, offer['name'], note.duration)
+
+    def send_file(self, filepath, is_audio=False, duration=None, offer=None, preview=None):
+        """Streams a file to the peer in fixed-size encrypted chunks.
+
+        The peer is sent a 'file_offer' header first and the data only follows
+        once it answers with 'file_accept', so memory use stays at one chunk
+        regardless of the file size. Passing the offer of an interrupted
+        transfer resumes it: only the chunks the peer reports missing are sent.
+        """
+        if not self.is_connected or not os.path.exists(filepath):
+            return
+        if 'streaming' not in self.peer_features:
+            self._send_file_frame(filepath, is_audio, duration)
+            return
+
+        if offer is None:
+            offer = self._make_file_offer(filepath, is_audio, duration, preview, file_sha256(filepath))
+            self._save_outgoing_journal(offer, filepath)
+            self._announce_preview(offer, filepath)
+        transfer_id = offer['id']
+        filename = offer['name']
+        pending = {'event': threading.Event(), 'accepted': False, 'have': [],
+                   'credit': None, 'credit_cond': threading.Condition(), 'blocked': False,
+                   'session': self.session_nonce}
+        self.outgoing_transfers[transfer_id] = pending
+        try:
+            self.send_json('file_offer', offer)
+
+            if not pending['event'].wait(FILE_OFFER_TIMEOUT) or not pending['accepted']:
+                self._file_not_accepted(offer, pending)
+                return
+            if self._peer_has_file(offer, pending, filepath):
+                return
+
+            digest = hashlib.sha256()
+            sent = 0
+            compress = self.is_compressible(filepath)
+            priority = transfer_priority(offer['kind'])
+            with open(filepath, 'rb') as f:
+                while True:
+                    chunk = f.read(FILE_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if not self._transfer_is_current(pending):
                         return
-                    data += packet
+                    digest.update(chunk)
+                    if not ranges_cover(pending['have'], sent, len(chunk)):
+                        if not self._wait_for_credit(pending, len(chunk)):
+                            return
+                        self._send_file_chunk(transfer_id, sent, chunk, compress, priority)
+                    sent += len(chunk)
+                    self._report_progress(pending, transfer_id, filename, sent, offer['size'], "send")
+
+            # Queued behind the last chunk on the transfer's own stream
+            self.send_json('file_end', {'id': transfer_id, 'size': sent, 'sha256': digest.hexdigest()},
+                           transfer_id, priority)
+            self._finish_outgoing_transfer(transfer_id)
+            self._notify_file_sent(offer['kind'], filepath, filename, offer.get('duration'))
+
+        except (ConnectionResetError, BrokenPipeError):
+            if pending['session'] == self.session_nonce:
+                self.handle_disconnect()
+        except Exception as e:
+            # Errors caused by the connection dropping leave the journal for a resume
+            if self._transfer_is_current(pending):
+                self._drop_outgoing_journal(transfer_id)
+                if self.on_message_received:
+                    self.on_message_received(f"System: Failed to send file: {e}")
+        finally:
+            # A resume in a newer session may have taken the entry over
+            if self.outgoing_transfers.get(transfer_id) is pending:
+                del self.outgoing_transfers[transfer_id]
+
+    def _send_file_frame(self, filepath, is_audio, duration):
+        """Sends a whole file as a single 'file'/'image'/'audio' message.
+
+        Peers that do not advertise 'streaming' ignore 'file_offer', so they
+        get the file the way they always have.
+        """
+        try:
+            filename = os.path.basename(filepath)
+            with open(filepath, 'rb') as f:
+                payload = {'name': filename, 'data': base64.b64encode(f.read()).decode('utf-8')}
+            msg_type = self._file_kind(filepath, is_audio)
+            if is_audio:
+                payload['duration'] = duration
+            self.send_json(msg_type, payload, uuid.uuid4().hex, transfer_priority(msg_type))
+            self._notify_file_sent(msg_type, filepath, filename, duration)
+        except (ConnectionResetError, BrokenPipeError):
+            self.handle_disconnect()
+        except Exception as e:
+            if self.on_message_received:
+                self.on_message_received(f"System: Failed to send file: {e}")
+
+    def _file_kind(self, filepath, is_audio):
+        if is_audio:
+            return 'audio'
+        return 'image' if self.is_image(filepath) else 'file'
+
+    def _make_file_offer(self, filepath, is_audio, duration, preview=None, sha256=None):
+        """Builds the 'file_offer' header announcing a new outgoing transfer.
+
+        With the file's sha256 in the offer, a peer that already holds the
+        content answers that it has every byte and nothing is sent.
+        """
+        msg_type = self._file_kind(filepath, is_audio)
+
+        offer = {
+            'id': uuid.uuid4().hex,
+            'name': os.path.basename(filepath),
+            'size': os.path.getsize(filepath),
+            'kind': msg_type,
+            'chunk_size': FILE_CHUNK_SIZE
+        }
+        if is_audio:
+            offer['duration'] = duration
+        if preview and msg_type == 'image':
+            offer['preview'] = base64.b64encode(preview).decode('ascii')
+        if sha256:
+            offer['sha256'] = sha256
+        return offer
+
+    def _peer_has_file(self, offer, pending, filepath) -> bool:
+        """Completes a transfer without sending data if the peer answered that it has all of it."""
+        if not offer.get('sha256') or not ranges_cover(pending['have'], 0, offer['size']):
+            return False
+        transfer_id = offer['id']
+        self.send_json('file_end', {'id': transfer_id, 'size': offer['size'], 'sha256': offer['sha256']},
+                       transfer_id, transfer_priority(offer['kind']))
+        self._finish_outgoing_transfer(transfer_id)
+        self._notify_file_sent(offer['kind'], filepath, offer['name'], offer.get('duration'))
+        return True
+
+    def _announce_preview(self, offer, filepath):
+        """Shows our own image right away when it is sent with a preview."""
+        if offer.get('preview') and self.on_image_preview:
+            self.on_image_preview(filepath, filepath, "You")
+
+    def _transfer_is_current(self, pending) -> bool:
+        """False once the session a transfer was started in has ended, even if a new one is up."""
+        return self.is_connected and pending['session'] == self.session_nonce
+
+    def _file_not_accepted(self, offer, pending):
+        if not self._transfer_is_current(pending):
+            return # Interrupted before the answer; resumed on the next session
+        self._drop_outgoing_journal(offer['id'])
+        if self.on_message_received:
+            if offer.get('resume'):
+                self.on_message_received(f"Could not resume sending file '{offer['name']}'.", "System")
+            else:
+                self.on_message_received(f"Peer did not accept file '{offer['name']}'.", "System")
+
+    def _finish_outgoing_transfer(self, transfer_id):
+        # The journal stays until the peer confirms with 'file_done'; legacy peers never do
+        if self.wire_version == 1:
+            self._drop_outgoing_journal(transfer_id)
+        if self.compressor:
+            self.compressor.forget(transfer_id)
+
+    # --- Transfer Journals ---
+    # Interrupted transfers survive disconnects and restarts on disk under
+    # downloads_dir/.transfers. The receiver keeps <id>.part, the offer in
+    # <id>.json and an append-only manifest of chunk hashes in <id>.manifest;
+    # the sender keeps the offer and source path in outgoing/<id>.json until
+    # the receiver confirms with 'file_done'. When the sender re-offers the
+    # same id, the receiver answers with the byte ranges it verified against
+    # its manifest and only the rest is resent.
+    @property
+    def store(self) -> ContentStore:
+        return content_store(self.downloads_dir)
+
+    def _journal_path(self, *parts):
+        return os.path.join(self.downloads_dir, TRANSFER_JOURNAL_DIR, *parts)
+
+    def _outgoing_journal_path(self, *parts):
+        # One directory per peer, so a transfer is only ever offered to the peer it was meant for
+        return self._journal_path('outgoing', self.history_peer, *parts)
+
+    def _save_outgoing_journal(self, offer, filepath):
+        stat = os.stat(filepath)
+        journal = {'offer': offer, 'path': os.path.abspath(filepath),
+                   'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        try:
+            os.makedirs(self._outgoing_journal_path(), exist_ok=True)
+            with open(self._outgoing_journal_path(offer['id'] + '.json'), 'w') as f:
+                json.dump(journal, f)
+        except OSError as e:
+            print(f"Cannot journal transfer of '{offer['name']}', it will not be resumable: {e}")
+
+    def _drop_outgoing_journal(self, transfer_id):
+        try:
+            os.remove(self._outgoing_journal_path(transfer_id + '.json'))
+        except OSError:
+            pass
+
+    def _resume_outgoing_transfers(self):
+        """Re-offers every transfer journaled for this peer whose source file is unchanged."""
+        self._prune_transfer_journals()
+        try:
+            names = os.listdir(self._outgoing_journal_path())
+        except OSError:
+            return
+        for name in names:
+            transfer_id = name[:-len('.json')]
+            if not name.endswith('.json'):
+                continue
+            pending = self.outgoing_transfers.get(transfer_id)
+            if pending and pending['session'] == self.session_nonce:
+                continue # Already offered in this session
+            try:
+                with open(self._outgoing_journal_path(name)) as f:
+                    journal = json.load(f)
+                stat = os.stat(journal['path'])
+                unchanged = (stat.st_size, stat.st_mtime_ns) == (journal['size'], journal['mtime_ns'])
+            except (OSError, ValueError, KeyError):
+                unchanged = False
+            if not unchanged:
+                self._drop_outgoing_journal(transfer_id)
+                continue
+            offer = dict(journal['offer'], resume=True)
+            self._start_file_send(journal['path'], offer)
+
+    def _start_file_send(self, filepath, offer):
+        threading.Thread(target=self.send_file, args=(filepath,), kwargs={'offer': offer}, daemon=True).start()
+
+    def _prune_transfer_journals(self):
+        """Deletes journals and partial files of transfers abandoned for too long."""
+        cutoff = time.time() - TRANSFER_JOURNAL_TTL
+        directories = [self._journal_path()]
+        while directories:
+            try:
+                entries = list(os.scandir(directories.pop()))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        directories.append(entry.path) # outgoing/ and its per-peer directories
+                    elif entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+
+    def _load_incoming_journal(self, offer):
+        """Returns (journal, verified chunks) for a resumed offer, or None if it cannot be resumed.
+
+        Every chunk listed in the manifest is re-hashed from the partial file,
+        so chunks lost or torn by a crash are simply fetched again.
+        """
+        transfer_id = offer['id']
+        try:
+            with open(self._journal_path(transfer_id + '.json')) as f:
+                journal = json.load(f)
+            if journal['size'] != offer.get('size') or journal['chunk_size'] != offer.get('chunk_size'):
+                return None
+            with open(self._journal_path(transfer_id + '.manifest'), 'rb') as f:
+                manifest = f.read()
+            entries = {}
+            for i in range(len(manifest) // CHUNK_RECORD.size):
+                offset, length, chunk_hash = CHUNK_RECORD.unpack_from(manifest, i * CHUNK_RECORD.size)
+                entries[offset] = (length, chunk_hash) # Later records win
+            chunks = {}
+            with open(self._journal_path(transfer_id + '.part'), 'rb') as f:
+                for offset, (length, chunk_hash) in sorted(entries.items()):
+                    f.seek(offset)
+                    if hashlib.sha256(f.read(length)).digest() == chunk_hash:
+                        chunks[offset] = length
+        except (OSError, ValueError, KeyError):
+            return None
+        return journal, chunks
+
+    def _drop_incoming_journal(self, transfer_id):
+        for suffix in ('.part', '.json', '.manifest', '.preview'):
+            try:
+                os.remove(self._journal_path(transfer_id + suffix))
+            except OSError:
+                pass
+
+    def _record(self, sender, kind, body, path=None, duration=None):
+        if self.history:
+            self.history.add(self.history_peer, sender, kind, body, path, duration)
+
+    def _notify_file_sent(self, kind, filepath, filename, duration):
+        self._record("You", kind, filename, os.path.abspath(filepath), duration)
+        # Trigger UI update for the sender
+        if kind == 'image':
+            if self.on_image_received: self.on_image_received(filepath, "You")
+        elif kind == 'audio':
+            if self.on_audio_received: self.on_audio_received(filepath, duration, "You")
+        else:
+            if self.on_message_received:
+                self.on_message_received(f"You sent file: {filename}")
+
+    def _send_file_chunk(self, transfer_id, offset, chunk, compress=True, priority=PRIORITY_BULK):
+        if self.send_cipher:
+            # Version 2 sessions carry the chunk as raw bytes in a binary frame
+            header = CHUNK_HEADER.pack(bytes.fromhex(transfer_id), offset)
+            self.send_data(header + chunk, FRAME_CHUNK, transfer_id, priority, compress)
+        else:
+            self.send_json('file_chunk', {
+                'id': transfer_id,
+                'offset': offset,
+                'data': base64.b64encode(chunk).decode('ascii')
+            }, transfer_id, priority)
+
+    def _wait_for_credit(self, pending, size) -> bool:
+        """Blocks until the peer has room for size more bytes of a transfer.
+
+        Returns False if the session ended while waiting.
+        """
+        with pending['credit_cond']:
+            if pending['credit'] is not None:
+                has_room = lambda: pending['credit'] >= size or not self.is_connected
+                if not has_room():
+                    pending['blocked'] = True
+                    pending['credit_cond'].wait_for(has_room)
+                    pending['blocked'] = False
+                pending['credit'] -= size
+        return self.is_connected
+
+    def _grant_credit(self, pending, credit):
+        """Adds credit handed back by the receiver; runs on the receive thread while the sender spends it."""
+        with pending['credit_cond']:
+            pending['credit'] += credit
+            pending['credit_cond'].notify_all()
+
+    def _wake_credit_waiter(self, pending):
+        with pending['credit_cond']:
+            pending['credit_cond'].notify_all()
+
+    def flow_stats(self) -> dict:
+        """Queue depths and flow control state of the connection, for diagnostics."""
+        return {
+            'send_queue': self.scheduler.pending() if self.scheduler else 0,
+            'seal_queue': self.send_pipeline.jobs.qsize() if self.send_pipeline else 0,
+            'open_queue': self.recv_pipeline.jobs.qsize() if self.recv_pipeline else 0,
+            'outgoing': {transfer_id: {'credit': pending.get('credit'), 'blocked': pending.get('blocked', False)}
+                         for transfer_id, pending in list(self.outgoing_transfers.items())},
+            'incoming': {transfer_id: {'received': transfer['received'], 'undrained_credit': transfer['drained']}
+                         for transfer_id, transfer in list(self.incoming_transfers.items())},
+        }
+
+    def _report_progress(self, transfer, transfer_id, filename, done, total, direction):
+        """Invokes the progress callback whenever the whole percentage changes."""
+        if not self.on_transfer_progress:
+            return
+        percent = int(done * 100 / total) if total else 100
+        if percent != transfer.get('last_percent'):
+            transfer['last_percent'] = percent
+            self.on_transfer_progress(transfer_id, filename, done, total, direction)
+
+    def _accept_file_offer(self, offer):
+        """Opens a partial file for an incoming transfer and accepts the offer.
+
+        A re-offered transfer we hold a journal for continues where it left
+        off; the answer lists the byte ranges we already have.
+        """
+        transfer_id = offer['id']
+        filename = os.path.basename(offer['name'])
+        # Transfer ids name files on disk, so only accept the uuid4 hex we generate
+        if len(transfer_id) != 32 or not all(c in '0123456789abcdef' for c in transfer_id):
+            self.send_json('file_reject', {'id': transfer_id})
+            return
+
+        digest = offer.get('sha256')
+        if digest and not offer.get('streaming') and self.store.has(digest, offer.get('size')):
+            # Nothing needs to travel; 'file_end' just names the stored content
+            self._drop_incoming_journal(transfer_id)
+            self.known_transfers[transfer_id] = {'name': filename, 'kind': offer.get('kind', 'file'),
+                                                 'duration': offer.get('duration', 0), 'sha256': digest,
+                                                 'path': self.store.destination(filename, digest)}
+            self.send_json('file_accept', {'id': transfer_id, 'have': [[0, offer['size']]], 'window': FLOW_WINDOW})
+            return
+
+        filepath = self.store.destination(filename, digest)
+        chunks = {}
+        resumed = self._load_incoming_journal(offer) if offer.get('resume') else None
+        if offer.get('resume') and resumed is None:
+            # We lost the partial file; the sender drops its journal too
+            self.send_json('file_reject', {'id': transfer_id})
+            return
+        try:
+            os.makedirs(self._journal_path(), exist_ok=True)
+            if resumed:
+                chunks = resumed[1]
+                f = open(self._journal_path(transfer_id + '.part'), 'r+b')
+            else:
+                # Name partial files by transfer id so concurrent transfers never collide
+                f = open(self._journal_path(transfer_id + '.part'), 'wb')
+                with open(self._journal_path(transfer_id + '.json'), 'w') as journal:
+                    json.dump({'name': filename, 'size': offer.get('size', 0),
+                               'chunk_size': offer.get('chunk_size')}, journal)
+            manifest = open(self._journal_path(transfer_id + '.manifest'), 'ab')
+        except OSError as e:
+            print(f"Cannot receive '{filename}': {e}")
+            self._drop_incoming_journal(transfer_id)
+            self.store.release(filepath)
+            self.send_json('file_reject', {'id': transfer_id})
+            return
+
+        self.incoming_transfers[transfer_id] = {
+            'name': filename,
+            'kind': offer.get('kind', 'file'),
+            # Streamed transfers announce their size with 'file_end'
+            'size': None if offer.get('streaming') else offer.get('size', 0),
+            'duration': offer.get('duration', 0),
+            'path': filepath,
+            'part_path': self._journal_path(transfer_id + '.part'),
+            'file': f,
+            'manifest': manifest,
+            'chunks': chunks,
+            'received': sum(chunks.values()),
+            # The running digest only holds while chunks arrive in order from the start
+            'digest': None if chunks else hashlib.sha256(),
+            'digest_offset': 0,
+            'drained': 0 # Bytes written since the last credit was returned
+        }
+        self.send_json('file_accept', {'id': transfer_id, 'have': chunk_ranges(chunks), 'window': FLOW_WINDOW})
+        if offer.get('preview') and self.incoming_transfers[transfer_id]['kind'] == 'image':
+            self._show_incoming_preview(transfer_id, offer['preview'], filepath)
+
+    def _show_incoming_preview(self, transfer_id, preview, filepath):
+        """Shows the preview an image offer carries until the image itself has arrived."""
+        if not self.on_image_preview:
+            return
+        preview_path = self._journal_path(transfer_id + '.preview')
+        try:
+            with open(preview_path, 'wb') as f:
+                f.write(base64.b64decode(preview))
+        except (OSError, ValueError) as e:
+            print(f"Could not show preview of '{os.path.basename(filepath)}': {e}")
+            return
+        self.on_image_preview(filepath, preview_path, "Peer")
+
+    def _write_file_chunk(self, transfer_id, offset, data):
+        """Writes one received chunk to the partial file and records it in the manifest."""
+        transfer = self.incoming_transfers.get(transfer_id)
+        if transfer is None:
+            return
+        if offset + len(data) > (MAX_STREAMED_SIZE if transfer['size'] is None else transfer['size']):
+            print(f"Transfer '{transfer['name']}' overran its size at offset {offset}, aborting.")
+            self._abort_incoming_transfer(transfer_id)
+            return
+        f = transfer['file']
+        if f.tell() != offset:
+            f.seek(offset)
+        f.write(data)
+        transfer['manifest'].write(CHUNK_RECORD.pack(offset, len(data), hashlib.sha256(data).digest()))
 
-                decrypted_data = self.decrypt(data)
-                message = json.loads(decrypted_data.decode('utf-8'))
-                msg_type = message['type']
-                payload = message['payload']
+        if transfer['digest'] and offset == transfer['digest_offset']:
+            transfer['digest'].update(data)
+            transfer['digest_offset'] += len(data)
+        else:
+            transfer['digest'] = None
+        if offset not in transfer['chunks']:
+            transfer['chunks'][offset] = len(data)
+            transfer['received'] += len(data)
+        if transfer['size'] is not None:
+            self._report_progress(transfer, transfer_id, transfer['name'], transfer['received'], transfer['size'], "receive")
 
-                if msg_type == 'text':
-                    if self.on_message_received:
-                        self.on_message_received(payload, "Peer")
-                
-                elif msg_type == 'disconnect':
-                    self.handle_disconnect()
-                    break
+        # Only now that the chunk is on disk and the UI was told may the sender reuse its credit
+        transfer['drained'] += len(data)
+        if transfer['drained'] >= FLOW_WINDOW // 4:
+            self.send_json('window_update', {'id': transfer_id, 'credit': transfer['drained']})
+            transfer['drained'] = 0
 
-                elif msg_type in ['file', 'image', 'audio']:
-                    filename = payload['name']
-                    filepath = os.path.join(self.downloads_dir, os.path.basename(filename))
-                    file_data = base64.b64decode(payload['data'])
-
-                    with open(filepath, 'wb') as f:
-                        f.write(file_data)
-                    
-                    # Trigger callbacks for UI
-                    if msg_type == 'image':
-                        if self.on_image_received: self.on_image_received(filepath, "Peer")
-                    elif msg_type == 'audio':
-                        duration = payload.get('duration', 0)
-                        if self.on_audio_received: self.on_audio_received(filepath, duration, "Peer")
-                    else: # Generic file
-                        if self.on_message_received:
-                            self.on_message_received(f"File '{filename}' received and saved to '{self.downloads_dir}'.")
-
-                # --- Call Signaling ---
-                elif msg_type == 'call_request':
-                    if self.on_call_request:
-                        self.on_call_request(payload)
-                elif msg_type == 'call_accepted':
-                    if self.on_call_status: self.on_call_status("Call connected. Starting stream...")
-                    if self.my_pending_udp_socket:
-                        peer_udp_port = payload['udp_port']
-                        self.start_voice_call(peer_udp_port, self.my_pending_udp_socket)
-                        self.my_pending_udp_socket = None # Clear after use
-                    else:
-                        print("ERROR: Received 'call_accepted' but no pending call was initiated.")
-                elif msg_type == 'call_rejected':
-                    if self.on_call_status: self.on_call_status("Call rejected by peer.")
-                    self.stop_voice_call() # Cleans up pending socket
-                elif msg_type == 'call_end':
-                    if self.on_call_status: self.on_call_status("Call ended by peer.")
-                    self.stop_voice_call()
-
-            except (ConnectionResetError, BrokenPipeError):
-                self.handle_disconnect()
-                break
-            except (json.JSONDecodeError, ValueError) as e:
-                print(f"Data corruption or format error: {e}")
-                # Don't disconnect for a single bad message, but log it.
-                continue
-            except Exception as e:
-                import traceback
-                print(f"UNEXPECTED ERROR in receive_loop:")
-                traceback.print_exc()
-                self.handle_disconnect()
-                break
-    
-    def send_message(self, message):
-        if self.is_connected and message:
-            try:
-                msg_json = json.dumps({'type': 'text', 'payload': message})
-                self.send_data(msg_json.encode('utf-8'))
-            except (ConnectionResetError, BrokenPipeError):
-                self.handle_disconnect()
-    
-    def send_file(self, filepath, is_audio=False, duration=None):
-        if not self.is_connected or not os.path.exists(filepath):
+    def _finish_file_transfer(self, payload):
+        """Verifies a completed transfer and moves it into place."""
+        transfer_id = payload['id']
+        known = self.known_transfers.pop(transfer_id, None)
+        if known:
+            self._finish_known_transfer(transfer_id, known, payload)
+            return
+        transfer = self.incoming_transfers.pop(transfer_id, None)
+        if transfer is None:
+            return
+        transfer['file'].close()
+        transfer['manifest'].close()
+        if transfer['digest'] and transfer['digest_offset'] == payload['size']:
+            sha256 = transfer['digest'].hexdigest()
+        else:
+            # Resumed transfers are hashed once more from disk
+            sha256 = file_sha256(transfer['part_path'])
+        ok = os.path.getsize(transfer['part_path']) == payload['size'] and sha256 == payload['sha256']
+        if ok:
+            self.store.add(transfer['part_path'], sha256, transfer['path'])
+        else:
+            self.store.release(transfer['path'])
+        self._drop_incoming_journal(transfer_id)
+        # Either way there is nothing left to resume
+        self.send_json('file_done', {'id': transfer_id, 'ok': ok})
+        if not ok:
+            if self.on_message_received:
+                self.on_message_received(f"File '{transfer['name']}' was corrupted in transit.", "System")
             return
-        
-        try:
-            filename = os.path.basename(filepath)
-            with open(filepath, 'rb') as f:
-                file_data = f.read()
-            
-            file_data_b64 = base64.b64encode(file_data).decode('utf-8')
 
-            payload = {
-                'name': filename,
-                'data': file_data_b64
-            }
-            
-            msg_type = 'file'
-            if is_audio:
-                msg_type = 'audio'
-                payload['duration'] = duration
-            elif self.is_image(filepath):
-                msg_type = 'image'
+        self._notify_file_received(transfer['kind'], transfer['path'], transfer['name'],
+                                   payload.get('duration', transfer['duration']))
 
-            info_json = json.dumps({'type': msg_type, 'payload': payload})
-            self.send_data(info_json.encode('utf-8'))
-            
-            # Trigger UI update for the sender
-            if msg_type == 'image':
-                if self.on_image_received: self.on_image_received(filepath, "You")
-            elif msg_type == 'audio':
-                if self.on_audio_received: self.on_audio_received(filepath, duration, "You")
-            else:
-                if self.on_message_received:
-                    self.on_message_received(f"You sent file: {filename}")
+    def _finish_known_transfer(self, transfer_id, known, payload):
+        """Completes a transfer of content we already had by linking it under its new name."""
+        ok = payload.get('sha256') == known['sha256'] and self.store.has(known['sha256'])
+        if ok:
+            self.store.link(known['sha256'], known['path'])
+        else:
+            self.store.release(known['path'])
+        self.send_json('file_done', {'id': transfer_id, 'ok': ok})
+        if not ok:
+            if self.on_message_received:
+                self.on_message_received(f"File '{known['name']}' could not be restored from earlier downloads.", "System")
+            return
+        self._notify_file_received(known['kind'], known['path'], known['name'],
+                                   payload.get('duration', known['duration']))
 
-        except (ConnectionResetError, BrokenPipeError):
-            self.handle_disconnect()
-        except Exception as e:
-             if self.on_message_received:
-                self.on_message_received(f"System: Failed to send file: {e}")
+    def _abort_incoming_transfer(self, transfer_id):
+        self._suspend_incoming_transfer(transfer_id)
+        self._drop_incoming_journal(transfer_id)
+
+    def _suspend_incoming_transfer(self, transfer_id):
+        """Closes an incoming transfer but keeps its journal so the sender can resume it."""
+        transfer = self.incoming_transfers.pop(transfer_id, None)
+        if transfer:
+            transfer['file'].close()
+            transfer['manifest'].close()
+            self.store.release(transfer['path'])
+
+    def _notify_file_received(self, kind, filepath, filename, duration):
+        self._record("Peer", kind, filename, os.path.abspath(filepath), duration)
+        # Trigger callbacks for UI
+        if kind == 'image':
+            if self.on_image_received: self.on_image_received(filepath, "Peer")
+        elif kind == 'audio':
+            if self.on_audio_received: self.on_audio_received(filepath, duration or 0, "Peer")
+        else: # Generic file
+            if self.on_message_received:
+                self.on_message_received(f"File '{filename}' received and saved as '{filepath}'.")
 
     def is_image(self, filepath):
         """Checks if a file is an image based on extension."""
-        return filepath.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp'))
+        return filepath.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'))
 
     def is_audio(self, filepath):
         """Checks if a file is an audio file based on extension."""
         return filepath.lower().endswith('.wav')
 
+    def is_compressible(self, filepath):
+        """Checks if a file is worth compressing, i.e. not an already compressed format."""
+        return not filepath.lower().endswith(INCOMPRESSIBLE_EXTENSIONS)
+
     def handle_disconnect(self):
         if not self.is_connected:
             return
             
         self.is_connected = False
+        self.connection_up.clear()
         
         if self.on_message_received:
             self.on_message_received("Peer has left the chat.", "System")
@@ -346,30 +2994,84 @@ class ChatClient:
             self.on_connection_status("Connection lost.", is_connected=False)
             
         self.stop_voice_call() # Ensure call resources are cleaned up
+
+        # Keep half-received files for a resume and wake up senders waiting for an answer
+        for transfer_id in list(self.incoming_transfers):
+            self._suspend_incoming_transfer(transfer_id)
+        for known in self.known_transfers.values():
+            self.store.release(known['path'])
+        self.known_transfers.clear()
+        for pending in list(self.outgoing_transfers.values()):
+            pending['event'].set()
+            self._wake_credit_waiter(pending)
+
+        # Messages sent from now on wait in the outbox for the next session
+        self.outbox_mode = None
+        self._cancel_ack()
+        self._cancel_hello_timeout()
+
+        self._close_transport()
+        self.disconnected.set()
+
+    def _close_transport(self):
+        if self.scheduler:
+            self.scheduler.close()
+            self.scheduler = None
+        if self.send_pipeline:
+            self.send_pipeline.close()
+            self.send_pipeline = None
         if self.sock:
             self.sock.close()
             self.sock = None
 
+    def peer_ip(self):
+        """Returns the IP address of the connected peer."""
+        return self.sock.getpeername()[0]
+
     def disconnect(self):
         """Public method to disconnect the client."""
+        self.session_ended = True
         if self.is_connected:
             try:
+                # Let queued frames go out first; the goodbye must not overtake them
+                if self.scheduler:
+                    self.scheduler.close(timeout=2)
+                    self.scheduler = None
                 msg = {"type": "disconnect", "payload": ""}
                 json_msg = json.dumps(msg).encode('utf-8')
                 self.send_data(json_msg)
+                if self.send_pipeline:
+                    self.send_pipeline.close(timeout=2)
             except Exception as e:
                 print(f"Could not send disconnect message: {e}")
 
         self.handle_disconnect()
 
-    def send_call_request(self):
-        try:
+    def _udp_socket(self):
+        """Binds a UDP socket for voice in the address family of the chat connection."""
+        if ':' in self.peer_ip():
+            s = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+            # Dual-stack listeners see IPv4 peers as ::ffff:a.b.c.d
+            s.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+            s.bind(('::', 0))
+        else:
             s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             s.bind(('0.0.0.0', 0))
+        return s
+
+    def send_call_request(self):
+        try:
+            s = self._udp_socket()
             self.my_pending_udp_socket = s
             my_udp_port = s.getsockname()[1]
+            self.call_nonce = os.urandom(16)
             
-            msg = {"type": "call_request", "payload": {"udp_port": my_udp_port}}
+            msg = {"type": "call_request", "payload": {
+                "udp_port": my_udp_port,
+                "codecs": supported_voice_codecs(),
+                "voice_version": VOICE_PROTOCOL_VERSION,
+                "media_nonce": base64.b64encode(self.call_nonce).decode('ascii')
+            }}
             self.send_data(json.dumps(msg).encode('utf-8'))
             if self.on_call_status: self.on_call_status("Ringing...")
             return True
@@ -380,13 +3082,26 @@ class ChatClient:
 
     def accept_call(self, peer_udp_port):
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.bind(('0.0.0.0', 0))
+            s = self._udp_socket()
             my_udp_port = s.getsockname()[1]
 
-            msg = {"type": "call_accepted", "payload": {"udp_port": my_udp_port}}
+            offer = self.incoming_call_offer or {}
+            codec_name = negotiate_voice_codec(offer.get('codecs'))
+            voice_version = min(offer.get('voice_version', 1), VOICE_PROTOCOL_VERSION)
+            self.call_nonce = os.urandom(16)
+            media_keys = None
+            if voice_version >= 3:
+                media_keys = self._media_keys(base64.b64decode(offer['media_nonce']))
+            msg = {"type": "call_accepted", "payload": {
+                "udp_port": my_udp_port,
+                "codec": codec_name,
+                "voice_version": voice_version,
+                "media_nonce": base64.b64encode(self.call_nonce).decode('ascii')
+            }}
+            # Started first, so a hang-up answering our acceptance finds the call to stop
+            if not self.start_voice_call(peer_udp_port, s, codec_name, voice_version, media_keys):
+                return False
             self.send_data(json.dumps(msg).encode('utf-8'))
-            self.start_voice_call(peer_udp_port, s)
             return True
         except Exception as e:
             if self.on_call_status: self.on_call_status(f"Accept failed: {e}")
@@ -397,14 +3112,49 @@ class ChatClient:
         self.send_data(json.dumps(msg).encode('utf-8'))
         self.stop_voice_call()
         if self.on_call_status: self.on_call_status("Call ended.")
+
+    def end_call(self):
+        """Hangs up the current call, or cancels an outgoing one that is still ringing."""
+        if self.is_connected:
+            try:
+                self.send_json('call_end', "")
+            except Exception as e:
+                print(f"Could not send call_end message: {e}")
+        self.stop_voice_call()
+        if self.on_call_status: self.on_call_status("Call ended.")
     
-    def start_voice_call(self, peer_udp_port, my_socket):
-        if self.voice_call_manager: return
-        peer_ip = self.sock.getpeername()[0]
-        self.voice_call_manager = VoiceCallManager(self.f_obj, peer_ip, peer_udp_port, my_socket)
-        self.voice_call_manager.start()
+    def _media_keys(self, peer_nonce):
+        """Returns the (send, receive) voice keys for this call."""
+        return (derive_media_key(self.master_key, self.call_nonce, peer_nonce),
+                derive_media_key(self.master_key, peer_nonce, self.call_nonce))
+
+    def start_voice_call(self, peer_udp_port, my_socket, codec_name='pcm', voice_version=1, media_keys=None) -> bool:
+        """Starts streaming audio; on failure hangs up instead of ending the chat session."""
+        if self.voice_call_manager: return True
+        manager = None
+        try:
+            manager = VoiceCallManager(self.f_obj, self.peer_ip(), peer_udp_port, my_socket,
+                                       codec_name, voice_version, media_keys,
+                                       audio_backend=self.audio_backend)
+            manager.start()
+        except Exception as e:
+            # No PyAudio or no usable sound device; this runs on the receive thread for the caller
+            if manager:
+                manager.stop()
+            my_socket.close()
+            if self.on_call_status: self.on_call_status(f"Call failed: {e}")
+            try:
+                self.send_json('call_end', "")
+            except Exception:
+                pass
+            self.stop_voice_call()
+            return False
+        self.voice_call_manager = manager
+        return True
 
     def stop_voice_call(self):
+        self.incoming_call_offer = None
+        self.call_nonce = None
         if self.voice_call_manager:
             self.voice_call_manager.stop()
             self.voice_call_manager = None
@@ -412,53 +3162,962 @@ class ChatClient:
             self.my_pending_udp_socket.close()
             self.my_pending_udp_socket = None
 
+# --- asyncio Transport ---
+_shared_loop = None
+_shared_loop_lock = threading.Lock()
+
+def get_shared_loop():
+    """Returns the process-wide event loop for AsyncChatClient, starting its thread on first use."""
+    global _shared_loop
+    with _shared_loop_lock:
+        if _shared_loop is None:
+            _shared_loop = asyncio.new_event_loop()
+            threading.Thread(target=_shared_loop.run_forever, name="p2p-event-loop", daemon=True).start()
+        return _shared_loop
+
+class AsyncChatClient(ChatClient):
+    """A ChatClient that runs on one asyncio event loop instead of a thread per task.
+
+    It takes the same callbacks as ChatClient and invokes them from the loop
+    thread. Every public method can be called from any thread; the work is
+    handed over to the loop. listen, connect and send_file return a
+    concurrent.futures.Future instead of blocking. All clients share one loop
+    unless another is passed in.
+    """
+    def __init__(self, key, loop=None, **kwargs):
+        super().__init__(key, **kwargs)
+        # Frames are sealed and opened on the loop thread
+        self.crypto_workers = 1
+        self.loop = loop or get_shared_loop()
+        self.reader = None
+        self.writer = None
+        self.server = None
+        self.receive_task = None
+        self.connection_decision = None
+
+    def _in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def _call_in_loop(self, func, *args):
+        if self._in_loop():
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def send_data(self, data: bytes, frame_type=FRAME_JSON, stream='json', priority=PRIORITY_CONTROL, compress=True):
+        """Queues an encrypted frame on the stream writer; safe to call from any thread.
+
+        Transfers wait for the writer to drain after every chunk, so other
+        frames interleave with them without a separate scheduler.
+        """
+        self._call_in_loop(self._write_frame, data, frame_type, stream if compress else None)
+
+    def _write_frame(self, data, frame_type, stream):
+        if self.writer is None or self.writer.is_closing():
+            return
+        with self.send_lock:
+            self.writer.write(self.seal_frame(data, frame_type, stream))
+
+    def listen(self, host, port):
+        """Starts listening for a peer without blocking the caller."""
+        return asyncio.run_coroutine_threadsafe(self._listen(host, port), self.loop)
+
+    async def _listen(self, host, port):
+        if self.listen_stopped.is_set():
+            return
+        # None binds every address, IPv6 included
+        self.server = await asyncio.start_server(self._on_incoming, None if host in ('0.0.0.0', '') else host, port)
+        if self.on_connection_status:
+            self.on_connection_status(f"Listening on {host}:{port}...", is_connected=False)
+
+    async def _on_incoming(self, reader, writer):
+        if self.is_connected or self.connection_decision is not None or self.listen_stopped.is_set():
+            writer.close() # Already talking to someone
+            return
+
+        addr = writer.get_extra_info('peername')
+        self.connection_decision = self.loop.create_future()
+        if self.on_connection_request:
+            self.on_connection_request(addr)
+        else:
+            self.connection_decision.set_result(True)
+
+        accepted = await self.connection_decision
+        self.connection_decision = None
+        if not accepted:
+            writer.close()
+            if self.on_connection_status:
+                self.on_connection_status(f"Connection rejected. Listening again...", is_connected=False)
+            return
+
+        if self.server:
+            # Stop listening; a ChatHub keeps its own listener open instead
+            self.server.close()
+            self.server = None
+        self._open_session(reader, writer, f"Connected by {addr[0]}:{addr[1]}")
+
+    def _decide_connection(self, accepted):
+        if self.connection_decision and not self.connection_decision.done():
+            self.connection_decision.set_result(accepted)
+
+    def stop_listening(self):
+        self.listen_stopped.set()
+        self._call_in_loop(self._stop_server)
+        self._call_in_loop(self._decide_connection, False)
+
+    def _stop_server(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+
+    def confirm_connection(self):
+        """Called by the UI to confirm a pending connection."""
+        self.loop.call_soon_threadsafe(self._decide_connection, True)
+
+    def reject_connection(self):
+        """Called by the UI to reject a pending connection."""
+        self.loop.call_soon_threadsafe(self._decide_connection, False)
+
+    def connect(self, host, port):
+        """Connects to a listening peer without blocking the caller."""
+        return asyncio.run_coroutine_threadsafe(self._connect(host, port), self.loop)
+
+    async def _connect(self, host, port):
+        try:
+            # Races the peer's IPv6 and IPv4 addresses like dial()
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port, happy_eyeballs_delay=CONNECT_ATTEMPT_DELAY, interleave=1),
+                self.connect_timeout)
+        except Exception as e:
+            self.is_connected = False
+            if self.on_connection_status:
+                self.on_connection_status(f"Connection failed: {e}", is_connected=False)
+            return
+        self._open_session(reader, writer, f"Connected to {host}:{port}")
+
+    def _open_session(self, reader, writer, status):
+        self.reader = reader
+        self.writer = writer
+        configure_socket(writer.get_extra_info('socket'))
+        self.is_connected = True
+        self._start_session()
+        if self.on_connection_status:
+            self.on_connection_status(status, is_connected=True)
+        self.receive_task = self.loop.create_task(self.receive_loop())
+
+    async def receive_loop(self):
+        """Handles receiving messages and files."""
+        while self.is_connected:
+            try:
+                header = await self.reader.readexactly(4)
+                frame = await self.reader.readexactly(int.from_bytes(header, 'big'))
+                if not self.handle_frame(frame):
+                    break
+            except asyncio.IncompleteReadError:
+                self.handle_disconnect()
+                break
+            except Exception as e:
+                if not self._handle_receive_error(e):
+                    break
+
+    def send_file(self, filepath, is_audio=False, duration=None, offer=None, preview=None):
+        """Streams a file to the peer from the event loop."""
+        return asyncio.run_coroutine_threadsafe(self.send_file_async(filepath, is_audio, duration, offer, preview),
+                                                self.loop)
+
+    def _start_file_send(self, filepath, offer):
+        self.send_file(filepath, offer=offer)
+
+    def send_voice_note(self, note):
+        """Streams a voice message from the event loop while it is recorded."""
+        return asyncio.run_coroutine_threadsafe(self.send_voice_note_async(note), self.loop)
+
+    async def send_voice_note_async(self, note):
+        if 'streaming' not in self.peer_features:
+            await self.loop.run_in_executor(None, note.wait)
+            return await self.send_file_async(note.path, True, note.duration)
+        if not self.is_connected:
+            return
+
+        offer = self._make_voice_note_offer(note)
+        transfer_id = offer['id']
+        try:
+            pending = {'event': asyncio.Event(), 'accepted': False, 'have': [],
+                       'credit': None, 'credit_event': asyncio.Event(), 'blocked': False,
+                       'session': self.session_nonce}
+            self.outgoing_transfers[transfer_id] = pending
+            self.send_json('file_offer', offer)
+
+            try:
+                await asyncio.wait_for(pending['event'].wait(), FILE_OFFER_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            if not pending['accepted']:
+                self._file_not_accepted(offer, pending)
+                return
+
+            chunks = self._voice_note_chunks(note)
+            while True:
+                # Waiting for the recorder blocks, so it happens off the loop
+                item = await self.loop.run_in_executor(None, next, chunks, None)
+                if item is None:
+                    break
+                offset, chunk = item
+                if not self.is_connected or not await self._wait_for_credit_async(pending, len(chunk)):
+                    return
+                self._send_file_chunk(transfer_id, offset, chunk, False, PRIORITY_VOICE)
+                await self.writer.drain()
+            self._finish_voice_note(offer, note)
+
+        except (ConnectionResetError, BrokenPipeError):
+            self.handle_disconnect()
+        except Exception as e:
+            if self.is_connected and self.on_message_received:
+                self.on_message_received(f"System: Failed to send voice message: {e}")
+        finally:
+            self.outgoing_transfers.pop(transfer_id, None)
+
+    def _schedule_ack(self):
+        if self.ack_timer is None:
+            self.ack_timer = self.loop.call_later(ACK_DELAY, self._send_ack)
+
+    def _schedule_hello_timeout(self):
+        self._cancel_hello_timeout()
+        self.hello_timer = self.loop.call_later(HELLO_TIMEOUT, self._hello_timed_out, self.session_nonce)
+
+    def _grant_credit(self, pending, credit):
+        # Spent and granted on the loop thread alone
+        pending['credit'] += credit
+        pending['credit_event'].set()
+
+    def _wake_credit_waiter(self, pending):
+        pending['credit_event'].set()
+
+    async def _wait_for_credit_async(self, pending, size) -> bool:
+        """Awaits room for size more bytes of a transfer; see ChatClient._wait_for_credit."""
+        while pending['credit'] is not None:
+            pending['credit_event'].clear()
+            if pending['credit'] >= size or not self.is_connected:
+                break
+            pending['blocked'] = True
+            await pending['credit_event'].wait()
+        pending['blocked'] = False
+        if pending['credit'] is not None:
+            pending['credit'] -= size
+        return self.is_connected
+
+    def flow_stats(self) -> dict:
+        stats = super().flow_stats()
+        stats['write_buffer'] = self.writer.transport.get_write_buffer_size() if self.writer else 0
+        return stats
+
+    async def send_file_async(self, filepath, is_audio=False, duration=None, offer=None, preview=None):
+        if not self.is_connected or not os.path.exists(filepath):
+            return
+        if 'streaming' not in self.peer_features:
+            await self.loop.run_in_executor(None, self._send_file_frame, filepath, is_audio, duration)
+            return
+
+        if offer is None:
+            sha256 = await self.loop.run_in_executor(None, file_sha256, filepath)
+            offer = self._make_file_offer(filepath, is_audio, duration, preview, sha256)
+            self._save_outgoing_journal(offer, filepath)
+            self._announce_preview(offer, filepath)
+        transfer_id = offer['id']
+        filename = offer['name']
+        pending = {'event': asyncio.Event(), 'accepted': False, 'have': [],
+                   'credit': None, 'credit_event': asyncio.Event(), 'blocked': False,
+                   'session': self.session_nonce}
+        self.outgoing_transfers[transfer_id] = pending
+        try:
+            self.send_json('file_offer', offer)
+
+            try:
+                await asyncio.wait_for(pending['event'].wait(), FILE_OFFER_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            if not pending['accepted']:
+                self._file_not_accepted(offer, pending)
+                return
+            if self._peer_has_file(offer, pending, filepath):
+                return
+
+            digest = hashlib.sha256()
+            sent = 0
+            compress = self.is_compressible(filepath)
+            priority = transfer_priority(offer['kind'])
+            with open(filepath, 'rb') as f:
+                while True:
+                    chunk = f.read(FILE_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if not self._transfer_is_current(pending):
+                        return
+                    digest.update(chunk)
+                    if not ranges_cover(pending['have'], sent, len(chunk)):
+                        if not await self._wait_for_credit_async(pending, len(chunk)):
+                            return
+                        self._send_file_chunk(transfer_id, sent, chunk, compress, priority)
+                        # Wait for the socket buffer to drain so memory stays bounded
+                        await self.writer.drain()
+                    sent += len(chunk)
+                    self._report_progress(pending, transfer_id, filename, sent, offer['size'], "send")
+
+            self.send_json('file_end', {'id': transfer_id, 'size': sent, 'sha256': digest.hexdigest()},
+                           transfer_id, priority)
+            self._finish_outgoing_transfer(transfer_id)
+            self._notify_file_sent(offer['kind'], filepath, filename, offer.get('duration'))
+
+        except (ConnectionResetError, BrokenPipeError):
+            if pending['session'] == self.session_nonce:
+                self.handle_disconnect()
+        except Exception as e:
+            # Errors caused by the connection dropping leave the journal for a resume
+            if self._transfer_is_current(pending):
+                self._drop_outgoing_journal(transfer_id)
+                if self.on_message_received:
+                    self.on_message_received(f"System: Failed to send file: {e}")
+        finally:
+            # A resume in a newer session may have taken the entry over
+            if self.outgoing_transfers.get(transfer_id) is pending:
+                del self.outgoing_transfers[transfer_id]
+
+    def handle_disconnect(self):
+        self._call_in_loop(super().handle_disconnect)
+
+    def disconnect(self):
+        """Public method to disconnect the client."""
+        self._call_in_loop(super().disconnect)
+
+    def _close_transport(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+        if self.writer:
+            if self.session_ended:
+                self.writer.close() # Flushes queued frames, the goodbye last
+            else:
+                # The link is gone: a graceful close would leave drain() waiting on it forever
+                self.writer.transport.abort()
+            self.writer = None
+
+    def peer_ip(self):
+        """Returns the IP address of the connected peer."""
+        return self.writer.get_extra_info('peername')[0]
+
+# --- Multi-peer Hub ---
+SESSION_CALLBACKS = (
+    'on_message_received',
+    'on_connection_status',
+    'on_image_received',
+    'on_audio_received',
+    'on_connection_request',
+    'on_call_request',
+    'on_call_status',
+    'on_transfer_progress',
+    'on_image_preview',
+)
+
+class HubSession(AsyncChatClient):
+    """One peer session owned by a ChatHub."""
+    def __init__(self, hub, session_id, key, **kwargs):
+        # Hub peers share one key, so a journaled transfer or queued message could reach the wrong peer
+        kwargs.setdefault('resume_transfers', False)
+        kwargs.setdefault('reliable_delivery', False)
+        super().__init__(key, loop=hub.loop, **kwargs)
+        self.hub = hub
+        self.session_id = session_id
+
+    def _close_transport(self):
+        super()._close_transport()
+        self.hub._forget_session(self.session_id)
+
+class ChatHub:
+    """Serves many concurrent encrypted peer sessions from one listening socket.
+
+    The listener stays open for the lifetime of the hub and every accepted or
+    dialed peer becomes a HubSession on the same event loop, so a single
+    thread handles all of them. Callbacks take the same arguments as
+    ChatClient's, prefixed with the session id they belong to. The hub also
+    reports on_session_opened(session_id, addr) and on_session_closed(session_id).
+    """
+    def __init__(self, key, loop=None, max_sessions=1024, **kwargs):
+        self.key = key
+        self.loop = loop or get_shared_loop()
+        self.max_sessions = max_sessions
+        self.sessions = {}
+        self.server = None
+        self.callbacks = {name: kwargs[name] for name in SESSION_CALLBACKS if kwargs.get(name)}
+        self.on_session_opened = kwargs.get('on_session_opened')
+        self.on_session_closed = kwargs.get('on_session_closed')
+
+    def _new_session(self):
+        session_id = uuid.uuid4().hex
+        callbacks = {name: functools.partial(cb, session_id) for name, cb in self.callbacks.items()}
+        session = HubSession(self, session_id, self.key, **callbacks)
+        self.sessions[session_id] = session
+        return session
+
+    def _forget_session(self, session_id):
+        if self.sessions.pop(session_id, None) and self.on_session_closed:
+            self.on_session_closed(session_id)
+
+    def start(self, host, port):
+        """Starts accepting peers; returns a future that resolves once listening."""
+        return asyncio.run_coroutine_threadsafe(self._start(host, port), self.loop)
+
+    async def _start(self, host, port):
+        self.server = await asyncio.start_server(self._on_incoming, host, port, backlog=128)
+
+    async def _on_incoming(self, reader, writer):
+        if len(self.sessions) >= self.max_sessions:
+            writer.close()
+            return
+        session = self._new_session()
+        addr = writer.get_extra_info('peername')
+        await session._on_incoming(reader, writer)
+        if not session.is_connected:
+            # Rejected by on_connection_request
+            self.sessions.pop(session.session_id, None)
+            return
+        if self.on_session_opened:
+            self.on_session_opened(session.session_id, addr)
+
+    def connect(self, host, port):
+        """Dials a peer as a new session and returns its session id."""
+        session = self._new_session()
+        future = session.connect(host, port)
+        future.add_done_callback(lambda f: self._on_dialed(session, (host, port)))
+        return session.session_id
+
+    def _on_dialed(self, session, addr):
+        if not session.is_connected:
+            self.sessions.pop(session.session_id, None)
+        elif self.on_session_opened:
+            self.on_session_opened(session.session_id, addr)
+
+    def session(self, session_id):
+        """Returns the HubSession for an id, for calls the hub does not wrap."""
+        return self.sessions[session_id]
+
+    def confirm_connection(self, session_id):
+        self.sessions[session_id].confirm_connection()
+
+    def reject_connection(self, session_id):
+        self.sessions[session_id].reject_connection()
+
+    def send_message(self, session_id, message):
+        self.sessions[session_id].send_message(message)
+
+    def send_file(self, session_id, filepath, is_audio=False, duration=None):
+        return self.sessions[session_id].send_file(filepath, is_audio, duration)
+
+    def send_image(self, session_id, filepath):
+        return self.sessions[session_id].send_image(filepath)
+
+    def broadcast(self, message):
+        """Sends a text message to every connected session."""
+        for session in list(self.sessions.values()):
+            if session.is_connected:
+                session.send_message(message)
+
+    def disconnect(self, session_id):
+        self.sessions[session_id].disconnect()
+
+    def stop(self):
+        """Closes the listener and disconnects every session."""
+        def _stop():
+            if self.server:
+                self.server.close()
+                self.server = None
+            for session in list(self.sessions.values()):
+                session.disconnect()
+        self.loop.call_soon_threadsafe(_stop)
+
+# --- Message History ---
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    peer TEXT NOT NULL,
+    ts REAL NOT NULL,
+    sender TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    body TEXT NOT NULL,
+    path TEXT,
+    duration REAL
+);
+CREATE INDEX IF NOT EXISTS messages_peer_ts ON messages(peer, ts, id);
+"""
+HISTORY_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(body, content='messages', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts(rowid, body) VALUES (new.id, new.body);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, body) VALUES ('delete', old.id, old.body);
+END;
+"""
+HISTORY_COLUMNS = "id, peer, ts, sender, kind, body, path, duration"
+
+def history_peer_id(master_key: bytes) -> str:
+    """Names a conversation in the history store.
+
+    Peers have no identity beyond the shared secret, so the conversation is
+    keyed by a fingerprint of it that stays the same across addresses and
+    reconnects but does not reveal the key.
+    """
+    return hmac.new(master_key, b'p2p-history-peer', hashlib.sha256).hexdigest()[:32]
+
+class HistoryStore:
+    """Keeps sent and received messages in a local SQLite database.
+
+    The database runs in WAL mode so the UI can read while messages are
+    written. add() only queues a message; a writer thread stores everything
+    that queued up in one transaction, so a burst of messages costs one
+    commit. Messages are indexed by peer and time for paging, and their text
+    (or file name) is indexed with FTS5 for search when SQLite has it.
+    """
+    def __init__(self, path="history.db"):
+        self.path = path
+        self.local = threading.local() # Reader connection per thread
+        self.queue = queue.Queue()
+        db = self._connect()
+        db.executescript(HISTORY_SCHEMA)
+        try:
+            db.executescript(HISTORY_FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            print("SQLite has no FTS5, history search falls back to a full scan.")
+            self.fts = False
+        db.commit()
+        self.writer = threading.Thread(target=self._write_loop, name='history', daemon=True)
+        self.writer.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL") # Durable enough with WAL and much faster
+        return db
+
+    def _reader(self):
+        if not hasattr(self.local, 'db'):
+            self.local.db = self._connect()
+        return self.local.db
+
+    def add(self, peer, sender, kind, body, path=None, duration=None, ts=None):
+        """Queues a message for storage; returns immediately."""
+        self.queue.put((peer, ts or time.time(), sender, kind, body, path, duration))
+
+    def _write_loop(self):
+        db = self._connect()
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            rows = [item for item in batch if isinstance(item, tuple)]
+            if rows:
+                try:
+                    with db:
+                        db.executemany("INSERT INTO messages (peer, ts, sender, kind, body, path, duration) "
+                                       "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                except sqlite3.Error as e:
+                    print(f"Could not save {len(rows)} messages to history: {e}")
+            for item in batch:
+                if item is None:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    item.set()
+        db.close()
+
+    def flush(self, timeout=None):
+        """Waits until every message queued so far has been written."""
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def page(self, peer, limit=50, before=None) -> list:
+        """Returns up to limit messages with peer in chronological order.
+
+        Without before these are the newest ones; pass the (ts, id) of the
+        oldest message shown to get the page before it.
+        """
+        if before is None:
+            rows = self._reader().execute(
+                f"SELECT {HISTORY_COLUMNS} FROM messages WHERE peer = ? ORDER BY ts DESC, id DESC LIMIT ?",
+                (peer, limit)).fetchall()
+        else:
+            rows = self._reader().execute(
+                f"SELECT {HISTORY_COLUMNS} FROM messages WHERE peer = ? AND (ts, id) < (?, ?) "
+                "ORDER BY ts DESC, id DESC LIMIT ?", (peer, before[0], before[1], limit)).fetchall()
+        return [dict(row) for row in reversed(rows)]
+
+    def search(self, text, peer=None, limit=50) -> list:
+        """Finds messages containing every word of text, newest first."""
+        words = text.split()
+        if not words:
+            return []
+        peer_filter = "AND m.peer = ?" if peer else ""
+        if self.fts:
+            # Quote each word so FTS5 query syntax in user input is matched literally
+            query = " ".join('"' + word.replace('"', '""') + '"' for word in words)
+            sql = ("SELECT m.id, m.peer, m.ts, m.sender, m.kind, m.body, m.path, m.duration "
+                   "FROM messages_fts f JOIN messages m ON m.id = f.rowid "
+                   f"WHERE messages_fts MATCH ? {peer_filter} ORDER BY f.rowid DESC LIMIT ?")
+            params = [query]
+        else:
+            sql = (f"SELECT {HISTORY_COLUMNS} FROM messages m WHERE "
+                   + " AND ".join("instr(lower(m.body), ?) > 0" for _ in words)
+                   + f" {peer_filter} ORDER BY m.id DESC LIMIT ?")
+            params = [word.lower() for word in words]
+        if peer:
+            params.append(peer)
+        params.append(limit)
+        return [dict(row) for row in self._reader().execute(sql, params).fetchall()]
+
+    def close(self):
+        """Writes out the remaining messages and stops the writer thread."""
+        self.queue.put(None)
+        self.writer.join()
+
+# --- Thumbnails ---
+THUMBNAIL_SIZE = (250, 250)
+THUMBNAIL_WORKERS = 2
+THUMBNAIL_MEMORY_ITEMS = 128 # Decoded thumbnails kept in memory
+THUMBNAIL_CACHE_DIR = os.path.join("downloads", ".thumbnails")
+
+class ThumbnailService:
+    """Decodes and shrinks chat images on worker threads.
+
+    Thumbnails are keyed by the sha256 of the image file, so a picture that
+    was received twice, or moved, is only decoded once. Results are kept in
+    an in-memory LRU and as PNGs in cache_dir, which makes scrolling back to
+    an image or reopening the app cheap. JPEGs are decoded in draft mode,
+    letting libjpeg scale them down by up to 8x while decoding.
+    """
+    def __init__(self, cache_dir=THUMBNAIL_CACHE_DIR, size=THUMBNAIL_SIZE, workers=THUMBNAIL_WORKERS,
+                 memory_items=THUMBNAIL_MEMORY_ITEMS):
+        self.cache_dir = cache_dir
+        self.size = size
+        self.memory_items = memory_items
+        self.memory = OrderedDict()  # Content hash -> PIL image
+        self.digests = OrderedDict() # (path, size, mtime_ns) -> content hash
+        self.pending = {}            # Path -> Future, so concurrent requests share one decode
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnail')
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _file_key(self, path):
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+    def get(self, path):
+        """Returns the thumbnail for path if it is in memory, without blocking on disk or decoding."""
+        try:
+            key = self._file_key(path)
+        except OSError:
+            return None
+        with self.lock:
+            digest = self.digests.get(key)
+            if digest in self.memory:
+                self.memory.move_to_end(digest)
+                return self.memory[digest]
+        return None
+
+    def request(self, path, callback) -> Future:
+        """Loads the thumbnail for path in the background.
+
+        callback(path, image) runs on a worker thread; image is None when the
+        file cannot be read as an image.
+        """
+        with self.lock:
+            future = self.pending.get(path)
+            if future is None:
+                future = self.executor.submit(self._load, path)
+                self.pending[path] = future
+        future.add_done_callback(lambda f: callback(path, f.result()))
+        return future
+
+    def _load(self, path):
+        try:
+            key = self._file_key(path)
+            with self.lock:
+                digest = self.digests.get(key)
+            if digest is None:
+                digest = file_sha256(path)
+            with self.lock:
+                self._remember(self.digests, key, digest, self.memory_items * 4)
+                image = self.memory.get(digest)
+            if image is None:
+                image = self._read_cached(digest) or self._decode(path, digest)
+                with self.lock:
+                    self._remember(self.memory, digest, image, self.memory_items)
+            return image
+        except Exception as e:
+            print(f"Could not make a thumbnail of {path}: {e}")
+            return None
+        finally:
+            with self.lock:
+                self.pending.pop(path, None)
+
+    @staticmethod
+    def _remember(cache, key, value, limit):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > limit:
+            cache.popitem(last=False)
+
+    def _read_cached(self, digest):
+        try:
+            with Image.open(os.path.join(self.cache_dir, digest + ".png")) as cached:
+                cached.load()
+                return cached.copy()
+        except (OSError, ValueError):
+            return None
+
+    def _decode(self, path, digest):
+        with Image.open(path) as image:
+            if image.format == "JPEG":
+                image.draft("RGB", self.size) # Picks the smallest DCT scale that is still >= size
+            image.thumbnail(self.size, Image.Resampling.LANCZOS)
+            thumbnail = image.copy() if image.mode in ("RGB", "RGBA", "L", "LA", "P") else image.convert("RGB")
+        cache_path = os.path.join(self.cache_dir, digest + ".png")
+        try:
+            # Write under another name first so a reader never sees half a file
+            thumbnail.save(cache_path + ".tmp", "PNG")
+            os.replace(cache_path + ".tmp", cache_path)
+        except (OSError, ValueError) as e:
+            print(f"Could not cache thumbnail for {path}: {e}")
+        return thumbnail
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+# --- Image Sending ---
+IMAGE_SEND_BUDGET = 1536 * 1024 # Images larger than this are re-encoded before sending
+IMAGE_MAX_DIMENSION = 2560      # Longest side of a re-encoded image
+IMAGE_QUALITY = 85              # Starting JPEG/WebP quality, lowered until the budget is met
+IMAGE_MIN_QUALITY = 50
+IMAGE_PREVIEW_SIZE = (160, 160)
+IMAGE_PREVIEW_QUALITY = 60      # Previews travel inside the offer, so they are kept to a few KB
+IMAGE_TRANSCODE_WORKERS = 2
+
+class ImageTranscoder:
+    """Prepares images for sending on a worker pool.
+
+    Every image gets a small JPEG preview that is sent inside the file offer,
+    so the peer can show it before any of the file has arrived. Images over
+    the size budget, such as full resolution screenshots, are scaled down to
+    max_dimension and re-encoded: JPEG for opaque images and WebP (or PNG
+    without WebP support) for ones with transparency, lowering the quality
+    and then the size until the result fits. Smaller images and animated
+    GIFs are sent unchanged. Re-encoded files are named after the source's
+    sha256 and the settings, so sending the same image again reuses the file.
+    """
+    def __init__(self, budget=IMAGE_SEND_BUDGET, quality=IMAGE_QUALITY, max_dimension=IMAGE_MAX_DIMENSION,
+                 workers=IMAGE_TRANSCODE_WORKERS):
+        self.budget = budget
+        self.quality = quality
+        self.max_dimension = max_dimension
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='transcode')
+
+    def submit(self, filepath, out_dir) -> Future:
+        """Starts preparing filepath; the future gives (path to send, preview JPEG bytes or None)."""
+        return self.executor.submit(self.prepare, filepath, out_dir)
+
+    def prepare(self, filepath, out_dir):
+        with Image.open(filepath) as image:
+            image.load()
+            preview = self.make_preview(image)
+            if (os.path.getsize(filepath) <= self.budget and max(image.size) <= self.max_dimension) \
+                    or getattr(image, 'is_animated', False):
+                return filepath, preview
+            return self._transcode(image, filepath, out_dir), preview
+
+    def make_preview(self, image) -> bytes:
+        preview = image.convert("RGB")
+        preview.thumbnail(IMAGE_PREVIEW_SIZE, Image.Resampling.LANCZOS)
+        data = io.BytesIO()
+        preview.save(data, "JPEG", quality=IMAGE_PREVIEW_QUALITY, optimize=True)
+        return data.getvalue()
+
+    def _transcode(self, image, filepath, out_dir):
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        if has_alpha:
+            fmt, ext = ("WEBP", ".webp") if features.check("webp") else ("PNG", ".png")
+        else:
+            fmt, ext = "JPEG", ".jpg"
+        key = hashlib.sha256(f"{file_sha256(filepath)}:{fmt}:{self.budget}:{self.quality}:{self.max_dimension}".encode())
+        stem = os.path.splitext(os.path.basename(filepath))[0]
+        out_path = os.path.join(out_dir, f"{stem}_{key.hexdigest()[:16]}{ext}")
+        if os.path.exists(out_path):
+            return out_path
+
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        image.thumbnail((self.max_dimension, self.max_dimension), Image.Resampling.LANCZOS)
+
+        quality = self.quality
+        while True:
+            data = io.BytesIO()
+            if fmt == "PNG":
+                image.save(data, fmt, optimize=True)
+            else:
+                image.save(data, fmt, quality=quality)
+            if data.tell() <= self.budget or max(image.size) <= IMAGE_PREVIEW_SIZE[0]:
+                break
+            if fmt != "PNG" and quality > IMAGE_MIN_QUALITY:
+                quality = max(quality - 10, IMAGE_MIN_QUALITY)
+            else:
+                image = image.resize((max(image.width * 3 // 4, 1), max(image.height * 3 // 4, 1)),
+                                     Image.Resampling.LANCZOS)
+
+        os.makedirs(out_dir, exist_ok=True)
+        # Written under another name first, so a concurrent or interrupted send never sees half a file
+        tmp_path = f"{out_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data.getbuffer())
+        os.replace(tmp_path, out_path)
+        return out_path
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+_shared_transcoder = None
+_shared_transcoder_lock = threading.Lock()
+
+def get_shared_transcoder() -> ImageTranscoder:
+    """Returns the process-wide ImageTranscoder, used by every client not given its own."""
+    global _shared_transcoder
+    with _shared_transcoder_lock:
+        if _shared_transcoder is None:
+            _shared_transcoder = ImageTranscoder()
+        return _shared_transcoder
+
 # --- Voice Recorder ---
+VOICE_NOTE_RATE = 22050
+VOICE_NOTE_BLOCK = 512 # Bytes per IMA ADPCM block, the WAV nBlockAlign
+VOICE_NOTE_BLOCK_SAMPLES = ImaAdpcmCodec.block_samples(VOICE_NOTE_BLOCK)
+WAVE_FORMAT_IMA_ADPCM = 0x0011
+
+class VoiceNote:
+    """A voice message being recorded into an IMA ADPCM WAV file.
+
+    Each block is written to disk as soon as it is encoded, so memory use
+    does not grow with the length of the note and a transfer can send the
+    start of the file while the rest is still being recorded. The lengths
+    in the header are only filled in by finish().
+    """
+    def __init__(self, path, rate=VOICE_NOTE_RATE):
+        self.path = path
+        self.rate = rate
+        self.samples = 0
+        self.data_size = 0
+        self.done = False
+        self.changed = threading.Condition()
+        self.file = open(path, 'wb')
+        self.file.write(self.header())
+        self.size = self.file.tell() # Bytes on disk that readers may use
+
+    def header(self) -> bytes:
+        fmt = struct.pack('<HHIIHHHH', WAVE_FORMAT_IMA_ADPCM, 1, self.rate,
+                          self.rate * VOICE_NOTE_BLOCK // VOICE_NOTE_BLOCK_SAMPLES,
+                          VOICE_NOTE_BLOCK, 4, 2, VOICE_NOTE_BLOCK_SAMPLES)
+        riff_size = 4 + 8 + len(fmt) + 12 + 8 + self.data_size
+        return (b'RIFF' + struct.pack('<I', riff_size) + b'WAVE'
+                + b'fmt ' + struct.pack('<I', len(fmt)) + fmt
+                + b'fact' + struct.pack('<II', 4, self.samples)
+                + b'data' + struct.pack('<I', self.data_size))
+
+    @property
+    def duration(self) -> float:
+        return self.samples / self.rate
+
+    def append(self, block: bytes, samples: int):
+        with self.changed:
+            if self.done:
+                return # A block read after the recording was stopped
+            self.file.write(block)
+            self.file.flush()
+            self.samples += samples
+            self.data_size += len(block)
+            self.size += len(block)
+            self.changed.notify_all()
+
+    def finish(self):
+        """Writes the final header and closes the file."""
+        with self.changed:
+            self.file.seek(0)
+            self.file.write(self.header())
+            self.file.close()
+            self.done = True
+            self.changed.notify_all()
+
+    def wait(self, size=None, timeout=None) -> int:
+        """Waits until size bytes are on disk (or the note is finished) and returns the bytes available."""
+        with self.changed:
+            self.changed.wait_for(lambda: self.done or (size is not None and self.size >= size), timeout)
+            return self.size
+
 class VoiceRecorder:
-    def __init__(self):
-        self.p = pyaudio.PyAudio()
+    """Records voice messages straight to disk as IMA ADPCM, a quarter of the size of PCM."""
+    def __init__(self, audio_backend=None, directory="downloads"):
+        self.audio_backend = audio_backend or default_audio_backend()
+        self.directory = directory
         self.stream = None
-        self.frames = []
+        self.note = None
+        self.thread = None
         self.is_recording = False
-        self.start_time = 0
 
-    def start_recording(self):
+    def start_recording(self) -> VoiceNote:
+        """Starts recording and returns the note, which can be sent while it grows."""
         if self.is_recording:
-            return
+            return self.note
+        os.makedirs(self.directory, exist_ok=True)
+        # The device first: if it cannot be opened there is no file to clean up
+        stream = self.audio_backend.open(channels=1,
+                                         rate=VOICE_NOTE_RATE,
+                                         input=True,
+                                         frames_per_buffer=VOICE_NOTE_BLOCK_SAMPLES)
+        try:
+            self.note = VoiceNote(os.path.join(self.directory, f"voice_message_{int(time.time())}.wav"))
+        except OSError:
+            stream.close()
+            raise
+        self.stream = stream
         self.is_recording = True
-        self.frames = []
-        self.stream = self.p.open(format=pyaudio.paInt16,
-                                  channels=1,
-                                  rate=44100,
-                                  input=True,
-                                  frames_per_buffer=1024)
-        self.start_time = time.time()
-        threading.Thread(target=self._record_loop, daemon=True).start()
-
-    def _record_loop(self):
+        self.thread = threading.Thread(target=self._record_loop, args=(self.stream, self.note), daemon=True)
+        self.thread.start()
+        return self.note
+
+    def _record_loop(self, stream, note):
+        codec = ImaAdpcmCodec()
+        block_bytes = VOICE_NOTE_BLOCK_SAMPLES * SAMPLE_WIDTH
         while self.is_recording:
             try:
-                data = self.stream.read(1024)
-                self.frames.append(data)
+                data = stream.read(VOICE_NOTE_BLOCK_SAMPLES)
             except IOError: # Stream closed
                 break
+            # Every block but the last is full; pad that one with silence
+            note.append(codec.encode(data.ljust(block_bytes, b'\0')), len(data) // SAMPLE_WIDTH)
     
     def stop_recording(self) -> (str, float):
         if not self.is_recording:
             return None, 0
         self.is_recording = False
-        duration = time.time() - self.start_time
-        
+        # The loop ends after the block being read, which takes a few tens of milliseconds;
+        # should the device hang, finish() makes the note ignore whatever it still reads
+        self.thread.join(timeout=1)
         self.stream.stop_stream()
         self.stream.close()
-        
-        filepath = f"voice_message_{int(time.time())}.wav"
-        with wave.open(filepath, 'wb') as wf:
-            wf.setnchannels(1)
-            wf.setsampwidth(self.p.get_sample_size(pyaudio.paInt16))
-            wf.setframerate(44100)
-            wf.writeframes(b''.join(self.frames))
-            
-        return filepath, duration
+        self.note.finish()
+        return self.note.path, self.note.duration
 
     def terminate(self):
-        self.p.terminate()
\ No newline at end of file
+        self.audio_backend.terminate()
\ No newline at end of file
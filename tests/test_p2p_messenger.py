@@ -0,0 +1,296 @@
+import hashlib
+import os
+import random
+import threading
+import time
+
+import numpy as np
+import pytest
+from cryptography.exceptions import InvalidTag
+from PIL import Image
+
+from p2p_messenger import (FRAME_CHUNK, FRAME_JSON, PRIORITY_BULK, PRIORITY_CONTROL,
+                           PRIORITY_TEXT, PRIORITY_VOICE, PRIORITY_WEIGHTS, ContentStore, CryptoPipeline,
+                           FrameCipher, ImaAdpcmCodec, ImageTranscoder, MediaCipher, Outbox, SendScheduler,
+                           clamped_cumsum)
+
+
+# --- Outbox ---
+def test_outbox_survives_reopen(tmp_path):
+    path = str(tmp_path / "peer.log")
+    outbox = Outbox(path)
+    assert [outbox.add('text', m) for m in ("a", "b", "c")] == [1, 2, 3]
+    outbox.ack(2)
+    outbox.close()
+
+    reopened = Outbox(path)
+    assert reopened.epoch == outbox.epoch
+    assert reopened.pending == [(3, 'text', "c")]
+    assert reopened.add('text', "d") == 4
+
+
+def test_outbox_compacts_and_keeps_newest(tmp_path):
+    path = str(tmp_path / "peer.log")
+    outbox = Outbox(path, limit=3)
+    for i in range(10):
+        outbox.add('text', str(i))
+    assert [entry[2] for entry in outbox.pending] == ["7", "8", "9"]
+    outbox.close()
+    with open(path) as f:
+        assert len(f.readlines()) <= 4 # A snapshot and at most limit records after it
+    assert Outbox(path, limit=3).pending == outbox.pending
+
+
+def test_outbox_filters_replayed_messages(tmp_path):
+    path = str(tmp_path / "peer.log")
+    outbox = Outbox(path)
+    outbox.greet("peer-epoch")
+    assert outbox.receive(1) and outbox.receive(2)
+    assert not outbox.receive(2)
+    outbox.close()
+
+    reopened = Outbox(path)
+    assert reopened.cursor() == {'epoch': "peer-epoch", 'seq': 2}
+    assert not reopened.receive(1)
+    reopened.greet("new-epoch") # The peer lost its outbox and counts from 1 again
+    assert reopened.receive(1)
+
+
+def test_outbox_take_empties_it(tmp_path):
+    outbox = Outbox(str(tmp_path / "peer.log"))
+    outbox.add('text', "a")
+    outbox.add('text', "b")
+    assert [entry[2] for entry in outbox.take()] == ["a", "b"]
+    assert outbox.pending == [] and outbox.take() == []
+
+
+# --- Frame ciphers ---
+@pytest.mark.parametrize("name", ['aesgcm', 'chacha20'])
+def test_frame_cipher_round_trip(name):
+    key = os.urandom(32)
+    sender, receiver = FrameCipher(name, key), FrameCipher(name, key)
+    frames = [sender.seal(FRAME_JSON, b"message %d" % i) for i in range(3)]
+    assert [receiver.open(frame) for frame in frames] == [(FRAME_JSON, b"message %d" % i) for i in range(3)]
+
+
+def test_frame_cipher_rejects_reordered_and_tampered_frames():
+    key = os.urandom(32)
+    sender = FrameCipher('aesgcm', key)
+    first, second = sender.seal(FRAME_JSON, b"one"), sender.seal(FRAME_JSON, b"two")
+    with pytest.raises(InvalidTag):
+        FrameCipher('aesgcm', key).open(second)
+    tampered = bytearray(first)
+    tampered[-1] ^= 1
+    with pytest.raises(InvalidTag):
+        FrameCipher('aesgcm', key).open(bytes(tampered))
+
+
+def test_frame_cipher_opens_reserved_sequence_numbers_in_any_order():
+    key = os.urandom(32)
+    sender, receiver = FrameCipher('chacha20', key), FrameCipher('chacha20', key)
+    frames = [sender.seal(FRAME_CHUNK, b"chunk %d" % i) for i in range(4)]
+    seqs = [receiver.reserve() for _ in frames]
+    for i in (2, 0, 3, 1):
+        assert receiver.open(frames[i], seqs[i]) == (FRAME_CHUNK, b"chunk %d" % i)
+
+
+def test_media_cipher_replay_window():
+    send_key, recv_key = os.urandom(16), os.urandom(16)
+    sender, receiver = MediaCipher(send_key, recv_key), MediaCipher(recv_key, send_key)
+    packets = {seq: sender.protect(seq, seq * 160, b"audio %d" % seq) for seq in range(50, 200)}
+
+    assert receiver.unprotect(packets[150])[2] == b"audio 150"
+    assert receiver.unprotect(packets[140])[0] == 140 # Late but inside the window
+    for seq in (150, 140):
+        with pytest.raises(InvalidTag):
+            receiver.unprotect(packets[seq])
+    with pytest.raises(InvalidTag):
+        receiver.unprotect(packets[150 - MediaCipher.WINDOW]) # Too old to tell apart from a replay
+    assert receiver.replayed == 3
+
+    forged = bytearray(packets[160])
+    forged[-1] ^= 1
+    with pytest.raises(InvalidTag):
+        receiver.unprotect(bytes(forged))
+    assert receiver.highest == 150 # Only authenticated packets move the window
+    assert receiver.unprotect(packets[160])[0] == 160
+
+
+# --- Send path ---
+def test_crypto_pipeline_delivers_in_submission_order():
+    delivered, done = [], threading.Event()
+
+    def job(i):
+        time.sleep(random.random() / 200)
+        return i
+
+    def deliver(i):
+        delivered.append(i)
+        if i == 199:
+            done.set()
+
+    pipeline = CryptoPipeline(4, deliver, lambda e: False)
+    for i in range(200):
+        pipeline.submit(job, i)
+    assert done.wait(10)
+    pipeline.close()
+    assert delivered == list(range(200))
+
+
+def test_crypto_pipeline_reports_job_errors():
+    errors = []
+
+    def job(i):
+        if i == 3:
+            raise ValueError("bad frame")
+        return i
+
+    delivered = []
+    pipeline = CryptoPipeline(2, delivered.append, lambda e: errors.append(e) or True)
+    for i in range(6):
+        pipeline.submit(job, i)
+    pipeline.close(timeout=5)
+    assert delivered == [0, 1, 2, 4, 5]
+    assert [str(e) for e in errors] == ["bad frame"]
+
+
+def test_send_scheduler_orders_by_priority():
+    written, gate = [], threading.Event()
+
+    def write(data, frame_type, stream):
+        gate.wait()
+        written.append(data)
+
+    scheduler = SendScheduler(write, lambda e: None)
+    scheduler.put((b"first", FRAME_JSON, 'json'), PRIORITY_CONTROL, 'json')
+    while not scheduler.busy:
+        time.sleep(0.001)
+    # Queued while the first frame is being written
+    for i in range(6):
+        scheduler.put((b"bulk %d" % i, FRAME_CHUNK, 'bulk'), PRIORITY_BULK, 'bulk')
+        scheduler.put((b"voice %d" % i, FRAME_CHUNK, 'voice'), PRIORITY_VOICE, 'voice')
+    scheduler.put((b"text", FRAME_JSON, 'json'), PRIORITY_TEXT, 'json')
+    scheduler.put((b"control", FRAME_JSON, 'json'), PRIORITY_CONTROL, 'json')
+    gate.set()
+    scheduler.close(timeout=5)
+
+    assert written[:3] == [b"first", b"control", b"text"]
+    transfers = written[3:]
+    assert [d for d in transfers if d.startswith(b"bulk")] == [b"bulk %d" % i for i in range(6)]
+    assert [d for d in transfers if d.startswith(b"voice")] == [b"voice %d" % i for i in range(6)]
+    # Each round gives the classes their PRIORITY_WEIGHTS share of the link
+    first_round = transfers[:PRIORITY_WEIGHTS[PRIORITY_VOICE] + PRIORITY_WEIGHTS[PRIORITY_BULK]]
+    assert sum(d.startswith(b"voice") for d in first_round) == PRIORITY_WEIGHTS[PRIORITY_VOICE]
+
+
+def test_send_scheduler_ignores_write_errors_after_close():
+    errors, gate = [], threading.Event()
+
+    def write(data, frame_type, stream):
+        gate.wait()
+        raise BrokenPipeError()
+
+    scheduler = SendScheduler(write, errors.append)
+    scheduler.put((b"frame", FRAME_JSON, 'json'), PRIORITY_CONTROL, 'json')
+    while not scheduler.busy:
+        time.sleep(0.001)
+    scheduler.close()
+    gate.set()
+    scheduler.thread.join(5)
+    assert errors == []
+    with pytest.raises(BrokenPipeError):
+        scheduler.put((b"late", FRAME_JSON, 'json'), PRIORITY_CONTROL, 'json')
+
+
+# --- Content store ---
+def _stored(store, tmp_path, name, data):
+    part = tmp_path / (name + ".part")
+    part.write_bytes(data)
+    digest = hashlib.sha256(data).hexdigest()
+    return digest, store.add(str(part), digest, store.destination(name, digest))
+
+
+def test_content_store_keeps_one_copy_per_content(tmp_path):
+    root = tmp_path / "downloads"
+    root.mkdir()
+    store = ContentStore(str(root))
+    digest, path = _stored(store, tmp_path, "a.bin", b"x" * 1000)
+    assert path == str(root / "a.bin")
+    assert store.has(digest, 1000) and not store.has(digest, 999)
+
+    # The same content under the same name is not saved again
+    assert store.destination("a.bin", digest) == path
+    # Different content never overwrites an existing name
+    other, other_path = _stored(store, tmp_path, "a.bin", b"y" * 1000)
+    assert other_path == str(root / "a (1).bin")
+    assert os.path.samefile(path, store.blob_path(digest))
+
+    # A fresh store reads the index back
+    assert ContentStore(str(root)).has(other, 1000)
+
+
+def test_content_store_forgets_blobs_changed_in_place(tmp_path):
+    root = tmp_path / "downloads"
+    root.mkdir()
+    store = ContentStore(str(root))
+    digest, path = _stored(store, tmp_path, "doc.txt", b"original")
+    time.sleep(0.01)
+    with open(path, 'ab') as f:
+        f.write(b" edited")
+    assert not store.has(digest)
+
+
+def test_content_store_reserves_names_of_transfers_in_progress(tmp_path):
+    store = ContentStore(str(tmp_path))
+    first, second = store.destination("same.bin"), store.destination("same.bin")
+    assert first != second
+    store.release(first)
+    assert store.destination("same.bin") == first
+
+
+# --- Image transcoding ---
+def test_transcoded_image_is_reused(tmp_path):
+    source = tmp_path / "photo.png"
+    Image.fromarray((np.random.default_rng(0).random((600, 800, 3)) * 255).astype('uint8')).save(source)
+    out_dir = tmp_path / "sent"
+    transcoder = ImageTranscoder(budget=50_000, max_dimension=400)
+    try:
+        path, preview = transcoder.prepare(str(source), str(out_dir))
+        assert path != str(source) and os.path.getsize(path) <= 50_000 and preview
+        mtime = os.stat(path).st_mtime_ns
+        assert transcoder.prepare(str(source), str(out_dir))[0] == path
+        assert os.stat(path).st_mtime_ns == mtime and os.listdir(out_dir) == [os.path.basename(path)]
+        # Other settings give another file
+        assert ImageTranscoder(budget=50_000, max_dimension=300).prepare(str(source), str(out_dir))[0] != path
+    finally:
+        transcoder.close()
+
+
+# --- Voice codecs ---
+def _clamped_cumsum_reference(start, deltas, lo, hi):
+    out, value = [], start
+    for delta in deltas:
+        value = min(max(value + delta, lo), hi)
+        out.append(value)
+    return out
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_clamped_cumsum_matches_loop(seed):
+    rng = np.random.default_rng(seed)
+    deltas = rng.integers(-3000, 3000, 2000)
+    for start in (-32768, 0, 32767):
+        expected = _clamped_cumsum_reference(start, deltas.tolist(), -32768, 32767)
+        assert clamped_cumsum(start, deltas, -32768, 32767).tolist() == expected
+    # Tight bounds hit both ends all the time
+    assert clamped_cumsum(0, deltas, 0, 88).tolist() == _clamped_cumsum_reference(0, deltas.tolist(), 0, 88)
+
+
+def test_adpcm_round_trip():
+    codec = ImaAdpcmCodec()
+    t = np.arange(codec.frame_size)
+    pcm = (8000 * np.sin(2 * np.pi * 440 * t / codec.rate)).astype('<i2')
+    decoded = np.frombuffer(codec.decode(codec.encode(pcm.tobytes())), dtype='<i2')
+    assert len(decoded) == len(pcm)
+    assert np.abs(decoded.astype(int) - pcm).mean() < 200
+
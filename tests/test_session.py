@@ -0,0 +1,93 @@
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from p2p_messenger import FLOW_WINDOW, AsyncChatClient, ChatClient, derive_key
+
+KEY = derive_key("test password", b'p2p_chat_salt_')
+
+
+def wait_for(predicate, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(params=[ChatClient, AsyncChatClient], ids=['threads', 'asyncio'])
+def pair(request, tmp_path, monkeypatch):
+    """A listening client and a client connected to it over loopback, with the events each has seen."""
+    monkeypatch.chdir(tmp_path)
+    events = {'listener': [], 'dialer': []}
+
+    def make(name):
+        client = request.param(KEY, crypto_workers=4,
+                               on_message_received=lambda m, s="Peer": events[name].append((s, m)),
+                               on_connection_status=lambda status, is_connected: None)
+        client.downloads_dir = str(tmp_path / name)
+        os.makedirs(client.downloads_dir)
+        return client
+
+    listener, dialer = make('listener'), make('dialer')
+    listener.on_connection_request = lambda addr: listener.confirm_connection()
+    port = free_port()
+    threading.Thread(target=listener.listen, args=('127.0.0.1', port), daemon=True).start()
+    time.sleep(0.2)
+    dialer.connect('127.0.0.1', port)
+    assert wait_for(lambda: listener.wire_version == 2 and dialer.wire_version == 2)
+    yield listener, dialer, events
+    dialer.disconnect()
+    listener.stop_listening()
+
+
+def test_messages_arrive_once_in_order(pair):
+    listener, dialer, events = pair
+    for i in range(20):
+        dialer.send_message(f"message {i}")
+    listener.send_message("reply")
+    assert wait_for(lambda: len([e for e in events['listener'] if e[0] == "Peer"]) == 20)
+    assert [m for s, m in events['listener'] if s == "Peer"] == [f"message {i}" for i in range(20)]
+    assert wait_for(lambda: ("Peer", "reply") in events['dialer'])
+    # Every message was acknowledged, so nothing is left to replay
+    assert wait_for(lambda: not dialer.outbox.pending and not listener.outbox.pending)
+
+
+def test_file_larger_than_flow_window(pair, tmp_path):
+    listener, dialer, events = pair
+    data = os.urandom(FLOW_WINDOW * 2 + 12345)
+    source = tmp_path / "big.bin"
+    source.write_bytes(data)
+    result = dialer.send_file(str(source))
+    if hasattr(result, 'result'):
+        result.result(30)
+    received = os.path.join(listener.downloads_dir, "big.bin")
+    assert wait_for(lambda: os.path.exists(received))
+    with open(received, 'rb') as f:
+        assert f.read() == data
+    assert ("Peer", "You sent file: big.bin") in events['dialer']
+    # The sender's journal goes once the receiver confirms the file
+    assert wait_for(lambda: not os.listdir(dialer._outgoing_journal_path()))
+
+
+def test_resent_file_does_not_travel_again(pair, tmp_path):
+    listener, dialer, events = pair
+    source = tmp_path / "doc.bin"
+    source.write_bytes(os.urandom(300_000))
+    for count in (1, 2):
+        result = dialer.send_file(str(source))
+        if hasattr(result, 'result'):
+            result.result(30)
+        assert wait_for(lambda: len([m for s, m in events['listener'] if "'doc.bin' received" in m]) == count)
+    # The second offer was answered from the content store under the same name
+    assert sorted(os.listdir(listener.downloads_dir)) == ['.outbox', '.store', '.transfers', 'doc.bin']
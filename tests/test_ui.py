@@ -0,0 +1,44 @@
+import bisect
+import itertools
+import random
+
+import pytest
+
+from ui import HeightIndex
+
+
+def _check(index, heights):
+    assert len(index) == len(heights)
+    assert [index[i] for i in range(len(heights))] == heights
+    offsets = [0] + list(itertools.accumulate(heights))
+    assert [index.offset(i) for i in range(len(heights) + 1)] == offsets
+    assert index.total() == offsets[-1]
+    for y in range(0, offsets[-1] + 5, 7):
+        assert index.find(y) == min(bisect.bisect_right(offsets, y) - 1, len(heights))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_height_index_matches_list(seed):
+    rng = random.Random(seed)
+    index, heights = HeightIndex(), []
+    for _ in range(60):
+        action = rng.random()
+        if action < 0.4:
+            height = rng.randint(1, 300)
+            index.append(height)
+            heights.append(height)
+        elif action < 0.7:
+            page = [rng.randint(1, 300) for _ in range(rng.randint(1, 5))]
+            index.prepend(page)
+            heights[:0] = page
+        elif heights:
+            i, height = rng.randrange(len(heights)), rng.randint(1, 300)
+            index.set(i, height)
+            heights[i] = height
+        _check(index, heights)
+
+
+def test_height_index_empty():
+    index = HeightIndex()
+    assert len(index) == 0 and index.total() == 0
+    assert index.find(0) == 0 and index.offset(0) == 0
@@ -1,23 +1,422 @@
+import sys
 import customtkinter as ctk
 import tkinter as tk
 import threading
+import queue
 from tkinter import filedialog, font
 import os
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image, ImageGrab, ImageTk
 from playsound import playsound
 
 # Import logic from the other file
-from p2p_messenger import ChatClient, derive_key, VoiceRecorder
+from p2p_messenger import (ChatClient, AsyncChatClient, KeyDerivationService, VoiceRecorder, HistoryStore,
+                           ThumbnailService, ReconnectSupervisor)
+
+SALT = b'p2p_chat_salt_'
+HISTORY_PAGE_SIZE = 30 # Messages loaded from history when a chat opens
+UI_FRAME_MS = 16       # Queued UI updates are applied at most once per frame
+
+# --- Virtualized Message List ---
+YOUR_BUBBLE_COLOR = "#005c4b"
+PEER_BUBBLE_COLOR = "#2b3033"
+BUBBLE_WRAP = 250        # Text wrap width inside a bubble
+ROW_PADDING = 6          # Vertical gap below every row
+OVERSCAN = 400           # Pixels drawn above and below the visible area
+POOL_LIMIT = 50          # Spare widgets kept per row kind
+THUMBNAIL_CACHE = 64     # CTkImages kept around for rows scrolling back in
+# Height guesses for rows that were never drawn; replaced once measured
+ESTIMATED_HEIGHTS = {'system': 28, 'text': 40, 'image': 270, 'audio': 46}
+
+class FenwickTree:
+    """Prefix sums over a list that only grows at the end."""
+    def __init__(self):
+        self.values = []
+        self.tree = [0]
+
+    def __len__(self):
+        return len(self.values)
+
+    def append(self, value):
+        self.values.append(value)
+        n = len(self.values)
+        # tree[n] covers the values after n - lowbit(n), up to and including n
+        total, k, low = value, n - 1, n - (n & -n)
+        while k > low:
+            total += self.tree[k]
+            k -= k & -k
+        self.tree.append(total)
+
+    def set(self, index, value):
+        delta = value - self.values[index]
+        self.values[index] = value
+        i = index + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix(self, count):
+        """Sum of the first count values."""
+        total = 0
+        while count > 0:
+            total += self.tree[count]
+            count -= count & -count
+        return total
+
+    def find(self, y, strict=False):
+        """Largest count whose prefix sum is <= y (< y if strict)."""
+        index, bit = 0, 1 << len(self.values).bit_length()
+        while bit:
+            nxt = index + bit
+            if nxt < len(self.tree) and (self.tree[nxt] < y if strict else self.tree[nxt] <= y):
+                index = nxt
+                y -= self.tree[nxt]
+            bit >>= 1
+        return index
+
+class HeightIndex:
+    """Row heights with prefix sums kept in Fenwick trees.
+
+    Finding the row at a scroll offset, the offset of a row and changing one
+    height are all O(log n), so a 100k row list stays cheap to lay out.
+    Rows added at the top go into a second tree in reverse order, so
+    loading older history is as cheap as appending.
+    """
+    def __init__(self):
+        self.front = FenwickTree() # Prepended rows, nearest to the original first row first
+        self.back = FenwickTree()
+
+    def __len__(self):
+        return len(self.front) + len(self.back)
+
+    def __getitem__(self, index):
+        if index < len(self.front):
+            return self.front.values[len(self.front) - 1 - index]
+        return self.back.values[index - len(self.front)]
+
+    def append(self, height):
+        self.back.append(height)
+
+    def prepend(self, heights):
+        for height in reversed(list(heights)):
+            self.front.append(height)
+
+    def set(self, index, height):
+        if index < len(self.front):
+            self.front.set(len(self.front) - 1 - index, height)
+        else:
+            self.back.set(index - len(self.front), height)
+
+    def offset(self, index):
+        """Total height of the rows before index."""
+        front = len(self.front)
+        if index <= front:
+            return self.front.prefix(front) - self.front.prefix(front - index)
+        return self.front.prefix(front) + self.back.prefix(index - front)
+
+    def total(self):
+        return self.front.prefix(len(self.front)) + self.back.prefix(len(self.back))
+
+    def find(self, y):
+        """Index of the row covering offset y (len(self) if y is past the end)."""
+        above = self.front.prefix(len(self.front))
+        if y >= above:
+            return len(self.front) + self.back.find(y - above)
+        # Measured upwards from the first appended row, the row covering y is the
+        # first whose running height from there exceeds above - y
+        return len(self.front) - 1 - self.front.find(above - y, strict=True)
+
+class MessageListView(ctk.CTkFrame):
+    """Chat transcript that only creates widgets for the rows on screen.
+
+    Messages are kept as plain dicts in self.rows. The rows inside the
+    visible area (plus OVERSCAN) are drawn on a canvas with bubble widgets
+    taken from a pool per row kind and handed back when they scroll away, so
+    100k messages cost no more widgets than a screenful. Row heights start
+    out as estimates and are measured the first time a row is drawn.
+    on_reach_top is called when the view is scrolled to the very top.
+    """
+    def __init__(self, master, app, on_reach_top=None, **kwargs):
+        super().__init__(master, **kwargs)
+        self.app = app
+        self.on_reach_top = on_reach_top
+        self.rows = []
+        self.heights = HeightIndex()
+        self.shown = {} # Row index -> (widget, canvas item)
+        self.previews = {} # Final image path -> index of the row showing its preview
+        self.pool = {kind: [] for kind in ESTIMATED_HEIGHTS}
+        self.thumbnails = OrderedDict()
+        self.stick_to_bottom = True
+        self.rendering = False
+
+        self.grid_rowconfigure(0, weight=1)
+        self.grid_columnconfigure(0, weight=1)
+        self.canvas = tk.Canvas(self, highlightthickness=0, bg=self._apply_appearance_mode(self.cget("fg_color")))
+        self.canvas.grid(row=0, column=0, sticky="nsew", padx=(5, 0), pady=5)
+        self.scrollbar = ctk.CTkScrollbar(self, command=self._on_scrollbar)
+        self.scrollbar.grid(row=0, column=1, sticky="ns", pady=5)
+        self.canvas.configure(yscrollcommand=self.scrollbar.set, yscrollincrement=20)
+
+        self.canvas.bind("<Configure>", lambda event: self._layout())
+        # Wheel events go to the widget under the pointer, so the canvas and
+        # every bubble carry this view's own tag; it is unbound in destroy()
+        self.wheel_tag = f"MessageListWheel{id(self)}"
+        self.wheel_events = ("<Button-4>", "<Button-5>") if "linux" in sys.platform else ("<MouseWheel>",)
+        for sequence in self.wheel_events:
+            self.bind_class(self.wheel_tag, sequence, self._on_mouse_wheel)
+        self._route_wheel(self.canvas)
+
+    def destroy(self):
+        for sequence in self.wheel_events:
+            self.unbind_class(self.wheel_tag, sequence)
+        super().destroy()
+
+    def _route_wheel(self, widget):
+        """Adds the wheel tag to widget and everything inside it."""
+        if self.wheel_tag not in widget.bindtags():
+            widget.bindtags((self.wheel_tag,) + widget.bindtags())
+        for child in widget.winfo_children():
+            self._route_wheel(child)
+
+    # --- Model ---
+    def extend(self, rows):
+        """Appends messages at the bottom, following them if the view was at the bottom.
+
+        An image row whose path has a preview row in the list replaces that
+        row instead, so the image appears where its preview was.
+        """
+        for row in rows:
+            index = self.previews.pop(row['path'], None) if row['kind'] == 'image' else None
+            if index is not None:
+                self._replace(index, row)
+                continue
+            if row.get('final'):
+                self.previews[row['final']] = len(self.rows)
+            self.rows.append(row)
+            self.heights.append(row.get('height') or ESTIMATED_HEIGHTS[row['kind']])
+        self._layout()
+
+    def _replace(self, index, row):
+        if index in self.shown:
+            self._release(index) # Drawn and measured again by the next render
+        row['height'] = self.rows[index].get('height')
+        self.rows[index] = row
+        self.thumbnails.pop(row['path'], None) # The file may reuse the name of an older image
+
+    def append(self, row):
+        self.extend([row])
+
+    def prepend(self, rows):
+        """Inserts older messages above the current ones without moving what is on screen."""
+        if not rows:
+            return
+        top = self.canvas.canvasy(0)
+        before = self.heights.total()
+        self.rows[:0] = rows
+        self.heights.prepend(row.get('height') or ESTIMATED_HEIGHTS[row['kind']] for row in rows)
+        self.shown = {index + len(rows): shown for index, shown in self.shown.items()}
+        self.previews = {path: index + len(rows) for path, index in self.previews.items()}
+        added = self.heights.total() - before
+        self._update_scrollregion()
+        self.canvas.yview_moveto((top + added) / max(self.heights.total(), 1))
+        self._render()
+
+    def scroll_to_end(self):
+        self.stick_to_bottom = True
+        self._layout()
+
+    # --- Scrolling ---
+    def _on_scrollbar(self, *args):
+        self.canvas.yview(*args)
+        self._after_scroll()
+
+    def _on_mouse_wheel(self, event):
+        if not self.canvas.winfo_exists():
+            return
+        if sys.platform.startswith("win"):
+            self.canvas.yview_scroll(-int(event.delta / 40), "units")
+        elif sys.platform == "darwin":
+            self.canvas.yview_scroll(-event.delta, "units")
+        else:
+            self.canvas.yview_scroll(-1 if event.num == 4 else 1, "units")
+        self._after_scroll()
+
+    def _after_scroll(self):
+        self.stick_to_bottom = self.canvas.yview()[1] >= 1.0
+        self._render()
+        if self.canvas.canvasy(0) <= 0 and self.on_reach_top:
+            self.on_reach_top()
+
+    # --- Rendering ---
+    def _update_scrollregion(self):
+        height = max(self.heights.total(), self.canvas.winfo_height())
+        self.canvas.configure(scrollregion=(0, 0, self.canvas.winfo_width(), height))
+
+    def _layout(self):
+        """Recomputes the scroll area and the position of every drawn row."""
+        self._update_scrollregion()
+        for index, (widget, item) in self.shown.items():
+            x, anchor = self._row_x(self.rows[index])
+            self.canvas.coords(item, x, self.heights.offset(index))
+        if self.stick_to_bottom:
+            self.canvas.yview_moveto(1.0)
+        self._render()
+
+    def _row_x(self, row):
+        if row['sender'] == "You":
+            return self.canvas.winfo_width() - 10, "ne"
+        if row['sender'] == "System":
+            return self.canvas.winfo_width() // 2, "n"
+        return 10, "nw"
+
+    def _render(self):
+        """Draws the rows in and near the visible area and recycles the rest."""
+        if self.rendering or not self.rows:
+            return
+        self.rendering = True
+        try:
+            top = self.canvas.canvasy(0)
+            first = self.heights.find(max(top - OVERSCAN, 0))
+            last = min(self.heights.find(top + self.canvas.winfo_height() + OVERSCAN), len(self.rows) - 1)
+            for index in [i for i in self.shown if not first <= i <= last]:
+                self._release(index)
+            new = [i for i in range(first, last + 1) if i not in self.shown]
+            for index in new:
+                self._show(index)
+            if new:
+                # Lay the new bubbles out so their real heights can be measured
+                self.canvas.update_idletasks()
+                changed = False
+                for index in new:
+                    height = self.shown[index][0].winfo_reqheight() + ROW_PADDING
+                    if height != self.heights[index]:
+                        self.heights.set(index, height)
+                        self.rows[index]['height'] = height
+                        changed = True
+                if changed:
+                    self._update_scrollregion()
+                    for index, (widget, item) in self.shown.items():
+                        self.canvas.coords(item, self._row_x(self.rows[index])[0], self.heights.offset(index))
+                    if self.stick_to_bottom:
+                        self.canvas.yview_moveto(1.0)
+        finally:
+            self.rendering = False
+
+    def _show(self, index):
+        row = self.rows[index]
+        widget = self.pool[row['kind']].pop() if self.pool[row['kind']] else self._create(row['kind'])
+        self._fill(widget, row)
+        x, anchor = self._row_x(row)
+        item = self.canvas.create_window(x, self.heights.offset(index), window=widget, anchor=anchor)
+        self.shown[index] = (widget, item)
+
+    def _release(self, index):
+        widget, item = self.shown.pop(index)
+        self.canvas.delete(item) # Unmaps the widget without destroying it
+        spare = self.pool[self.rows[index]['kind']]
+        if len(spare) < POOL_LIMIT:
+            spare.append(widget)
+        else:
+            widget.destroy()
+
+    def _create(self, kind):
+        widget = self._create_widget(kind)
+        self._route_wheel(widget)
+        return widget
+
+    def _create_widget(self, kind):
+        if kind == 'system':
+            return ctk.CTkLabel(self.canvas, text="", font=(self.app.app_font[0], 11), text_color="gray",
+                                wraplength=BUBBLE_WRAP + 50)
+        bubble = ctk.CTkFrame(self.canvas, corner_radius=10)
+        if kind == 'text':
+            bubble.content = ctk.CTkLabel(bubble, text="", wraplength=BUBBLE_WRAP, text_color="white")
+            bubble.content.pack(pady=5, padx=10)
+        elif kind == 'image':
+            bubble.content = ctk.CTkLabel(bubble, text="")
+            bubble.content.pack(pady=5, padx=5)
+        else:
+            bubble.content = ctk.CTkButton(bubble, text="")
+            bubble.content.pack(side="left", padx=10, pady=5)
+        return bubble
+
+    def _fill(self, widget, row):
+        """Points a pooled widget at another message."""
+        if row['kind'] == 'system':
+            widget.configure(text=row['text'])
+            return
+        widget.configure(fg_color=YOUR_BUBBLE_COLOR if row['sender'] == "You" else PEER_BUBBLE_COLOR)
+        if row['kind'] == 'text':
+            text = f"Peer: {row['text']}" if row['sender'] == "Peer" else row['text']
+            widget.content.configure(text=text, font=row['font'], justify="right" if row['sender'] == "You" else "left")
+        elif row['kind'] == 'image':
+            image = self._thumbnail(row['path'])
+            if image:
+                widget.content.configure(image=image, text="")
+            else:
+                # CTkLabel cannot drop an image once set, so text-only states get a fresh label
+                widget.content.destroy()
+                text = "[Error displaying image]" if row['path'] in self.thumbnails else "🖼️ Loading image..."
+                widget.content = ctk.CTkLabel(widget, text=text, text_color="white")
+                widget.content.pack(pady=5, padx=5)
+                self._route_wheel(widget.content)
+        else:
+            widget.content.configure(text=f"▶️ Play (~{row['duration']:.1f}s)",
+                                     command=lambda path=row['path']: self.app.play_audio(path))
+
+    def _thumbnail(self, path):
+        """Returns the CTkImage for path, or None and asks for it to be decoded in the background."""
+        if path in self.thumbnails:
+            self.thumbnails.move_to_end(path)
+            return self.thumbnails[path]
+        image = self.app.thumbnails.get(path)
+        if image is None:
+            self.app.thumbnails.request(path, lambda path, image: self.app.post_ui_update('thumbnail', (path, image)))
+            return None
+        return self._cache_thumbnail(path, image)
+
+    def _cache_thumbnail(self, path, image):
+        thumbnail = ctk.CTkImage(light_image=image, dark_image=image, size=image.size) if image else None
+        self.thumbnails[path] = thumbnail
+        if len(self.thumbnails) > THUMBNAIL_CACHE:
+            self.thumbnails.popitem(last=False)
+        return thumbnail
+
+    def thumbnail_ready(self, path, image):
+        """Swaps the placeholder of every drawn row showing path for the decoded image."""
+        self._cache_thumbnail(path, image)
+        # Released rows are drawn again, and measured again, by the next render
+        for index in [i for i in self.shown if self.rows[i]['kind'] == 'image' and self.rows[i]['path'] == path]:
+            self._release(index)
+        self._render()
 
 class ChatApp(ctk.CTk):
-    def __init__(self):
+    def __init__(self, client_class=ChatClient):
         super().__init__()
         self.title("P2P Encrypted Messenger")
         self.geometry("400x500")
+        self.client_class = client_class
         self.chat_client = None
-        self.recorder = VoiceRecorder()
+        self.supervisor = None # Keeps chat_client connected, see start_client
+        self.key_service = KeyDerivationService()
+        self.history = HistoryStore()
+        self.history_cutoff = None
+        self.history_before = None # (ts, id) of the oldest history message shown
+        self.thumbnails = ThumbnailService()
+        try:
+            self.recorder = VoiceRecorder()
+        except RuntimeError as e:
+            print(f"Voice messages disabled: {e}")
+            self.recorder = None
         self.last_connection_details = {}
+        # Updates from network threads, applied in batches by drain_ui_updates
+        self.ui_updates = queue.SimpleQueue()
+        self.ui_drain_lock = threading.Lock()
+        self.ui_drain_scheduled = False
+        # Typed messages are sent and their rows built here, one at a time so they keep their order
+        self.message_sender = ThreadPoolExecutor(max_workers=1, thread_name_prefix="send-message")
 
         # --- Font Handling ---
         self.initialize_fonts()
@@ -81,9 +480,8 @@ class ChatApp(ctk.CTk):
         self.chat_frame.grid_rowconfigure(0, weight=1)
         self.chat_frame.grid_columnconfigure(0, weight=1)
 
-        self.scrollable_frame = ctk.CTkScrollableFrame(self.chat_frame)
-        self.scrollable_frame.grid(row=0, column=0, sticky="nsew", columnspan=2)
-        self.scrollable_frame.columnconfigure(0, weight=1)
+        self.message_list = MessageListView(self.chat_frame, self, on_reach_top=self.load_earlier_history)
+        self.message_list.grid(row=0, column=0, sticky="nsew", columnspan=2)
 
         bottom_frame = ctk.CTkFrame(self.chat_frame)
         bottom_frame.grid(row=1, column=0, sticky="ew", pady=(10,0))
@@ -106,6 +504,10 @@ class ChatApp(ctk.CTk):
 
         self.call_button = ctk.CTkButton(bottom_frame, text="📞", width=40, command=self.initiate_call)
         self.call_button.grid(row=0, column=4, pady=5, padx=5)
+        if not self.recorder:
+            # No audio backend, see __init__; calls would fail the same way
+            self.mic_button.configure(state="disabled")
+            self.call_button.configure(state="disabled")
 
         # --- Status and Leave Button ---
         status_frame = ctk.CTkFrame(self.chat_frame, fg_color="transparent")
@@ -115,27 +517,78 @@ class ChatApp(ctk.CTk):
         self.status_label_chat = ctk.CTkLabel(status_frame, text="Connected", height=10, font=(self.app_font[0], 11), text_color="gray")
         self.status_label_chat.grid(row=0, column=0, sticky="ew")
 
+        self.search_button = ctk.CTkButton(status_frame, text="🔍", command=self.search_history, width=30, height=20, font=(self.app_font[0], 10))
+        self.search_button.grid(row=0, column=1, padx=5)
+
         self.leave_button = ctk.CTkButton(status_frame, text="Leave Chat", command=self.leave_chat, width=80, height=20, font=(self.app_font[0], 10))
-        self.leave_button.grid(row=0, column=1, padx=5)
+        self.leave_button.grid(row=0, column=2, padx=5)
+
+        self.load_history()
     
+    def load_history(self):
+        """Shows the last screen of messages with this peer from before the connection."""
+        self.history_before = None
+        if not self.chat_client or self.history_cutoff is None:
+            return
+        # Messages after the cutoff arrive through the callbacks instead
+        self.history_before = (self.history_cutoff, 0)
+        self.message_list.extend(self.history_rows())
+
+    def load_earlier_history(self):
+        """Puts the page of history before the oldest message shown at the top of the list."""
+        if self.history_before is not None:
+            self.message_list.prepend(self.history_rows())
+
+    def history_rows(self):
+        """Reads the history page before self.history_before and moves the cursor past it."""
+        entries = self.history.page(self.chat_client.history_peer, HISTORY_PAGE_SIZE, before=self.history_before)
+        # A short page means the start of the conversation was reached
+        self.history_before = (entries[0]['ts'], entries[0]['id']) if len(entries) == HISTORY_PAGE_SIZE else None
+        return [self.history_row(entry) for entry in entries]
+
+    def history_row(self, entry):
+        sender, kind, path = entry['sender'], entry['kind'], entry['path']
+        if kind == 'text':
+            return self.message_row(entry['body'], sender)
+        if kind == 'image' and path and os.path.exists(path):
+            return {'kind': 'image', 'sender': sender, 'path': path}
+        if kind == 'audio' and path and os.path.exists(path):
+            return {'kind': 'audio', 'sender': sender, 'path': path, 'duration': entry['duration'] or 0}
+        if sender == "You":
+            return self.message_row(f"You sent file: {entry['body']}", "System")
+        return self.message_row(f"File '{entry['body']}' received.", "System")
+
+    def search_history(self):
+        """Asks for search words and lists the matching messages with this peer."""
+        dialog = ctk.CTkInputDialog(text="Search messages:", title="Search History")
+        text = dialog.get_input()
+        if not text or not self.chat_client:
+            return
+        results = self.history.search(text, peer=self.chat_client.history_peer)
+
+        window = ctk.CTkToplevel(self)
+        window.title(f"Search: {text}")
+        window.geometry("380x400")
+        results_box = ctk.CTkTextbox(window, font=(self.persian_font_family, 12), wrap="word")
+        results_box.pack(fill="both", expand=True, padx=10, pady=10)
+        if not results:
+            results_box.insert("end", "No messages found.")
+        for entry in results:
+            when = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry['ts']))
+            results_box.insert("end", f"{when}  {entry['sender']}: {entry['body']}\n\n")
+        results_box.configure(state="disabled")
+
     def clear_frame(self):
         for widget in self.winfo_children():
             widget.destroy()
 
     def start_listening(self):
-        if not self.initialize_client(): return
-        self.last_connection_details["mode"] = "listen"
-        port = int(self.port_entry.get())
-        threading.Thread(target=self.chat_client.listen, args=('0.0.0.0', port), daemon=True).start()
+        self.initialize_client("listen")
 
     def start_connecting(self):
-        if not self.initialize_client(): return
-        self.last_connection_details["mode"] = "connect"
-        ip = self.ip_entry.get()
-        port = int(self.port_entry.get())
-        threading.Thread(target=self.chat_client.connect, args=(ip, port), daemon=True).start()
+        self.initialize_client("connect")
     
-    def initialize_client(self):
+    def initialize_client(self, mode):
         secret = self.secret_entry.get()
         if not secret or not self.port_entry.get():
             self.status_label.configure(text="Secret and Port are required.")
@@ -145,144 +598,166 @@ class ChatApp(ctk.CTk):
         self.last_connection_details = {
             'secret': secret,
             'port': int(self.port_entry.get()),
-            'ip': self.ip_entry.get()
+            'ip': self.ip_entry.get(),
+            'mode': mode
         }
 
-        SALT = b'p2p_chat_salt_'
-        key = derive_key(secret, SALT)
-        self.chat_client = ChatClient(key, 
+        self.status_label.configure(text="Deriving key...")
+        self.stop_supervisor()
+        self.derive_key_then(secret, self.start_client)
+        return True
+
+    def derive_key_then(self, secret, callback):
+        """Derives the key on a worker thread, then calls back on the Tk thread with the future."""
+        future = self.key_service.derive(secret, SALT)
+        future.add_done_callback(lambda f: self.after(0, callback, f))
+
+    def start_client(self, key_future):
+        """Creates the chat client once the key is ready and starts listening or connecting."""
+        try:
+            key = key_future.result()
+        except Exception as e:
+            self.on_connection_status(f"Key derivation failed: {e}", is_connected=False)
+            return
+
+        self.chat_client = self.client_class(key, 
                                      on_message_received=self.on_message_received,
                                      on_connection_status=self.on_connection_status,
                                      on_image_received=self.on_image_received,
                                      on_audio_received=self.on_audio_received,
                                      on_connection_request=self.on_connection_request,
                                      on_call_request=self.on_call_request,
-                                     on_call_status=self.on_call_status)
-        self.after(100, self._scroll_to_bottom)
-        return True
+                                     on_call_status=self.on_call_status,
+                                     on_transfer_progress=self.on_transfer_progress,
+                                     on_image_preview=self.on_image_preview,
+                                     history=self.history)
+
+        # Listens or dials now and again whenever the connection drops
+        details = self.last_connection_details
+        host = '0.0.0.0' if details.get("mode") == "listen" else details['ip']
+        self.supervisor = ReconnectSupervisor(self.chat_client, details['mode'], host, details['port'],
+                                              on_retry=self.on_reconnect_retry)
+        self.supervisor.start()
+
+    def on_reconnect_retry(self, attempt, delay):
+        self.after(0, self.on_connection_status, f"Connection failed. Retrying in {delay:.0f}s (attempt {attempt})...", False)
+
+    def stop_supervisor(self):
+        if self.supervisor:
+            self.supervisor.stop()
+            self.supervisor = None
 
     def send_chat_message(self):
         msg = self.message_entry.get()
         if msg:
-            # Check if message contains Persian characters
-            font_to_use = self.app_font
-            if any("\u0600" <= char <= "\u06FF" for char in msg):
-                 font_to_use = (self.persian_font_family, 14)
-
-            self.chat_client.send_message(msg)
-            self.display_message(msg, sender="You", font=font_to_use)
             self.message_entry.delete(0, tk.END)
+            self.message_sender.submit(self.send_and_display, self.chat_client, msg)
 
-    def display_message(self, message, sender=None, font=None):
-        if font is None:
-            font_to_use = self.app_font
-            if any("\u0600" <= char <= "\u06FF" for char in message):
-                 font_to_use = (self.persian_font_family, 14)
+    def send_and_display(self, client, msg):
+        """Sends a typed message and queues its row, on the message_sender thread."""
+        try:
+            client.send_message(msg)
+        except Exception as e:
+            print(f"Could not send message: {e}")
+            return
+        self.display_message(msg, sender="You")
+
+    # --- UI Update Queue ---
+    def post_ui_update(self, kind, value):
+        """Queues a 'row' for the message list, a decoded 'thumbnail' or the latest 'status' text.
+
+        Safe to call from any thread.
+        """
+        self.ui_updates.put((kind, value))
+        with self.ui_drain_lock:
+            if self.ui_drain_scheduled:
+                return
+            self.ui_drain_scheduled = True
+        self.after(UI_FRAME_MS, self.drain_ui_updates)
+
+    def drain_ui_updates(self):
+        """Applies everything queued since the last frame: one insert, one scroll, one status change."""
+        with self.ui_drain_lock:
+            self.ui_drain_scheduled = False
+        rows, thumbnails, status = [], [], None
+        while True:
+            try:
+                kind, value = self.ui_updates.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'row':
+                rows.append(value)
+            elif kind == 'thumbnail':
+                thumbnails.append(value)
             else:
-                font_to_use = self.app_font
-        else:
-            font_to_use = font
-        
-        # Handle System messages
+                status = value
+        # Check if the chat UI is still active before proceeding
+        if self.chat_ui_active():
+            if rows:
+                self.message_list.extend(rows)
+            for path, image in thumbnails:
+                self.message_list.thumbnail_ready(path, image)
+        if status is not None and hasattr(self, 'status_label_chat') and self.status_label_chat.winfo_exists():
+            self.status_label_chat.configure(text=status)
+
+    def message_row(self, message, sender, font=None):
+        """Builds the message list row for a text or system message."""
         if sender == "System":
-            msg_label = ctk.CTkLabel(self.scrollable_frame, text=message, font=(self.app_font[0], 11), text_color="gray")
-            msg_label.pack(pady=5, padx=10, anchor="center")
-            self.after(100, self._scroll_to_bottom)
-            return
-
-        display_text = message
-        if sender == "Peer":
-            display_text = f"Peer: {message}"
+            return {'kind': 'system', 'sender': sender, 'text': message}
+        if font is None:
+            font = self.app_font
+            if any("\u0600" <= char <= "\u06FF" for char in message):
+                font = (self.persian_font_family, 14)
+        return {'kind': 'text', 'sender': sender, 'text': message, 'font': font}
 
-        bubble_color = "#2b3033"  # Peer's message color
-        text_color = "white"
-        justify = "left"
-        anchor = "w"
-        if sender == "You":
-            bubble_color = "#005c4b"  # Your message color
-            justify = "right"
-            anchor = "e"
-        
-        # Create a bubble frame
-        bubble_frame = ctk.CTkFrame(self.scrollable_frame, fg_color=bubble_color, corner_radius=10)
-        
-        msg_label = ctk.CTkLabel(bubble_frame, text=display_text, wraplength=250, justify=justify, font=font_to_use, text_color=text_color)
-        msg_label.pack(pady=5, padx=10)
-        
-        bubble_frame.pack(pady=2, padx=10, anchor=anchor)
-        
-        self.after(100, self._scroll_to_bottom)
+    def display_message(self, message, sender=None, font=None):
+        self.post_ui_update('row', self.message_row(message, sender, font))
     
     def on_message_received(self, message, sender="Peer"):
-        # This is called from a worker thread, so we use `after` to safely update the UI
-        self.after(0, self._update_ui_for_message, message, sender)
-
-    def _update_ui_for_message(self, message, sender):
-        """Helper function to run display_message on the main thread."""
-        # Check if the chat UI is still active before proceeding
-        if not hasattr(self, 'scrollable_frame') or not self.scrollable_frame.winfo_exists():
-            return
-
-        font_to_use = self.app_font
-        if any("\u0600" <= char <= "\u06FF" for char in message):
-            font_to_use = (self.persian_font_family, 14)
-        self.display_message(message, sender=sender, font=font_to_use)
+        # Called from a worker thread, which also does the font detection
+        self.display_message(message, sender=sender)
 
     def on_image_received(self, filepath, sender):
-        self.after(0, self.display_image, filepath, sender)
-
-    def on_audio_received(self, filepath, duration, sender):
-        self.after(0, self.display_audio_player, filepath, duration, sender)
+        self.display_image(filepath, sender)
 
-    def display_image(self, filepath, sender):
-        try:
-            anchor = "e" if sender == "You" else "w"
-            bubble_color = "#005c4b" if sender == "You" else "#2b3033"
+    def on_image_preview(self, filepath, preview_path, sender):
+        # The row shows the preview until an image row for filepath arrives and takes its place
+        self.post_ui_update('row', {'kind': 'image', 'sender': sender, 'path': preview_path, 'final': filepath})
 
-            bubble_frame = ctk.CTkFrame(self.scrollable_frame, fg_color=bubble_color, corner_radius=10)
-            
-            image = Image.open(filepath)
-            max_size = (250, 250)
-            image.thumbnail(max_size, Image.Resampling.LANCZOS)
-            
-            ctk_image = ctk.CTkImage(light_image=image, dark_image=image, size=image.size)
-            
-            img_label = ctk.CTkLabel(bubble_frame, image=ctk_image, text="")
-            img_label.pack(pady=5, padx=5)
+    def on_audio_received(self, filepath, duration, sender):
+        self.display_audio_player(filepath, duration, sender)
 
-            bubble_frame.pack(pady=5, padx=10, anchor=anchor)
+    def on_transfer_progress(self, transfer_id, filename, done, total, direction):
+        self.post_ui_update('status', self.transfer_status(filename, done, total, direction))
 
-            self.after(100, self._scroll_to_bottom)
+    def transfer_status(self, filename, done, total, direction):
+        """Status bar text for the progress of a streaming file transfer."""
+        if done >= total:
+            return "Connected"
+        verb = "Sending" if direction == "send" else "Receiving"
+        percent = int(done * 100 / total) if total else 0
+        return f"{verb} {filename}: {percent}%"
 
-        except Exception as e:
-            self.display_message(f"[Error displaying image: {e}]", sender="System")
+    def display_image(self, filepath, sender):
+        self.post_ui_update('row', {'kind': 'image', 'sender': sender, 'path': filepath})
 
     def display_audio_player(self, filepath, duration, sender):
-        anchor = "e" if sender == "You" else "w"
-        bubble_color = "#005c4b" if sender == "You" else "#2b3033"
-
-        bubble_frame = ctk.CTkFrame(self.scrollable_frame, fg_color=bubble_color, corner_radius=10)
-        
-        def play_audio():
-            try:
-                abs_path = os.path.abspath(filepath)
-                threading.Thread(target=playsound, args=(abs_path,), daemon=True).start()
-            except Exception as e:
-                print(f"Error playing sound: {e}")
+        self.post_ui_update('row', {'kind': 'audio', 'sender': sender, 'path': filepath, 'duration': duration})
 
-        play_button = ctk.CTkButton(bubble_frame, text=f"▶️ Play (~{duration:.1f}s)", command=play_audio)
-        play_button.pack(side="left", padx=10, pady=5)
-
-        bubble_frame.pack(pady=5, padx=10, anchor=anchor)
-        self.after(100, self._scroll_to_bottom)
+    def play_audio(self, filepath):
+        try:
+            abs_path = os.path.abspath(filepath)
+            threading.Thread(target=playsound, args=(abs_path,), daemon=True).start()
+        except Exception as e:
+            print(f"Error playing sound: {e}")
 
-    def _scroll_to_bottom(self):
-        # Check if the chat UI components still exist before trying to scroll
-        if hasattr(self, 'scrollable_frame') and self.scrollable_frame.winfo_exists():
-            self.scrollable_frame._parent_canvas.yview_moveto(1.0)
+    def chat_ui_active(self):
+        return hasattr(self, 'message_list') and self.message_list.winfo_exists()
 
     def on_connection_status(self, status, is_connected):
         if is_connected:
+            # Called before any message of the new session is received
+            self.history_cutoff = time.time()
             self.after(0, self.setup_chat_ui)
             # This lambda ensures the status label exists before we try to configure it.
             self.after(100, lambda: self.status_label_chat.configure(text=status) if hasattr(self, 'status_label_chat') else None)
@@ -305,35 +780,24 @@ class ChatApp(ctk.CTk):
                 self.status_label.configure(text=status)
 
     def attempt_reconnect(self):
-        """Tries to reconnect using the last known connection details."""
+        """Reconnects right away instead of waiting out the supervisor's backoff."""
         if not self.last_connection_details:
             self.leave_chat() # No details to use, go to login
             return
 
         self.status_label_chat.configure(text="Attempting to reconnect...")
-        
-        # Re-initialize client with the same secret
-        SALT = b'p2p_chat_salt_'
-        key = derive_key(self.last_connection_details['secret'], SALT)
-        self.chat_client = ChatClient(key, 
-                                     on_message_received=self.on_message_received,
-                                     on_connection_status=self.on_connection_status,
-                                     on_image_received=self.on_image_received,
-                                     on_audio_received=self.on_audio_received)
-        
-        mode = self.last_connection_details.get("mode")
-        if mode == "listen":
-            port = self.last_connection_details['port']
-            threading.Thread(target=self.chat_client.listen, args=('0.0.0.0', port), daemon=True).start()
-        elif mode == "connect":
-            ip = self.last_connection_details['ip']
-            port = self.last_connection_details['port']
-            threading.Thread(target=self.chat_client.connect, args=(ip, port), daemon=True).start()
+        if self.supervisor and not self.chat_client.session_ended:
+            self.supervisor.retry_now()
+            return
+        # The peer left on purpose, so nothing is reconnecting; start over with the cached key
+        self.stop_supervisor()
+        self.derive_key_then(self.last_connection_details['secret'], self.start_client)
 
     def attach_file(self):
         filepath = filedialog.askopenfilename()
         if filepath:
-            threading.Thread(target=self.chat_client.send_file, args=(filepath,), daemon=True).start()
+            send = self.chat_client.send_image if self.chat_client.is_image(filepath) else self.chat_client.send_file
+            threading.Thread(target=send, args=(filepath,), daemon=True).start()
 
     def paste_from_clipboard(self, event=None):
         if not self.chat_client or not self.chat_client.is_connected:
@@ -344,48 +808,53 @@ class ChatApp(ctk.CTk):
             if isinstance(image, Image.Image):
                 temp_filepath = f"pasted_image_{int(time.time())}.png"
                 save_path = os.path.join(self.chat_client.downloads_dir, temp_filepath)
-                image.save(save_path, 'PNG')
 
-                threading.Thread(
-                    target=self.chat_client.send_file,
-                    args=(save_path,),
-                    daemon=True
-                ).start()
+                def save_and_send():
+                    # Big screenshots take a while to encode, so stay off the Tk thread
+                    image.save(save_path, 'PNG', compress_level=1)
+                    self.chat_client.send_image(save_path)
+
+                threading.Thread(target=save_and_send, daemon=True).start()
                 
                 return "break"
         except Exception:
             pass
 
     def start_recording_ui(self, event):
+        if not self.recorder or self.recorder.is_recording:
+            return
+        try:
+            note = self.recorder.start_recording()
+        except OSError as e:
+            print(f"Error starting voice recording: {e}")
+            return
         self.mic_button.configure(text="Recording...")
-        self.recorder.start_recording()
+        # The note is sent while it is being recorded and finishes right after release
+        threading.Thread(target=self.chat_client.send_voice_note, args=(note,), daemon=True).start()
 
     def stop_recording_ui(self, event):
+        if not self.recorder:
+            return
         self.mic_button.configure(text="🎙️")
-        temp_filepath, duration = self.recorder.stop_recording()
-        if temp_filepath:
-            permanent_filepath = os.path.join(self.chat_client.downloads_dir, os.path.basename(temp_filepath))
-            try:
-                os.rename(temp_filepath, permanent_filepath)
-                threading.Thread(
-                    target=self.chat_client.send_file, 
-                    args=(permanent_filepath, True, duration), 
-                    daemon=True
-                ).start()
-            except OSError as e:
-                print(f"Error moving/sending audio file: {e}")
+        self.recorder.stop_recording()
     
     def leave_chat(self):
         """Disconnects from the chat and returns to the login screen."""
+        self.stop_supervisor()
         if self.chat_client:
             self.chat_client.disconnect()
         self.setup_login_ui()
 
     def on_closing(self):
+        self.message_sender.shutdown() # Messages already typed go out before the goodbye
+        self.key_service.clear()
         if self.recorder:
             self.recorder.terminate()
+        self.stop_supervisor()
         if self.chat_client:
             self.chat_client.disconnect()
+        self.history.close()
+        self.thumbnails.close()
         self.destroy()
 
     def on_connection_request(self, addr):
@@ -509,5 +978,6 @@ class CallWindow(ctk.CTkToplevel):
 
 if __name__ == "__main__":
     ctk.set_appearance_mode("dark")
-    app = ChatApp()
+    # --asyncio runs all networking on a single event loop thread
+    app = ChatApp(client_class=AsyncChatClient if "--asyncio" in sys.argv else ChatClient)
     app.mainloop() 
\ No newline at end of file